@@ -1,22 +1,43 @@
 # app/__init__.py
 import os
 from flask import Flask
+from sqlalchemy import event
 from .config import Config
-from .extensions import executor, task_statuses, login_manager, db, migrate, socketio
+from .extensions import executor, task_statuses, job_queue, login_manager, db, migrate, socketio
+from .utils.log import setup_logging
+
+
+def _configure_sqlite(app):
+    """PRAGMA для каждого нового соединения с SQLite (см. SQLITE_* в config.py)."""
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    journal_mode = app.config['SQLITE_JOURNAL_MODE']
+    busy_timeout = int(app.config['SQLITE_BUSY_TIMEOUT_MS'])
+    synchronous = app.config['SQLITE_SYNCHRONOUS']
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        cursor.execute(f"PRAGMA busy_timeout={busy_timeout}")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.close()
 
 
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
+    # До первого обращения к app.logger: Flask не добавит свой обработчик
+    setup_logging(app)
 
     login_manager.init_app(app)
     db.init_app(app)
     migrate.init_app(app, db)
+    with app.app_context():
+        _configure_sqlite(app)
 
-    # --- ИЗМЕНЕНИЕ ЗДЕСЬ ---
-    # Добавляем 'message_queue'
-    socketio.init_app(app, async_mode='threading', message_queue='memory://')
-    # --- КОНЕЦ ИЗМЕНЕНИЯ ---
+    socketio.init_app(app, async_mode='threading', message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
 
     # Создаем необходимые директории
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -26,16 +47,32 @@ def create_app():
     os.makedirs(app.config['DICTIONARIES_FOLDER'], exist_ok=True)
     os.makedirs(app.config['GEOCODING_DATA_FOLDER'], exist_ok=True)
 
+    # Хранилище состояния задач (после создания PROCESSED_FOLDER)
+    task_statuses.init_app(app)
+    job_queue.init_app(app)
+
     # --- Настройка User Loader ---
     from .services import user_service
     @login_manager.user_loader
     def load_user(user_id):
-        return user_service.get_user_by_id(user_id)  # Эта функция будет переписана под DB
+        return user_service.load_user(user_id)
 
     # Регистрируем все маршруты (blueprints)
     from .routes import register_routes
     register_routes(app)
 
+    # Фоновая запись журнала задач
+    from .services import logging_service
+    logging_service.configure_writer(app)
+
+    # Обработчики очереди заданий в веб-процессе (запускаются с первым запросом)
+    if app.config['JOB_QUEUE_WEB_WORKERS'] > 0:
+        from .services import job_worker
+
+        @app.before_request
+        def ensure_job_workers():
+            job_worker.start_web_workers(app)
+
     with app.app_context():
         from . import models
 
@@ -2,6 +2,23 @@
 import os
 
 
+def _engine_options(database_uri):
+    """
+    Параметры пула соединений SQLAlchemy. Для серверной БД (DATABASE_URL)
+    настраиваются переменными окружения, для SQLite используются значения
+    по умолчанию (настройки SQLite - PRAGMA при подключении, см. app/__init__.py).
+    """
+    if database_uri.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'a-very-secret-key-that-you-should-change'
 
@@ -14,6 +31,23 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
                               'sqlite:///' + os.path.join(DATA_DIR, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # Отключаем ненужное отслеживание
+    SQLALCHEMY_ENGINE_OPTIONS = _engine_options(SQLALCHEMY_DATABASE_URI)
+
+    # --- SQLite: WAL (чтение не блокируется записью), ожидание блокировки вместо
+    # ошибки 'database is locked' и synchronous=NORMAL (в режиме WAL безопасно) ---
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+
+    # --- Журнал задач: запись фоновым потоком пачками ---
+    TASK_LOG_ASYNC = os.environ.get('TASK_LOG_ASYNC', '1') != '0'
+    TASK_LOG_BATCH_SIZE = 100
+    TASK_LOG_FLUSH_INTERVAL = 1.0  # секунды
+
+    # --- Кэш пользователей Flask-Login (services/user_service.py): без запроса
+    # к DB на каждый запрос; 0 - загружать пользователя из DB каждый раз ---
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))  # секунды
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
 
     # --- Folder Configurations (Based on DATA_DIR) ---
     UPLOAD_FOLDER = os.path.join(DATA_DIR, 'user_uploads')
@@ -31,4 +65,69 @@ class Config:
     VALUE_DICTIONARY_FILE = os.path.join(DICTIONARIES_FOLDER, 'values.json')
     ADDRESS_CSV_FILE = os.path.join(GEOCODING_DATA_FOLDER, 'addresses.csv')
 
-    ALLOWED_EXTENSIONS = {'xlsx', 'xlsm'}
\ No newline at end of file
+    ALLOWED_EXTENSIONS = {'xlsx', 'xlsm'}
+
+    # --- Обработка ---
+    # Колонки источника, на которые ссылаются правила, извлекаются один раз
+    # в компактные массивы (см. services/source_cache.py)
+    COLUMNAR_SOURCE_CACHE = os.environ.get('COLUMNAR_SOURCE_CACHE', '1') != '0'
+    # Чтение книги-источника: 'stream' - потоковый разбор XML (lxml, см.
+    # services/xlsx_reader.py), 'openpyxl' - load_workbook
+    SOURCE_READER = os.environ.get('SOURCE_READER', 'stream')
+    # Строки результата записываются в XML листа на диске по мере заполнения,
+    # а не в ячейки шаблона в памяти (см. services/output_writer.py)
+    STREAMING_OUTPUT = os.environ.get('STREAMING_OUTPUT', '1') != '0'
+
+    # --- Состояние задач и результаты ---
+    # 'sqlite' - общее для всех процессов (несколько воркеров gunicorn),
+    # 'memory' - в памяти одного процесса (см. services/task_store.py)
+    TASK_STORE = os.environ.get('TASK_STORE', 'sqlite')
+    TASK_STORE_PATH = os.environ.get('TASK_STORE_PATH')  # по умолчанию PROCESSED_FOLDER/tasks.db
+    TASK_RESULT_TTL_HOURS = 24  # Задачи и результаты старше этого срока удаляются
+
+    # Кэш результатов: повторный запуск с теми же файлами и правилами не
+    # обрабатывается заново (см. services/result_cache.py)
+    RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', '1') != '0'
+    RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+
+    # Инкрементальный режим: для растущих источников обрабатываются только
+    # новые строки (см. services/incremental_service.py). Состояние линии
+    # источника, не обновлявшееся этот срок, удаляется
+    INCREMENTAL_STATE_TTL_DAYS = 30
+
+    # Предпросмотр (POST /preview, см. services/preview_service.py): строк данных
+    # по умолчанию и не больше, время на чтение источника в секундах
+    PREVIEW_ROWS = 20
+    PREVIEW_MAX_ROWS = 200
+    PREVIEW_TIME_BUDGET = float(os.environ.get('PREVIEW_TIME_BUDGET', 1.0))
+
+    # --- Очередь заданий обработки (см. services/job_queue.py) ---
+    JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH')  # по умолчанию UPLOAD_FOLDER/jobs/queue.db
+    # Обработчики очереди внутри веб-процесса; 0 - только отдельные процессы manage.py worker
+    JOB_QUEUE_WEB_WORKERS = int(os.environ.get('JOB_QUEUE_WEB_WORKERS', 1))
+    JOB_POLL_INTERVAL = 1.0  # секунды
+    JOB_LEASE_SECONDS = 60  # Задание упавшего обработчика возвращается в очередь через это время
+    JOB_HEARTBEAT_INTERVAL = 15  # секунды
+    JOB_MAX_ATTEMPTS = 3
+    # Планирование: всего выполняющихся заданий (во всех обработчиках) и на
+    # одного пользователя (0 - без ограничения); файлы-источники до
+    # JOB_SMALL_FILE_BYTES обрабатываются в первую очередь
+    JOB_MAX_RUNNING = int(os.environ.get('JOB_MAX_RUNNING', 4))
+    JOB_MAX_RUNNING_PER_USER = int(os.environ.get('JOB_MAX_RUNNING_PER_USER', 2))
+    JOB_SMALL_FILE_BYTES = 2 * 1024 * 1024
+
+    # Очередь сообщений Socket.IO (kombu): при нескольких воркерах - общий брокер,
+    # например redis://localhost:6379/0, иначе события доходят только до своего процесса
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', 'memory://')
+
+    # --- Логирование ---
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+    # --- Метрики ---
+    # Токен для /admin/metrics без входа администратора (Authorization: Bearer <токен>)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # --- Загрузка больших файлов по частям ---
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024))
+    UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 1024 * 1024 * 1024))
+    UPLOAD_STALE_HOURS = 48  # Незавершенные загрузки старше этого срока удаляются
\ No newline at end of file
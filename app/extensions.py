@@ -4,6 +4,8 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_socketio import SocketIO
 from flask_executor import Executor
+from app.services.task_store import TaskStore
+from app.services.job_queue import JobQueue
 
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
@@ -16,8 +18,11 @@ migrate = Migrate()
 # --- ИЗМЕНЕНИЕ ЗДЕСЬ ---
 # 1. Возвращаем 'threading'
 # 2. Добавляем message_queue (kombu у вас уже есть в requirements.txt)
-socketio = SocketIO(async_mode='threading', message_queue='memory://')
+socketio = SocketIO(async_mode='threading')
 # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
 executor = Executor()
-task_statuses = {}
\ No newline at end of file
+# Состояние задач (см. services/task_store.py), бэкенд выбирается в create_app
+task_statuses = TaskStore()
+# Очередь заданий обработки (см. services/job_queue.py)
+job_queue = JobQueue()
@@ -40,13 +40,43 @@ class TaskLog(db.Model):
     Модель для логгирования каждой задачи парсинга.
     """
     __tablename__ = 'task_log'
+    __table_args__ = (
+        # Журнал задач пользователя: фильтр по владельцу и сортировка/диапазон по дате
+        db.Index('ix_task_log_owner_id_timestamp', 'owner_id', 'timestamp'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     task_uuid = db.Column(db.String(36), index=True)  # task_id из task_statuses
     template_name = db.Column(db.String(255))
     status = db.Column(db.String(500))  # 'Готово!' или 'Ошибка: ...'
+    status_kind = db.Column(db.String(10), index=True)  # 'success', 'error' или 'cancelled' (для группировки в отчетах)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.datetime.now)
-    owner_id = db.Column(db.String(36), db.ForeignKey('user.id'))
+    owner_id = db.Column(db.String(36), db.ForeignKey('user.id'), index=True)
+
+    # --- Метрики обработки (см. services/task_metrics.py) ---
+    duration = db.Column(db.Float, nullable=True)  # секунды
+    source_rows = db.Column(db.Integer, nullable=True)
+    target_rows = db.Column(db.Integer, nullable=True)
+    input_bytes = db.Column(db.BigInteger, nullable=True)  # источник + шаблон
+    output_bytes = db.Column(db.BigInteger, nullable=True)
+    peak_rss_bytes = db.Column(db.BigInteger, nullable=True)
 
     # Связь: "Какая задача принадлежит какому пользователю?"
-    owner = db.relationship('User', back_populates='task_logs')
\ No newline at end of file
+    owner = db.relationship('User', back_populates='task_logs')
+    # Время по этапам обработки
+    stages = db.relationship('TaskStageTiming', back_populates='task_log', cascade='all, delete-orphan',
+                             order_by='TaskStageTiming.id')
+
+
+class TaskStageTiming(db.Model):
+    """
+    Время одного этапа обработки задачи (load, columns, formulas, save, ...).
+    """
+    __tablename__ = 'task_stage_timing'
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_log_id = db.Column(db.Integer, db.ForeignKey('task_log.id', ondelete='CASCADE'), index=True, nullable=False)
+    stage = db.Column(db.String(32), nullable=False)
+    seconds = db.Column(db.Float, nullable=False)
+
+    task_log = db.relationship('TaskLog', back_populates='stages')
\ No newline at end of file
@@ -1,24 +1,46 @@
 # app/routes/admin.py
 import os
-import glob
 import json
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
+import hmac
+import datetime
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, Response, abort
 from flask_login import login_required, current_user
 from app.utils.decorators import admin_required
 from app.services import user_service
 from app.services import logging_service
 from app.services import geocoding_service  # <-- Убедитесь, что этот импорт есть
+from app.services import metrics_service
+from app.extensions import task_statuses, job_queue
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+# Записей журнала задач на странице
+REPORT_PAGE_SIZE = 50
+
 
-# Применяем декораторы ко всему Blueprint
-@admin_bp.before_request
 @login_required
 @admin_required
+def _require_admin():
+    """Пропускает только вошедших администраторов."""
+    pass
+
+
+def _has_metrics_token():
+    """Проверяет токен сборщика метрик (заголовок 'Authorization: Bearer <METRICS_TOKEN>')."""
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+
+
+# Применяем декораторы ко всему Blueprint
+@admin_bp.before_request
 def ensure_admin():
     """Защищает все маршруты в этом Blueprint."""
-    pass
+    # Сборщик метрик может авторизоваться токеном вместо входа администратора
+    if request.endpoint == 'admin.metrics' and _has_metrics_token():
+        return None
+    return _require_admin()
 
 
 @admin_bp.route('/users')
@@ -68,55 +90,104 @@ def delete_user():
     return redirect(url_for('admin.users_list'))
 
 
+# Кэш описаний шаблонов для отчета: {путь: (mtime, owner_id, имя шаблона)}.
+# JSON перечитывается только если файл изменился.
+_template_owner_cache = {}
+
+
+def _get_templates_by_owner():
+    """Имена созданных шаблонов по владельцам: {owner_id: [имя, ...]}."""
+    templates_by_owner = {}
+    seen_paths = set()
+    with os.scandir(current_app.config['TEMPLATES_DB_FOLDER']) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.json') or not entry.is_file():
+                continue
+            seen_paths.add(entry.path)
+            mtime = entry.stat().st_mtime
+            cached = _template_owner_cache.get(entry.path)
+            if cached is None or cached[0] != mtime:
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as file:
+                        data = json.load(file)
+                    cached = (mtime, data.get('owner_id'), data.get('template_name', 'Без имени'))
+                except Exception:
+                    cached = (mtime, None, None)  # Игнорируем ошибки чтения шаблонов
+                _template_owner_cache[entry.path] = cached
+            _, owner_id, template_name = cached
+            if owner_id:
+                templates_by_owner.setdefault(owner_id, []).append(template_name)
+    for path in set(_template_owner_cache) - seen_paths:
+        del _template_owner_cache[path]
+    return templates_by_owner
+
+
+def _get_date_range():
+    """Диапазон дат отчета из параметров date_from/date_to (YYYY-MM-DD)."""
+    dates = []
+    for name in ('date_from', 'date_to'):
+        value = request.args.get(name)
+        try:
+            dates.append(datetime.date.fromisoformat(value) if value else None)
+        except ValueError:
+            flash(f'Некорректная дата: {value}', 'error')
+            dates.append(None)
+    return dates
+
+
 @admin_bp.route('/reports')
 def reports():
     """Отображает страницу отчетности по активности пользователей."""
+    date_from, date_to = _get_date_range()
 
     # 1. Загружаем всех пользователей из DB
     users = user_service.get_all_users()
 
-    # 2. Инициализируем структуру отчета
+    # 2. Количество задач по пользователям и созданные шаблоны
+    task_counts = logging_service.get_task_counts_by_owner(date_from, date_to)
+    templates_by_owner = _get_templates_by_owner()
+
     report_data = {}
     for user in users:
+        counts = task_counts.get(user.id, {'tasks_run': 0, 'tasks_success': 0, 'tasks_error': 0})
         report_data[user.id] = {
             "username": user.username,
-            "templates_created": [],  # Заполним из JSON
-            "tasks_run": 0,
-            "tasks_success": 0,
-            "tasks_error": 0,
-            "task_log": []  # Заполним из DB
+            "templates_created": templates_by_owner.get(user.id, []),
+            **counts,
+            # Последние запуски; полный журнал - на странице пользователя
+            "task_log": logging_service.get_recent_tasks(user.id, 10, date_from, date_to) if counts['tasks_run'] else []
         }
 
-    # 3. Собираем данные о созданных шаблонах (по-прежнему из JSON)
-    template_files = glob.glob(os.path.join(current_app.config['TEMPLATES_DB_FOLDER'], '*.json'))
-    for f in template_files:
-        try:
-            with open(f, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-                owner_id = data.get('owner_id')
-                # Добавляем шаблон в отчет, только если у него есть владелец
-                if owner_id and owner_id in report_data:
-                    report_data[owner_id]['templates_created'].append(data.get('template_name', 'Без имени'))
-        except Exception:
-            pass  # Игнорируем ошибки чтения шаблонов
-
-    # 4. Собираем данные о выполненных задачах (из DB)
-    task_logs = logging_service.load_logs()  # <-- Получаем TaskLog объекты
-
-    for task in task_logs:
-        owner_id = task.owner_id
-        if owner_id in report_data:
-            report_data[owner_id]['tasks_run'] += 1
-            report_data[owner_id]['task_log'].append(task)  # Добавляем объект
-
-            if "Ошибка" in task.status:
-                report_data[owner_id]['tasks_error'] += 1
-            else:
-                report_data[owner_id]['tasks_success'] += 1
-
-    # task_logs уже отсортированы по дате из DB (см. logging_service.load_logs)
-
-    return render_template('admin_reports.html', report_data=report_data)
+    # 3. Производительность: самые медленные шаблоны и время по этапам
+    slowest_templates = logging_service.get_slowest_templates(date_from=date_from, date_to=date_to)
+    stage_breakdown = logging_service.get_stage_breakdown(date_from, date_to)
+
+    return render_template('admin_reports.html', report_data=report_data,
+                           slowest_templates=slowest_templates, stage_breakdown=stage_breakdown,
+                           date_from=date_from, date_to=date_to)
+
+
+@admin_bp.route('/reports/<user_id>')
+def user_task_log(user_id):
+    """Журнал задач пользователя с постраничным выводом и фильтром по датам."""
+    user = user_service.get_user_by_id(user_id)
+    if user is None:
+        abort(404)
+    date_from, date_to = _get_date_range()
+    page = request.args.get('page', 1, type=int)
+    pagination = logging_service.get_task_log_page(user_id, page=page, per_page=REPORT_PAGE_SIZE,
+                                                   date_from=date_from, date_to=date_to)
+    return render_template('admin_task_log.html', user=user, pagination=pagination,
+                           date_from=date_from, date_to=date_to)
+
+
+@admin_bp.route('/metrics')
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus."""
+    text = metrics_service.render(task_statuses, geocoding_service.address_service,
+                                  pending_task_logs=logging_service.pending_task_logs(),
+                                  job_stats=job_queue.stats())
+    return Response(text, mimetype='text/plain; version=0.0.4')
 
 
 #
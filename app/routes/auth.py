@@ -1,6 +1,6 @@
 # app/routes/auth.py
 import datetime  # <-- ДОБАВИТЬ ИМПОРТ
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_user, logout_user, login_required, current_user
 from app.services import user_service
 from app.extensions import db  # <-- ДОБАВИТЬ ИМПОРТ
@@ -29,7 +29,7 @@ def login():
                 db.session.commit()
             except Exception as e:
                 db.session.rollback()
-                print(f"Ошибка обновления last_login: {e}")  # Безопасный вывод в консоль
+                current_app.logger.error("Ошибка обновления last_login: %s", e)
             # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
             flash('Вход выполнен успешно.', 'success')
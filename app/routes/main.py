@@ -1,18 +1,16 @@
 # app/routes/main.py
 import os
 import io
+import shutil
 import uuid
-import json
 from flask import (Blueprint, render_template, request, jsonify,
                    send_from_directory, current_app, send_file)
-from werkzeug.utils import secure_filename
 from flask_login import login_required, current_user
 from flask_socketio import join_room
 
-from app.services.excel_processor import process_excel_hybrid
-# Мы по-прежнему импортируем оба,
-# но будем использовать 'socketio' для этой конкретной задачи
-from app.extensions import executor, task_statuses, socketio
+from app.services import (upload_service, metrics_service, job_worker, logging_service, result_cache,
+                          preview_service, template_plans, warning_report)
+from app.extensions import task_statuses, socketio
 
 main_bp = Blueprint('main', __name__)
 
@@ -31,14 +29,26 @@ def handle_join_task_room(data):
         join_room(task_id)
 
         # --- НОВЫЙ БЛОК: Отправляем статус сразу при входе ---
-        if task_id in task_statuses:
-            task_data = task_statuses.get(task_id)
-            if task_data:
-                # Отправляем 'status_update' только этому клиенту (request.sid)
-                socketio.emit('status_update', {
-                    'status': task_data.get('status', 'Загрузка...'),
-                    'progress': task_data.get('progress', 0)
-                }, room=request.sid)  # request.sid = только запросившему клиенту
+        # Состояние читается из общего хранилища: задача могла выполняться в другом воркере
+        task_data = task_statuses.get(task_id)
+        if task_data and 'result_ready' in task_data:
+            # Задача уже завершена (например, результат взят из кэша)
+            socketio.emit('task_complete', {
+                'task_id': task_id,
+                'status': task_data.get('status', 'Готово!'),
+                'progress': 100,
+                'result_ready': task_data['result_ready'],
+                'warnings': task_data.get('warnings') or [],
+                'warnings_report': task_data.get('warnings_report', False)
+            }, room=request.sid)
+            metrics_service.socketio_event('task_complete')
+        elif task_data:
+            # Отправляем 'status_update' только этому клиенту (request.sid)
+            socketio.emit('status_update', {
+                'status': task_data.get('status', 'Загрузка...'),
+                'progress': task_data.get('progress', 0)
+            }, room=request.sid)  # request.sid = только запросившему клиенту
+            metrics_service.socketio_event('status_update')
         # --- КОНЕЦ НОВОГО БЛОКА ---
 
 
@@ -46,29 +56,19 @@ def handle_join_task_room(data):
 @login_required
 def index():
     """Главная страница, отображает список доступных шаблонов."""
-    templates_path = current_app.config['TEMPLATES_DB_FOLDER']
     templates = []
-
-    if os.path.isdir(templates_path):
-        for f_name in os.listdir(templates_path):
-            if f_name.endswith('.json'):
-                try:
-                    with open(os.path.join(templates_path, f_name), 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-
-                        owner_id = data.get('owner_id')
-                        is_admin = current_user.role == 'admin'
-                        is_owner = (owner_id == current_user.id)
-                        is_public = (owner_id is None)
-
-                        if is_admin or is_owner or is_public:
-                            templates.append({
-                                'id': f_name.replace('.json', ''),
-                                'name': data.get('template_name', 'Без имени'),
-                                'owner_id': owner_id
-                            })
-                except Exception as e:
-                    current_app.logger.error(f"Ошибка чтения шаблона {f_name}: {e}")
+    is_admin = current_user.role == 'admin'
+    for template_id, data in template_plans.all_templates():
+        owner_id = data.get('owner_id')
+        is_owner = (owner_id == current_user.id)
+        is_public = (owner_id is None)
+
+        if is_admin or is_owner or is_public:
+            templates.append({
+                'id': template_id,
+                'name': data.get('template_name', 'Без имени'),
+                'owner_id': owner_id
+            })
 
     if current_user.role == 'admin':
         templates.sort(key=lambda x: (x.get('owner_id') != current_user.id, x['name']))
@@ -76,6 +76,152 @@ def index():
     return render_template('index.html', templates=templates)
 
 
+def _collect_task_settings(form, template_file_in_memory=None, template_filename=None):
+    """
+    Собирает все параметры задачи обработки из данных формы:
+    правила сохраненного шаблона или ручную настройку.
+    Ошибки пользователя выбрасываются как ValueError.
+    """
+    saved_template_id = form.get('saved_template')
+
+    # Инициализация всех переменных
+    settings = {
+        'template_rules': [], 'cell_mappings': [], 'formula_rules': [],
+        'static_value_rules': [], 'sheet_settings': [], 'source_cell_fill_rules': [],
+        'original_template_filename': "template.xlsx",
+        'post_function': 'none',
+        'visible_rows_only': False,
+        'template_file_in_memory': None,
+        'template_id': saved_template_id or None,
+        # Дописать к результату предыдущего прогона только новые строки источника
+        'incremental': form.get('incremental') in ('on', '1', 'true')
+    }
+    start_row = 1
+
+    if saved_template_id:
+        # --- ИСПОЛЬЗУЕМ СОХРАНЕННЫЙ ШАБЛОН ---
+        template_data = template_plans.get(saved_template_id)
+        if template_data is None:
+            raise ValueError('Файл шаблона не найден.')
+
+        # --- ПРОВЕРКА ДОСТУПА К ШАБЛОНУ ---
+        owner_id = template_data.get('owner_id')
+        if owner_id is not None:
+            if current_user.role != 'admin' and owner_id != current_user.id:
+                current_app.logger.warning(
+                    f"Пользователь {current_user.id} пытался использовать чужой шаблон {saved_template_id}")
+                raise ValueError('Доступ к этому шаблону запрещен.')
+
+        excel_folder = current_app.config['TEMPLATE_EXCEL_FOLDER']
+        template_filename = template_data.get('excel_file')
+        settings['original_template_filename'] = template_data.get('original_filename', template_filename)
+        template_file_path = os.path.join(excel_folder, template_filename)
+
+        with open(template_file_path, 'rb') as tf:
+            settings['template_file_in_memory'] = io.BytesIO(tf.read())
+
+        header_start_cell = template_data.get('header_start_cell', 'A1')
+        if header_start_cell:
+            start_row_match = "".join(filter(str.isdigit, header_start_cell))
+            if start_row_match:
+                start_row = int(start_row_match)
+
+        # --- СБОР ВСЕХ ПРАВИЛ ---
+        settings['template_rules'] = template_data.get('rules', [])
+        settings['cell_mappings'] = template_data.get('cell_mappings', [])
+        settings['formula_rules'] = template_data.get('formula_rules', [])
+        settings['static_value_rules'] = template_data.get('static_value_rules', [])
+        settings['sheet_settings'] = template_data.get('sheet_settings', [])
+        settings['post_function'] = template_data.get('post_function', 'none')
+        settings['visible_rows_only'] = template_data.get('visible_rows_only', False)
+        settings['source_cell_fill_rules'] = template_data.get('source_cell_fill_rules', [])
+
+    else:
+        # --- РУЧНАЯ НАСТРОЙКА ---
+        if template_file_in_memory is None:
+            raise ValueError('Файл-шаблон для ручной настройки не загружен.')
+        settings['template_file_in_memory'] = template_file_in_memory
+        settings['original_template_filename'] = template_filename
+
+        template_range_start_str = form.get('template_range_start', 'A1')
+        if template_range_start_str:
+            start_row_match = "".join(filter(str.isdigit, template_range_start_str))
+            if start_row_match:
+                start_row = int(start_row_match)
+
+    settings['ranges_settings'] = {'t_start_row': start_row}
+    return settings
+
+
+def _start_processing_task(source_file, settings):
+    """
+    Регистрирует задачу в task_statuses и ставит ее в очередь заданий
+    (выполняет обработчик очереди, см. services/job_worker.py).
+    source_file - файловый объект в памяти или путь к файлу на диске.
+    """
+    task_id = str(uuid.uuid4())
+
+    task_statuses.purge(current_app.config['TASK_RESULT_TTL_HOURS'])
+    warning_report.purge(current_app.config['TASK_RESULT_TTL_HOURS'])
+
+    cache_key = None
+    if current_app.config['RESULT_CACHE_ENABLED']:
+        cache_key = result_cache.make_key(source_file, settings)
+        cached = result_cache.lookup(cache_key)
+        if cached is not None:
+            _finish_from_cache(task_id, source_file, *cached)
+            return task_id
+
+    task_statuses.create(task_id, {
+        'status': 'Задача поставлена в очередь...',
+        'progress': 0,
+        'owner_id': current_user.id
+    })
+
+    try:
+        job_worker.submit_processing_job(current_app._get_current_object(), task_id, current_user.id,
+                                         source_file, settings, cache_key=cache_key)
+    except Exception:
+        task_statuses.delete(task_id)
+        raise
+    metrics_service.task_queued()
+    current_app.logger.debug("Задача %s поставлена в очередь", task_id)
+
+    return task_id
+
+
+def _finish_from_cache(task_id, source_file, result_path, meta):
+    """Задача, результат которой уже есть в кэше: сразу завершена, без постановки в очередь."""
+    final_status = 'Готово!'
+    has_report = False
+    if meta.get('report_path'):
+        # Отчет о замечаниях - копия закэшированного, под id новой задачи
+        report_path = warning_report.report_path(task_id)
+        try:
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+            shutil.copyfile(meta['report_path'], report_path)
+            has_report = True
+        except OSError:
+            current_app.logger.warning("Задача %s: не удалось скопировать отчет о замечаниях из кэша", task_id)
+    task_statuses.create(task_id, {
+        'status': final_status,
+        'progress': 100,
+        'owner_id': current_user.id,
+        'result_ready': True,
+        'from_cache': True,
+        'template_filename': meta.get('template_filename'),
+        'warnings': meta.get('warnings', []),
+        'warnings_report': has_report
+    })
+    with open(result_path, 'rb') as result_file:
+        task_statuses.save_result(task_id, result_file)
+    logging_service.log_task(task_id, current_user.id, final_status, meta.get('template_filename'))
+    if isinstance(source_file, (str, os.PathLike)):
+        # Собранная загрузка по частям больше не нужна
+        os.remove(source_file)
+    current_app.logger.info("Задача %s: результат взят из кэша", task_id)
+
+
 @main_bp.route('/process', methods=['POST'])
 @login_required
 def process_files():
@@ -88,127 +234,194 @@ def process_files():
         return jsonify({'error': 'Файл-источник не выбран.'})
 
     source_file_in_memory = io.BytesIO(source_file.read())
-    template_file_in_memory = None
 
-    saved_template_id = request.form.get('saved_template')
+    try:
+        template_file_in_memory, template_filename = None, None
+        if not request.form.get('saved_template') and 'template_file' in request.files:
+            template_file = request.files['template_file']
+            template_file_in_memory = io.BytesIO(template_file.read())
+            template_filename = template_file.filename
 
-    # Инициализация всех переменных
-    template_rules, cell_mappings, formula_rules, static_value_rules, sheet_settings = [], [], [], [], []
-    source_cell_fill_rules = []
-    original_template_filename = "template.xlsx"
-    start_row = 1
-    post_function = 'none'
-    visible_rows_only = False
+        settings = _collect_task_settings(request.form, template_file_in_memory, template_filename)
+        task_id = _start_processing_task(source_file_in_memory, settings)
+        return jsonify({'task_id': task_id})
+
+    except ValueError as e:
+        return jsonify({'error': str(e)})
+    except Exception as e:
+        current_app.logger.critical(f"Критическая ошибка в process_files: {e}", exc_info=True)
+        return jsonify({'error': f'Произошла внутренняя ошибка: {e}'})
+
+
+@main_bp.route('/preview', methods=['POST'])
+@login_required
+def preview():
+    """
+    Предпросмотр: первые rows строк результата в JSON, сразу в ответе.
+    Форма та же, что и для /process (источник не сохраняется и в очередь не ставится).
+    """
+    source_file = request.files.get('source_file')
+    if not source_file or source_file.filename == '':
+        return jsonify({'error': 'Файл-источник не выбран.'})
 
     try:
-        if saved_template_id:
-            # --- ИСПОЛЬЗУЕМ СОХРАНЕННЫЙ ШАБЛОН ---
-            json_path = os.path.join(current_app.config['TEMPLATES_DB_FOLDER'],
-                                     f"{secure_filename(saved_template_id)}.json")
-
-            if not os.path.exists(json_path):
-                return jsonify({'error': 'Файл шаблона не найден.'})
-
-            with open(json_path, 'r', encoding='utf-8') as f:
-                template_data = json.load(f)
-
-            # --- ПРОВЕРКА ДОСТУПА К ШАБЛОНУ ---
-            owner_id = template_data.get('owner_id')
-            if owner_id is not None:
-                if current_user.role != 'admin' and owner_id != current_user.id:
-                    current_app.logger.warning(
-                        f"Пользователь {current_user.id} пытался использовать чужой шаблон {saved_template_id}")
-                    return jsonify({'error': 'Доступ к этому шаблону запрещен.'})
-
-            excel_folder = current_app.config['TEMPLATE_EXCEL_FOLDER']
-            template_filename = template_data.get('excel_file')
-            original_template_filename = template_data.get('original_filename', template_filename)
-            template_file_path = os.path.join(excel_folder, template_filename)
-
-            with open(template_file_path, 'rb') as tf:
-                template_file_in_memory = io.BytesIO(tf.read())
+        rows = request.form.get('rows', type=int) or current_app.config['PREVIEW_ROWS']
+        if rows < 1:
+            raise ValueError('Число строк предпросмотра должно быть положительным.')
+        rows = min(rows, current_app.config['PREVIEW_MAX_ROWS'])
 
-            header_start_cell = template_data.get('header_start_cell', 'A1')
-            if header_start_cell:
-                start_row_match = "".join(filter(str.isdigit, header_start_cell))
-                if start_row_match:
-                    start_row = int(start_row_match)
-
-            # --- СБОР ВСЕХ ПРАВИЛ ---
-            template_rules = template_data.get('rules', [])
-            cell_mappings = template_data.get('cell_mappings', [])
-            formula_rules = template_data.get('formula_rules', [])
-            static_value_rules = template_data.get('static_value_rules', [])
-            sheet_settings = template_data.get('sheet_settings', [])
-            post_function = template_data.get('post_function', 'none')
-            visible_rows_only = template_data.get('visible_rows_only', False)
-            source_cell_fill_rules = template_data.get('source_cell_fill_rules', [])
-
-        else:
-            # --- РУЧНАЯ НАСТРОЙКА ---
-            if 'template_file' not in request.files:
-                return jsonify({'error': 'Файл-шаблон для ручной настройки не загружен.'})
+        template_file_in_memory, template_filename = None, None
+        if not request.form.get('saved_template') and 'template_file' in request.files:
             template_file = request.files['template_file']
             template_file_in_memory = io.BytesIO(template_file.read())
-            original_template_filename = template_file.filename
-
-            template_range_start_str = request.form.get('template_range_start', 'A1')
-            if template_range_start_str:
-                start_row_match = "".join(filter(str.isdigit, template_range_start_str))
-                if start_row_match:
-                    start_row = int(start_row_match)
-
-        ranges_settings = {'t_start_row': start_row}
-        task_id = str(uuid.uuid4())
-
-        # --- DEBUG PRINT 1 ---
-        print(f"--- DEBUG [main.py]: Задача {task_id} создана ---")
-
-        task_statuses[task_id] = {
-            'status': 'Задача поставлена в очередь...',
-            'progress': 0,
-            'owner_id': current_user.id
-        }
-
-        # --- ИЗМЕНЕНИЕ: ПОЛУЧАЕМ РЕАЛЬНЫЙ ЭКЗЕМПЛЯР 'app' ---
-        app_instance = current_app._get_current_object()
-        # --- КОНЕЦ ИЗМЕНЕНИЯ ---
-
-        # --- DEBUG PRINT 2 (ИЗМЕНЕНО) ---
-        print(f"--- DEBUG [main.py]: Вызываю socketio.start_background_task для {task_id} ---")
-
-        # --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: ПЕРЕДАЕМ 'app_instance' ---
-        socketio.start_background_task(
-            process_excel_hybrid,
-            app_instance,  # <--- ПЕРВЫЙ АРГУМЕНТ
-            task_id,
-            source_file_in_memory,
-            template_file_in_memory,
-            ranges_settings,
-            sheet_settings,
-            template_rules,
-            post_function,
-            original_template_filename,
-            task_statuses,
-            cell_mappings,
-            formula_rules,
-            static_value_rules,
-            visible_rows_only,
-            source_cell_fill_rules
+            template_filename = template_file.filename
+
+        settings = _collect_task_settings(request.form, template_file_in_memory, template_filename)
+        return jsonify(preview_service.build_preview(source_file.stream, settings, rows,
+                                                     current_app.config['PREVIEW_TIME_BUDGET']))
+
+    except ValueError as e:
+        return jsonify({'error': str(e)})
+    except Exception as e:
+        current_app.logger.critical(f"Критическая ошибка в preview: {e}", exc_info=True)
+        return jsonify({'error': f'Произошла внутренняя ошибка: {e}'})
+
+
+# --- ЗАГРУЗКА БОЛЬШИХ ФАЙЛОВ ПО ЧАСТЯМ ---
+
+def _complete_upload(manifest):
+    """
+    Собирает файл из частей и сразу запускает задачу обработки. Загрузка
+    считается завершенной (assembled) только когда задача создана; при
+    ошибке собранный файл удаляется, а ошибка сохраняется в manifest.
+    """
+    upload_id = manifest['upload_id']
+    if not upload_service.claim_assembly(upload_id):
+        return None  # Сборку уже выполняет другой запрос
+
+    source_path = None
+    try:
+        # Параметры задачи проверяются до сборки файла
+        form = manifest['task_settings']
+        template_file_in_memory = None
+        if manifest.get('template_filename'):
+            with open(upload_service.get_template_path(manifest), 'rb') as tf:
+                template_file_in_memory = io.BytesIO(tf.read())
+        settings = _collect_task_settings(form, template_file_in_memory, manifest.get('template_filename'))
+        source_path, sha256 = upload_service.assemble_upload(upload_id)
+        task_id = _start_processing_task(source_path, settings)
+    except Exception as e:
+        # Файл, еще не перемещенный в папку задачи, больше не нужен
+        if source_path and os.path.exists(source_path):
+            os.remove(source_path)
+        error = str(e) if isinstance(e, ValueError) else f'Произошла внутренняя ошибка: {e}'
+        upload_service.fail_upload(upload_id, error)
+        raise
+
+    upload_service.finish_upload(upload_id, task_id, sha256)
+    return task_id
+
+
+def _upload_state(manifest, received):
+    state = {
+        'upload_id': manifest['upload_id'],
+        'chunk_size': manifest['chunk_size'],
+        'total_chunks': manifest['total_chunks'],
+        'received': received,
+        'complete': bool(manifest.get('assembled')),
+        'task_id': manifest.get('task_id')
+    }
+    if manifest.get('error'):
+        # Последняя попытка запустить задачу не удалась (см. _complete_upload)
+        state['error'] = manifest['error']
+    return state
+
+
+def _get_own_upload(upload_id):
+    manifest, received = upload_service.get_upload(upload_id)
+    if manifest is None:
+        return None, None
+    if manifest['owner_id'] != current_user.id:
+        current_app.logger.warning(f"Пользователь {current_user.id} обратился к чужой загрузке {upload_id}")
+        return None, None
+    return manifest, received
+
+
+@main_bp.route('/upload/init', methods=['POST'])
+@login_required
+def upload_init():
+    """
+    Начинает загрузку файла-источника по частям.
+    Форма та же, что и для /process, но вместо source_file передаются
+    filename, size и (необязательно) sha256 всего файла.
+    """
+    try:
+        template_filename = None
+        template_file = None
+        if not request.form.get('saved_template'):
+            template_file = request.files.get('template_file')
+            if not template_file or not template_file.filename:
+                return jsonify({'error': 'Файл-шаблон для ручной настройки не загружен.'})
+            template_filename = template_file.filename
+
+        task_form = {key: request.form.get(key) for key in ('saved_template', 'template_range_start', 'incremental')
+                     if request.form.get(key)}
+        manifest = upload_service.create_upload(
+            current_user.id,
+            request.form.get('filename'),
+            request.form.get('size'),
+            sha256=request.form.get('sha256'),
+            task_settings=task_form,
+            template_filename=template_filename
         )
-        # --- КОНЕЦ КЛЮЧЕВОГО ИЗМЕНЕНИЯ ---
+        if template_file:
+            template_file.save(upload_service.get_template_path(manifest))
 
-        # --- DEBUG PRINT 3 (ИЗМЕНЕНО) ---
-        print(
-            f"--- DEBUG [main.py]: socketio.start_background_task для {task_id} ВЫЗВАН (HTTP 200 будет отправлен) ---")
+        return jsonify(_upload_state(manifest, []))
+
+    except ValueError as e:
+        return jsonify({'error': str(e)})
+
+
+@main_bp.route('/upload/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Состояние загрузки: какие части уже получены (для возобновления)."""
+    manifest, received = _get_own_upload(upload_id)
+    if manifest is None:
+        return jsonify({'error': 'Загрузка не найдена.'}), 404
+    return jsonify(_upload_state(manifest, received))
 
-        return jsonify({'task_id': task_id})
 
+@main_bp.route('/upload/<upload_id>/chunk/<int:index>', methods=['PUT', 'POST'])
+@login_required
+def upload_chunk(upload_id, index):
+    """
+    Принимает одну часть файла (тело запроса - сырые байты).
+    Заголовок X-Chunk-SHA256 (необязательный) - контрольная сумма части.
+    После получения последней части задача обработки запускается автоматически.
+    """
+    manifest, _ = _get_own_upload(upload_id)
+    if manifest is None:
+        return jsonify({'error': 'Загрузка не найдена.'}), 404
+
+    try:
+        if not manifest.get('assembled'):
+            manifest, received = upload_service.save_chunk(
+                upload_id, index, request.get_data(cache=False), request.headers.get('X-Chunk-SHA256'))
+            if len(received) == manifest['total_chunks']:
+                task_id = _complete_upload(manifest)
+                manifest, received = upload_service.get_upload(upload_id)
+                if task_id:
+                    manifest['task_id'] = task_id
+            return jsonify(_upload_state(manifest, received))
+        return jsonify(_upload_state(manifest, []))
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        # --- DEBUG PRINT 4 ---
-        print(f"--- DEBUG [main.py]: КРИТИЧЕСКАЯ ОШИБКА в process_files: {e} ---")
-        current_app.logger.critical(f"Критическая ошибка в process_files: {e}", exc_info=True)
-        return jsonify({'error': f'Произошла внутренняя ошибка: {e}'})
+        current_app.logger.critical(f"Критическая ошибка в upload_chunk: {e}", exc_info=True)
+        return jsonify({'error': f'Произошла внутренняя ошибка: {e}'}), 500
 
 
 @main_bp.route('/status/<task_id>')
@@ -222,33 +435,73 @@ def task_status(task_id):
     if task.get('owner_id') != current_user.id and current_user.role != 'admin':
         return jsonify({'status': 'Доступ к задаче запрещен.'})
 
-    response_data = {k: v for k, v in task.items() if k != 'result_file'}
-    response_data['result_ready'] = 'result_file' in task and task['result_file'] is not None
+    response_data = dict(task)
+    response_data['result_ready'] = bool(task.get('result_ready'))
     return jsonify(response_data)
 
 
+@main_bp.route('/cancel/<task_id>', methods=['POST'])
+@login_required
+def cancel_task(task_id):
+    """Отменяет задачу: из очереди - сразу, выполняющуюся - между блоками строк."""
+    task = task_statuses.get(task_id)
+    if not task:
+        return jsonify({'error': 'Задача не найдена.'}), 404
+
+    if task.get('owner_id') != current_user.id and current_user.role != 'admin':
+        current_app.logger.warning(f"Пользователь {current_user.id} пытался отменить чужую задачу {task_id}")
+        return jsonify({'error': 'Доступ к задаче запрещен.'}), 403
+
+    status = job_worker.cancel_job(current_app._get_current_object(), task_id)
+    if status is None:
+        return jsonify({'error': 'Задача уже завершена.'}), 409
+    return jsonify({'task_id': task_id, 'status': status})
+
+
 @main_bp.route('/download/<task_id>')
 @login_required
 def download_file(task_id):
     """Отдает готовый файл для скачивания."""
     task = task_statuses.get(task_id)
 
-    if not task or 'result_file' not in task or not task['result_file']:
+    if not task or not task.get('result_ready'):
         return "Файл не найден или еще не готов.", 404
 
     if task.get('owner_id') != current_user.id and current_user.role != 'admin':
         current_app.logger.warning(f"Пользователь {current_user.id} пытался скачать чужой файл {task_id}")
         return "Доступ к файлу запрещен.", 403
 
-    result_file_obj = task['result_file']
-    result_file_obj.seek(0)
+    result_file_obj = task_statuses.open_result(task_id)
+    if result_file_obj is None:
+        return "Файл не найден или еще не готов.", 404
 
     template_filename = task.get('template_filename', 'template.xlsx')
     download_name = f"processed_{task_id[:8]}_{template_filename}"
 
     return send_file(
-        io.BytesIO(result_file_obj.read()),
+        result_file_obj,
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
         as_attachment=True,
         download_name=download_name
-    )
\ No newline at end of file
+    )
+
+
+@main_bp.route('/download_warnings/<task_id>')
+@login_required
+def download_warnings(task_id):
+    """Отдает полный отчет о замечаниях задачи (CSV, см. services/warning_report.py)."""
+    task = task_statuses.get(task_id)
+
+    if not task or not task.get('warnings_report'):
+        return "Отчет не найден.", 404
+
+    if task.get('owner_id') != current_user.id and current_user.role != 'admin':
+        current_app.logger.warning(f"Пользователь {current_user.id} пытался скачать чужой отчет {task_id}")
+        return "Доступ к отчету запрещен.", 403
+
+    report_path = warning_report.report_path(task_id)
+    if not os.path.exists(report_path):
+        return "Отчет не найден.", 404
+
+    return send_file(report_path, mimetype='text/csv', as_attachment=True,
+                     download_name=f"warnings_{task_id[:8]}.csv")
\ No newline at end of file
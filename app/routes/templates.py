@@ -1,11 +1,11 @@
 # app/routes/templates.py
 import os
-import glob
 import json
 import uuid
 from flask import (Blueprint, render_template, request, flash, redirect,
                    url_for, current_app, send_from_directory)
 from werkzeug.utils import secure_filename
+from app.services import template_plans
 from app.utils.helpers import allowed_file
 from flask_login import login_required, current_user
 
@@ -17,16 +17,13 @@ def _check_template_access(template_id):
     Вспомогательная функция для проверки доступа к шаблону.
     Возвращает (template_data, has_access)
     """
-    json_path = os.path.join(current_app.config['TEMPLATES_DB_FOLDER'], f"{secure_filename(template_id)}.json")
-    if not os.path.exists(json_path):
-        return None, False  # Шаблон не найден
-
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            template_data = json.load(f)
+        template_data = template_plans.get(template_id)
     except Exception as e:
         current_app.logger.error(f"Ошибка чтения файла шаблона {template_id}: {e}")
         return None, False  # Ошибка чтения файла
+    if template_data is None:
+        return None, False  # Шаблон не найден
 
     owner_id = template_data.get('owner_id')
 
@@ -44,25 +41,17 @@ def _check_template_access(template_id):
 @login_required
 def list():
     """Отображает список шаблонов, доступных пользователю."""
-    template_files = glob.glob(os.path.join(current_app.config['TEMPLATES_DB_FOLDER'], '*.json'))
     templates_data = []
+    is_admin = current_user.role == 'admin'
 
-    for f in template_files:
-        try:
-            with open(f, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-                data['id'] = os.path.basename(f).replace('.json', '')
-
-                owner_id = data.get('owner_id')
-                is_admin = current_user.role == 'admin'
-                is_owner = (owner_id == current_user.id)
-                is_public = (owner_id is None)  # Шаблон без владельца = public
-
-                # Показываем, если: админ, ИЛИ владелец, ИЛИ шаблон публичный
-                if is_admin or is_owner or is_public:
-                    templates_data.append(data)
-        except Exception as e:
-            current_app.logger.error(f"Ошибка чтения шаблона {f}: {e}")
+    for template_id, template in template_plans.all_templates():
+        owner_id = template.get('owner_id')
+        is_owner = (owner_id == current_user.id)
+        is_public = (owner_id is None)  # Шаблон без владельца = public
+
+        # Показываем, если: админ, ИЛИ владелец, ИЛИ шаблон публичный
+        if is_admin or is_owner or is_public:
+            templates_data.append(dict(template, id=template_id))
 
     # Сортировка для админа: сначала свои, потом остальные
     if current_user.role == 'admin':
@@ -229,6 +218,7 @@ def create():
         with open(os.path.join(current_app.config['TEMPLATES_DB_FOLDER'], f"{template_id}.json"), 'w',
                   encoding='utf-8') as f:
             json.dump(template_data, f, ensure_ascii=False, indent=4)
+        template_plans.forget(template_id)
 
         flash(f"Шаблон '{template_name}' успешно создан!", "success")
         return redirect(url_for('templates.list'))
@@ -291,6 +281,7 @@ def edit(template_id):
             # Сохраняем обновленный JSON
             with open(json_path, 'w', encoding='utf-8') as f:
                 json.dump(template_data, f, ensure_ascii=False, indent=4)
+            template_plans.forget(template_id)
             flash("Шаблон успешно обновлен!", "success")
             return redirect(url_for('templates.list'))
 
@@ -353,6 +344,7 @@ def delete(template_id):
 
         # Удаляем JSON-файл
         os.remove(json_path)
+        template_plans.forget(template_id)
         flash("Шаблон успешно удален.", "success")
 
     except Exception as e:
@@ -1,56 +1,144 @@
 # app/services/excel_processor.py
+import hashlib
 import io
 import re
-import traceback
+import tempfile
+import time
+import logging
+from array import array
 from collections import defaultdict
 from openpyxl import load_workbook
 from openpyxl.utils import column_index_from_string
 from asteval import Interpreter
 
 # Импорт сервисов из приложения
-from app.services.geocoding_service import apply_post_processing
-from app.utils.helpers import get_col_from_cell
-from app.services import logging_service
+from app.services.geocoding_service import GeocodingPostProcessor
+from app.services.output_writer import StreamingWorkbookWriter
+from app.services.source_cache import SourceSheetData
+from app.services.source_loader import load_source_workbook
+from app.services.task_metrics import StageTimer, file_size
+from app.services.warning_report import WarningCollector
+from app.utils.helpers import get_col_from_cell, get_data_extent, iter_row_values
+from app.services import incremental_service, logging_service, metrics_service, warning_report
 # --- ИМПОРТИРУЕМ ГЛОБАЛЬНЫЙ 'socketio' ---
 from app.extensions import task_statuses, db, socketio
 
+from app.utils.log import TaskLogContext
+
 # --- УБИРАЕМ 'create_app' ОТСЮДА ---
 # (app.py его уже создал, мы его импортируем через socketio)
 
+logger = logging.getLogger(__name__)
+
+# Статус задачи, отмененной пользователем (см. /cancel/<task_id>)
+CANCELLED_STATUS = 'Отменено пользователем'
+
+
+class TaskCancelled(Exception):
+    """Задача отменена: обработка останавливается на ближайшей границе блока строк."""
+
+
+def _check_cancelled(cancel_check):
+    if cancel_check is not None and cancel_check():
+        raise TaskCancelled()
+
+
 # --- НОВЫЙ ВЫЧИСЛИТЕЛЬ ФОРМУЛ ---
 _aeval = Interpreter()
 
 
-def _evaluate_formula(formula_str, source_row_idx, source_ws, warnings_list):
-    # ... (эта функция остается без изменений) ...
-    if not isinstance(formula_str, str) or not formula_str.startswith('='):
-        return formula_str
-    expression = formula_str[1:].strip()
+_FORMULA_VARIABLE_RE = re.compile(r'([A-Z]+\d*\{row\}?\d*)', re.IGNORECASE)
+_ROW_VARIABLE_RE = re.compile(r'([A-Z]+)\{row\}', re.IGNORECASE)
+
+
+class _CompiledFormula:
+    """
+    Формула правила, разобранная один раз (а не на каждой строке):
+    список переменных с готовыми регулярными выражениями для подстановки.
+    Для переменных вида A{row} сразу вычисляется номер колонки - их значения
+    читаются из колоночного кэша источника.
+    """
+
+    def __init__(self, formula_str):
+        self.formula_str = formula_str
+        self.is_formula = isinstance(formula_str, str) and formula_str.startswith('=')
+        self.expression = formula_str[1:].strip() if self.is_formula else None
+        self.variables = []
+        if self.is_formula:
+            # Без повторов, в порядке появления в формуле: при нескольких нечисловых
+            # ссылках в "#VALUE!" всегда попадает первая (порядок множества зависел
+            # от PYTHONHASHSEED)
+            for var in dict.fromkeys(_FORMULA_VARIABLE_RE.findall(self.expression)):
+                match = _ROW_VARIABLE_RE.fullmatch(var)
+                col_idx = column_index_from_string(match.group(1).upper()) if match else None
+                self.variables.append((var, re.compile(r'(?i)' + re.escape(var)), col_idx))
+
+    @property
+    def row_columns(self):
+        """Колонки источника, которые формула читает построчно."""
+        return {col_idx for _, _, col_idx in self.variables if col_idx}
+
+
+# Разобранные формулы общие для всех задач процесса: формулы сохраненных
+# шаблонов разбираются один раз (и в режиме pre-fork - до fork, см.
+# services/template_plans.py). Размер ограничен: формулы ручной настройки
+# произвольные
+_compiled_formulas = {}
+_COMPILED_FORMULAS_MAX = 1024
+
+
+def compile_formula(formula_str):
+    """_CompiledFormula для строки формулы (из кэша процесса)."""
+    try:
+        return _compiled_formulas[formula_str]
+    except KeyError:
+        pass
+    except TypeError:  # Нехешируемое значение из JSON правил
+        return _CompiledFormula(formula_str)
+    formula = _CompiledFormula(formula_str)
+    if len(_compiled_formulas) >= _COMPILED_FORMULAS_MAX:
+        _compiled_formulas.pop(next(iter(_compiled_formulas)), None)
+    _compiled_formulas[formula_str] = formula
+    return formula
+
+
+def _evaluate_formula(formula, source_row_idx, source_data, warnings):
+    """
+    Вычисляет _CompiledFormula для строки источника (source_data - SourceSheetData).
+    Ошибки добавляются в warnings (WarningCollector, services/warning_report.py).
+    """
+    if not formula.is_formula:
+        return formula.formula_str
+    expression = formula.expression
     try:
-        variables = set(re.findall(r'([A-Z]+\d*\{row\}?\d*)', expression, re.IGNORECASE))
-        for var in variables:
+        for var, var_pattern, col_idx in formula.variables:
             cell_ref = var.format(row=source_row_idx)
             try:
-                cell_value = source_ws[cell_ref].value
+                if col_idx:
+                    cell_value = source_data.value(source_row_idx, col_idx)
+                else:
+                    cell_value = source_data.cell_value(cell_ref)
                 numeric_value = float(cell_value)
-                expression = re.sub(r'(?i)' + re.escape(var), str(numeric_value), expression)
+                expression = var_pattern.sub(str(numeric_value), expression)
             except (ValueError, TypeError, AttributeError, TypeError):
-                error_msg = f"Ошибка в формуле (ячейка {cell_ref}): Не удалось получить число (значение: '{cell_value}')"
-                print(f"Ошибка в _evaluate_formula: {error_msg}")
-                if warnings_list is not None:
-                    warnings_list.append(error_msg)
+                logger.debug("Ошибка в _evaluate_formula: ячейка %s, значение %r", cell_ref, cell_value)
+                if warnings is not None:
+                    warnings.add(f"Формула {formula.formula_str}", "не удалось получить число", cell_ref,
+                                 f"значение: '{cell_value}'")
                 return f'#VALUE! (ссылка: {cell_ref})'
-        _aeval.eval(expression)
+        result = _aeval.eval(expression)
         if _aeval.error:
             error_msg = _aeval.error_msg
             _aeval.error = None
-            print(f"Ошибка asteval: {error_msg}")
-            if warnings_list is not None:
-                warnings_list.append(f"Ошибка вычисления ({formula_str[1:]}): {error_msg}")
+            logger.debug("Ошибка asteval: %s", error_msg)
+            if warnings is not None:
+                warnings.add(f"Формула {formula.formula_str}",
+                             f"ошибка вычисления: {error_msg}" if error_msg else "ошибка вычисления",
+                             details=f"строка источника {source_row_idx}")
             return '#NUM!'
-        return _aeval.result
+        return result
     except Exception as e:
-        print(f"Критическая ошибка в _evaluate_formula: {e}")
+        logger.warning("Критическая ошибка в _evaluate_formula: %s", e)
         return '#ERROR!'
 
 
@@ -67,58 +155,41 @@ def get_sheet_settings_map(sheet_settings):
     return settings_map
 
 
-# --- Функции применения правил (без изменений) ---
-def _apply_static_value_rules(template_wb, static_value_rules, t_start_row, task_id):
-    # ... (без изменений) ...
-    if not static_value_rules: return
-    rules_by_sheet = defaultdict(list)
-    for rule in static_value_rules:
-        rules_by_sheet[rule.get('target_sheet', template_wb.sheetnames[0])].append(rule)
-    for sheet_name, sheet_rules in rules_by_sheet.items():
-        try:
-            ws = template_wb[sheet_name]
-            max_row = ws.max_row
-            if max_row < t_start_row + 1: continue
-            for rule in sheet_rules:
-                t_col_idx = column_index_from_string(rule['target_col'])
-                value_to_insert = rule['value']
-                for row_idx in range(t_start_row + 1, max_row + 1):
-                    ws.cell(row=row_idx, column=t_col_idx).value = value_to_insert
-        except KeyError:
-            print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' для статичного значения не найден.")
-        except Exception as e:
-            print(f"[{task_id}] ОШИБКА: Ошибка применения статичного значения: {e}")
-
-
-def _apply_formula_rules(source_wb, template_wb, formula_rules, sheet_settings_map, t_start_row, task_id,
-                         warnings_list):
-    # ... (без изменений) ...
-    if not formula_rules: return
-    rules_by_target_sheet = defaultdict(list)
-    for rule in formula_rules:
-        rules_by_target_sheet[rule.get('target_sheet', template_wb.sheetnames[0])].append(rule)
-    for target_sheet_name, sheet_rules in rules_by_target_sheet.items():
-        try:
-            template_ws = template_wb[target_sheet_name]
-            max_row = template_ws.max_row
-            if max_row < t_start_row + 1: continue
-            for t_row_idx in range(t_start_row + 1, max_row + 1):
-                for rule in sheet_rules:
-                    source_sheet_name = rule['source_sheet']
-                    s_start_row = sheet_settings_map.get(source_sheet_name)
-                    if s_start_row is None: continue
-                    source_ws = source_wb[source_sheet_name]
-                    source_row_idx = s_start_row + (t_row_idx - (t_start_row + 1))
-                    formula_template = rule['formula']
-                    t_col_idx = column_index_from_string(rule['target_col'])
-                    calculated_value = _evaluate_formula(formula_template, source_row_idx, source_ws, warnings_list)
-                    template_ws.cell(row=t_row_idx, column=t_col_idx).value = calculated_value
-        except KeyError as e:
-            print(f"[{task_id}] ВНИМАНИЕ: Лист '{e.args[0]}' не найден при обработке формул.")
-        except Exception as e:
-            print(f"[{task_id}] ОШИБКА: Ошибка применения формулы: {e}")
-
-
+def _get_visible_rows(visible_rows_cache, source_ws, s_start_row, s_end_row):
+    """
+    Индекс видимых строк данных листа-источника (компактный array номеров строк).
+    Строится один раз на лист за проход по уже существующим row_dimensions
+    (обращение source_ws.row_dimensions[r] создает объект на каждую строку)
+    и затем используется всеми правилами колонок и формул.
+    s_end_row - последняя строка с данными (см. get_data_extent).
+    """
+    key = (source_ws.title, s_start_row)
+    visible_rows = visible_rows_cache.get(key)
+    if visible_rows is None:
+        hidden_rows = {r_idx for r_idx, dim in source_ws.row_dimensions.items() if dim.hidden}
+        visible_rows = array('I', (r_idx for r_idx in range(s_start_row + 1, s_end_row + 1)
+                                   if r_idx not in hidden_rows))
+        visible_rows_cache[key] = visible_rows
+    return visible_rows
+
+
+def _source_row_for_target(t_offset, s_start_row, visible_rows):
+    """
+    Номер строки источника для смещения t_offset от начала данных шаблона.
+    Первой строке данных шаблона соответствует строка после заголовка
+    источника (s_start_row + 1) - та же, что копируют правила колонок.
+    С visible_rows_only строки шаблона соответствуют только видимым строкам источника.
+    """
+    if visible_rows is None:
+        return s_start_row + 1 + t_offset
+    if t_offset < len(visible_rows):
+        return visible_rows[t_offset]
+    # За пределами данных: строка заведомо пустая, как и без фильтра
+    last_row = visible_rows[-1] if visible_rows else s_start_row
+    return last_row + 1 + (t_offset - len(visible_rows))
+
+
+# --- Функции применения правил ---
 def _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id):
     # ... (без изменений) ...
     if not cell_mappings: return
@@ -130,7 +201,7 @@ def _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id):
         try:
             source_ws = source_wb[sheet_name]
         except KeyError:
-            print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' для копирования ячеек не найден.")
+            logger.warning("Лист '%s' для копирования ячеек не найден.", sheet_name)
             continue
         for mapping in sheet_mappings:
             try:
@@ -141,99 +212,507 @@ def _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id):
                     dest_cell.hyperlink = source_cell.hyperlink.target
                     dest_cell.style = "Hyperlink"
             except Exception as e:
-                print(
-                    f"[{task_id}] ОШИБКА: Ошибка при копировании ячейки {mapping['source_cell']} -> {mapping['dest_cell']}: {e}")
-
-
-def _apply_source_cell_fill_rules(source_wb, template_wb, source_cell_fill_rules, t_start_row, task_id):
-    # ... (без изменений) ...
-    if not source_cell_fill_rules: return
+                logger.error("Ошибка при копировании ячейки %s -> %s: %s",
+                             mapping['source_cell'], mapping['dest_cell'], e)
+
+
+# --- План выполнения: все типы правил за один проход по строкам шаблона ---
+#
+# Раньше каждый тип правил (заполнение из ячейки, колонки, статичные значения,
+# формулы, геокодинг) отдельно проходил по всем строкам шаблона. Теперь для
+# каждого листа шаблона строится список операций, и каждая строка заполняется
+# за один проход. Операции строки выполняются в том же порядке, в котором раньше
+# шли этапы, а границы строк каждой операции вычисляются заранее по последней
+# строке с данными на соответствующем этапе (ячейки только с форматированием
+# не в счет - см. get_data_extent).
+
+class _RowOp:
+    """Операция заполнения одной колонки шаблона в строках t_first_row..last_row."""
+    __slots__ = ('last_row', 'apply', 'description')
+
+    def __init__(self, last_row, apply, description):
+        self.last_row = last_row
+        self.apply = apply
+        self.description = description
+
+
+class _SheetPlan:
+    """Все операции для одного листа шаблона в порядке бывших этапов."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.fill_ops = []
+        self.column_ops = []
+        self.static_ops = []
+        self.formula_ops = []
+        self.post_ops = []
+
+    @property
+    def ops(self):
+        return self.fill_ops + self.column_ops + self.static_ops + self.formula_ops + self.post_ops
+
+    @property
+    def stage_groups(self):
+        """Непустые группы операций с именами этапов (для замера времени этапов)."""
+        groups = [('source_cell_fill', self.fill_ops), ('columns', self.column_ops), ('static', self.static_ops),
+                  ('formulas', self.formula_ops), ('geocoding', self.post_ops)]
+        return [(stage, ops) for stage, ops in groups if ops]
+
+    @property
+    def last_row(self):
+        return max((op.last_row for op in self.ops), default=0)
+
+
+def _constant_op(col_idx, value):
+    def apply(t_row_idx, t_offset, values, links):
+        values[col_idx] = value
+    return apply
+
+
+def _column_op(source_data, s_col_idx, t_col_idx, source_rows):
+    def apply(t_row_idx, t_offset, values, links):
+        value, has_link, link_target = source_data.value_and_link(source_rows[t_offset], s_col_idx)
+        values[t_col_idx] = value
+        if has_link:
+            links[t_col_idx] = link_target
+    return apply
+
+
+def _formula_op(source_data, formula, t_col_idx, s_start_row, visible_rows, warnings):
+    def apply(t_row_idx, t_offset, values, links):
+        source_row_idx = _source_row_for_target(t_offset, s_start_row, visible_rows)
+        values[t_col_idx] = _evaluate_formula(formula, source_row_idx, source_data, warnings)
+    return apply
+
+
+def _get_sheet_plan(plans, template_wb, sheet_name):
+    plan = plans.get(sheet_name)
+    if plan is None:
+        plan = plans[sheet_name] = _SheetPlan(template_wb[sheet_name])
+    return plan
+
+
+def _rule_source_column(rule):
+    """Буква колонки источника в правиле колонок (или None)."""
+    return rule.get('s_col') or get_col_from_cell(rule.get('source_cell'))
+
+
+def _collect_source_columns(source_wb, template_rules, compiled_formulas):
+    """
+    Колонки каждого листа-источника, которые читаются построчно:
+    только их имеет смысл держать в колоночном кэше.
+    """
+    columns_by_sheet = defaultdict(set)
+    for rule in template_rules:
+        s_col_letter = _rule_source_column(rule)
+        if s_col_letter:
+            sheet_name = rule.get('source_sheet', source_wb.sheetnames[0])
+            columns_by_sheet[sheet_name].add(column_index_from_string(s_col_letter))
+    for rule, formula in compiled_formulas:
+        columns_by_sheet[rule.get('source_sheet')] |= formula.row_columns
+    return columns_by_sheet
+
+
+def _sheet_digests(source_ws, last_rows, include_hidden):
+    """
+    SHA-256 значений листа, накопленный построчно: {строка: hexdigest строк 1..строка}
+    для каждой строки из last_rows. В отпечаток строки входят только непустые ячейки
+    (с номером колонки), поэтому новые колонки в новых строках не меняют отпечаток
+    прежних; include_hidden - учитывать и скрытость строк.
+    """
+    hidden_rows = set()
+    if include_hidden:
+        hidden_rows = {r_idx for r_idx, dim in source_ws.row_dimensions.items() if dim.hidden}
+    digest = hashlib.sha256()
+    digests = {0: digest.hexdigest()}
+    targets = set(last_rows)
+    for r_idx, row in iter_row_values(source_ws, max(targets, default=0)):
+        digest.update(repr(row).encode('utf-8'))
+        if r_idx in hidden_rows:
+            digest.update(b'hidden')
+        if r_idx in targets:
+            digests[r_idx] = digest.hexdigest()
+    return digests
+
+
+class _SourceWatermark:
+    """
+    Водяной знак источника для инкрементального режима (services/incremental_service.py).
+
+    rows - число строк данных, которые источник дает в результате (как при
+    полном прогоне). Для листов, которые читаются построчно (правила колонок
+    и формулы), last_row - последняя строка источника, попадающая в эти rows
+    строк результата (с visible_rows_only - с учетом скрытых строк), для
+    листов правил колонок еще и count - число их строк данных. Листы, которые
+    читают только точечные правила (копирование ячеек, заполнение из ячейки),
+    учитываются целиком. Отпечаток листа - _sheet_digests строк 1..last_row.
+    """
+
+    def __init__(self, source_wb, sheet_settings_map, template_rules, formula_rules, cell_mappings,
+                 source_cell_fill_rules, visible_rows_only):
+        self.visible_rows_only = visible_rows_only
+        self.source_wb = source_wb
+        default_sheet = source_wb.sheetnames[0]
+        existing = set(source_wb.sheetnames)
+        compiled_formulas = [(rule, compile_formula(rule.get('formula'))) for rule in formula_rules or []]
+        source_columns = _collect_source_columns(source_wb, template_rules, compiled_formulas)
+        column_sheets = {rule.get('source_sheet', default_sheet) for rule in template_rules
+                         if _rule_source_column(rule) and (rule.get('t_col') or rule.get('template_col'))}
+        formula_sheets = {rule.get('source_sheet') for rule, _ in compiled_formulas
+                          if rule.get('source_sheet') in sheet_settings_map}
+        cell_sheets = {rule.get('source_sheet', default_sheet)
+                       for rule in list(cell_mappings or []) + list(source_cell_fill_rules or [])}
+        row_sheets = (column_sheets | formula_sheets) & existing
+
+        # Последние строки с данными - те же, что посчитает build_execution_plan
+        self.extents = {name: get_data_extent(source_wb[name], source_columns.get(name, ())) for name in row_sheets}
+        self.start_rows = {name: sheet_settings_map.get(name, 1) for name in row_sheets}
+        visible_rows_cache = {}
+
+        def visible_rows(name):
+            if not visible_rows_only:
+                return None
+            return _get_visible_rows(visible_rows_cache, source_wb[name], self.start_rows[name], self.extents[name])
+
+        self.counts = {}
+        for name in column_sheets & existing:
+            s_start_row, s_end_row = self.start_rows[name], self.extents[name]
+            if s_end_row - s_start_row <= 0:
+                self.counts[name] = 0
+            else:
+                rows = visible_rows(name)
+                self.counts[name] = len(rows) if rows is not None else s_end_row - s_start_row
+        self.rows = max(self.counts.values(), default=0)
+
+        self.last_rows = {}
+        for name in row_sheets:
+            s_start_row = self.start_rows[name]
+            self.last_rows[name] = (_source_row_for_target(self.rows - 1, s_start_row, visible_rows(name))
+                                    if self.rows else s_start_row)
+        for name in (cell_sheets & existing) - row_sheets:
+            self.last_rows[name] = get_data_extent(source_wb[name])
+        self.digests = {}
+
+    @property
+    def signature(self):
+        """Подпись линии источника: листы, их заголовки и первая строка данных."""
+        signature = []
+        for name in sorted(self.last_rows):
+            header_row = self.start_rows.get(name)
+            if header_row is None:
+                signature.append([name])
+                continue
+            rows = iter_row_values(self.source_wb[name], header_row + 1)
+            signature.append([name, repr([row for _, row in rows])])
+        return signature
+
+    def resume_from(self, previous):
+        """
+        Считает отпечатки листов и сравнивает их с состоянием предыдущего
+        прогона. Возвращает число строк результата previous, которые можно
+        оставить как есть (дописать только новые), или None - нужен полный прогон.
+        """
+        previous_sheets = (previous or {}).get('sheets', {})
+        for name, last_row in self.last_rows.items():
+            targets = {last_row}
+            if name in previous_sheets:
+                targets.add(previous_sheets[name]['last_row'])
+            digests = _sheet_digests(self.source_wb[name], targets, self.visible_rows_only)
+            self.digests[name] = digests
+
+        if previous is None:
+            return None
+        previous_rows = previous.get('rows', 0)
+        if previous_rows <= 0 or self.rows < previous_rows or set(previous_sheets) != set(self.last_rows):
+            return None
+        # Строки листов правил колонок лежат в результате рядом: дописывать можно,
+        # только если их было поровну (иначе новые строки короткого листа
+        # встали бы не туда, где их поставил бы полный прогон)
+        previous_counts = {name: sheet.get('count') for name, sheet in previous_sheets.items()
+                           if sheet.get('count') is not None}
+        if set(previous_counts) != set(self.counts) or any(c != previous_rows for c in previous_counts.values()):
+            return None
+        for name, sheet in previous_sheets.items():
+            last_row = sheet['last_row']
+            if name not in self.start_rows and last_row != self.last_rows[name]:
+                return None
+            if last_row > self.last_rows[name] or self.digests[name].get(last_row) != sheet['digest']:
+                logger.info("Лист '%s' источника изменился до строки %s, нужен полный прогон", name, last_row)
+                return None
+        return previous_rows
+
+    def resumed_sheet_settings(self, sheet_settings_map, previous):
+        """Начальные строки листов для дописывания: данные начинаются после водяного знака."""
+        resumed = dict(sheet_settings_map)
+        for name in self.start_rows:
+            resumed[name] = previous['sheets'][name]['last_row']
+        return resumed
+
+    def as_state(self):
+        """Водяной знак для сохранения (incremental_service.save)."""
+        return {
+            'rows': self.rows,
+            'sheets': {name: {'last_row': last_row, 'count': self.counts.get(name),
+                              'digest': self.digests[name][last_row]}
+                       for name, last_row in self.last_rows.items()}
+        }
+
+
+def build_execution_plan(source_wb, template_wb, template_ws, t_start_row, template_rules, sheet_settings_map,
+                         source_cell_fill_rules, static_value_rules, formula_rules, visible_rows_only,
+                         task_id, warnings, post_processor=None, use_column_cache=True, timer=None,
+                         append_after=0, source_extents=None):
+    """
+    Компилирует все правила в планы по листам шаблона: {имя листа: _SheetPlan}.
+    Ошибки отдельных правил (нет листа, неверная ячейка) выводятся и правило пропускается.
+    use_column_cache - читать колонки источника через колоночный кэш (SourceSheetData).
+    timer - StageTimer: в счетчик 'source_rows' добавляется число строк данных листов-источников.
+    append_after - число строк данных, уже заполненных в шаблоне (инкрементальный
+    режим): строки заполняются начиная со следующей, заголовки остаются в t_start_row.
+    source_extents - уже посчитанные последние строки листов-источников {имя: строка}.
+
+    Границы строк берутся по фактическим данным (get_data_extent), а не по max_row:
+    строки, в которых есть только форматирование, не обрабатываются.
+    """
+    t_first_row = t_start_row + 1 + append_after
+    plans = {}
+    compiled_formulas = [(rule, compile_formula(rule.get('formula'))) for rule in formula_rules or []]
+    source_columns = _collect_source_columns(source_wb, template_rules, compiled_formulas)
+    source_data_by_sheet = {}
+    source_extents = dict(source_extents or {})
+
+    def get_source_extent(source_ws):
+        # Последняя строка с данными в колонках источника, которые читают правила
+        s_end_row = source_extents.get(source_ws.title)
+        if s_end_row is None:
+            s_end_row = source_extents[source_ws.title] = get_data_extent(
+                source_ws, source_columns.get(source_ws.title, ()))
+        return s_end_row
+
+    def get_source_data(source_ws):
+        # Один SourceSheetData (и один набор извлеченных колонок) на лист для всех правил
+        source_data = source_data_by_sheet.get(source_ws.title)
+        if source_data is None:
+            first_row = sheet_settings_map.get(source_ws.title, 1) + 1
+            source_data = source_data_by_sheet[source_ws.title] = SourceSheetData(
+                source_ws, source_columns.get(source_ws.title, ()), first_row, get_source_extent(source_ws),
+                use_cache=use_column_cache)
+        return source_data
+
+    # Индекс видимых строк: один на лист-источник для всех правил колонок и формул
+    visible_rows_cache = {}
+    # Последняя строка с данными на листах до заполнения строк (после точечного копирования ячеек)
+    base_max_rows = {name: get_data_extent(template_wb[name]) for name in template_wb.sheetnames}
+
+    # 1. Заполнение столбцов из ячейки: строки, существующие в шаблоне до заполнения
     rules_by_source_sheet = defaultdict(list)
-    for rule in source_cell_fill_rules:
+    for rule in source_cell_fill_rules or []:
         rules_by_source_sheet[rule.get('source_sheet', source_wb.sheetnames[0])].append(rule)
     for source_sheet_name, sheet_rules in rules_by_source_sheet.items():
         try:
             source_ws = source_wb[source_sheet_name]
         except KeyError:
-            print(
-                f"[{task_id}] ВНИМАНИЕ: Лист источника '{source_sheet_name}' для правила 'Заполнение из ячейки' не найден.")
+            logger.warning("Лист источника '%s' для правила 'Заполнение из ячейки' не найден.", source_sheet_name)
             continue
         for rule in sheet_rules:
+            source_cell_coord = rule.get('source_cell')
+            target_sheet_name = rule.get('target_sheet', template_wb.sheetnames[0])
             try:
-                source_cell_coord = rule['source_cell']
                 value_to_insert = source_ws[source_cell_coord].value
-                target_sheet_name = rule.get('target_sheet', template_wb.sheetnames[0])
-                target_col = rule['target_col']
-                template_ws = template_wb[target_sheet_name]
-                t_col_idx = column_index_from_string(target_col)
-                max_row = template_ws.max_row
-                if max_row < t_start_row + 1: continue
-                for row_idx in range(t_start_row + 1, max_row + 1):
-                    template_ws.cell(row=row_idx, column=t_col_idx).value = value_to_insert
+                plan = _get_sheet_plan(plans, template_wb, target_sheet_name)
+                t_col_idx = column_index_from_string(rule['target_col'])
+                last_row = base_max_rows[target_sheet_name]
+                if last_row < t_first_row: continue
+                plan.fill_ops.append(_RowOp(last_row, _constant_op(t_col_idx, value_to_insert),
+                                            f"заполнение из ячейки {source_cell_coord}"))
             except KeyError:
-                print(
-                    f"[{task_id}] ОШИБКА: Не найдена ячейка '{source_cell_coord}' (источник) или лист '{target_sheet_name}' (шаблон).")
+                logger.error("Не найдена ячейка '%s' (источник) или лист '%s' (шаблон).",
+                             source_cell_coord, target_sheet_name)
             except Exception as e:
-                print(f"[{task_id}] ОШИБКА: Ошибка применения правила 'Заполнение из ячейки': {e}")
-
+                logger.error("Ошибка применения правила 'Заполнение из ячейки': %s", e)
+
+    # 2. Копирование колонок (на активный лист шаблона)
+    active_plan = _get_sheet_plan(plans, template_wb, template_ws.title)
+    used_template_cols = set()
+    sheets_with_rules = set(r.get('source_sheet', source_wb.sheetnames[0]) for r in template_rules)
+    sheets_to_process = [s for s in source_wb.sheetnames if s in sheets_with_rules]
+    for sheet_name in sheets_to_process:
+        source_ws = source_wb[sheet_name]
+        s_start_row = sheet_settings_map.get(sheet_name, 1)
+        s_end_row = get_source_extent(source_ws)
+        if s_end_row - s_start_row <= 0:
+            logger.debug("Лист '%s' не содержит строк данных (s_start_row: %s, s_end_row: %s).",
+                         sheet_name, s_start_row, s_end_row)
+            continue
+        if visible_rows_only:
+            source_rows = _get_visible_rows(visible_rows_cache, source_ws, s_start_row, s_end_row)
+        else:
+            source_rows = range(s_start_row + 1, s_end_row + 1)
+        if timer is not None:
+            timer.count('source_rows', len(source_rows))
+        used_source_cols = set()
+        for rule in template_rules:
+            if rule.get('source_sheet', source_wb.sheetnames[0]) != sheet_name:
+                continue
+            s_col_letter = _rule_source_column(rule)
+            t_col_letter = rule.get('t_col') or rule.get('template_col')
+            if not s_col_letter or not t_col_letter:
+                continue
+            s_col_idx, t_col_idx = column_index_from_string(s_col_letter), column_index_from_string(t_col_letter)
+            if s_col_idx in used_source_cols or t_col_idx in used_template_cols:
+                logger.debug("Правило пропущено: колонка %s или %s уже используется.", s_col_letter, t_col_letter)
+                continue
+            used_source_cols.add(s_col_idx)
+            used_template_cols.add(t_col_idx)
+            if not source_rows:
+                continue
+            active_plan.column_ops.append(_RowOp(
+                t_first_row + len(source_rows) - 1,
+                _column_op(get_source_data(source_ws), s_col_idx, t_col_idx, source_rows),
+                f"колонка {sheet_name}!{s_col_letter} → {t_col_letter}"))
+
+    # Строки, которые существуют после копирования колонок: до них
+    # заполняются статичные значения, формулы и пост-обработка
+    def filled_max_row(sheet_name):
+        plan = plans.get(sheet_name)
+        return max(base_max_rows[sheet_name], plan.last_row if plan else 0)
+
+    # 3. Статичные значения
+    for rule in static_value_rules or []:
+        sheet_name = rule.get('target_sheet', template_wb.sheetnames[0])
+        try:
+            plan = _get_sheet_plan(plans, template_wb, sheet_name)
+            last_row = filled_max_row(sheet_name)
+            if last_row < t_first_row: continue
+            plan.static_ops.append(_RowOp(last_row, _constant_op(column_index_from_string(rule['target_col']),
+                                                                 rule['value']),
+                                          f"статичное значение в колонку {rule['target_col']}"))
+        except KeyError:
+            logger.warning("Лист '%s' для статичного значения не найден.", sheet_name)
+        except Exception as e:
+            logger.error("Ошибка применения статичного значения: %s", e)
 
-def _apply_manual_rules(source_ws, template_ws, rules, s_start_row, t_start_row, used_source_cols, used_template_cols,
-                        visible_rows_only, task_id,
-                        sheet_name, sheet_base_progress, sheet_progress_weight):
-    # ... (эта функция остается без изменений) ...
-    s_end_row = source_ws.max_row
-    total_rows = s_end_row - s_start_row
+    # 4. Формулы
+    for rule, formula in compiled_formulas:
+        try:
+            target_sheet_name = rule.get('target_sheet', template_wb.sheetnames[0])
+            plan = _get_sheet_plan(plans, template_wb, target_sheet_name)
+            last_row = filled_max_row(target_sheet_name)
+            if last_row < t_first_row: continue
+            source_sheet_name = rule['source_sheet']
+            s_start_row = sheet_settings_map.get(source_sheet_name)
+            if s_start_row is None: continue
+            source_ws = source_wb[source_sheet_name]
+            visible_rows = None
+            if visible_rows_only:
+                visible_rows = _get_visible_rows(visible_rows_cache, source_ws, s_start_row,
+                                                 get_source_extent(source_ws))
+            plan.formula_ops.append(_RowOp(
+                last_row,
+                _formula_op(get_source_data(source_ws), formula, column_index_from_string(rule['target_col']),
+                            s_start_row, visible_rows, warnings),
+                f"формула {rule['formula']}"))
+        except KeyError as e:
+            logger.warning("Лист '%s' не найден при обработке формул.", e.args[0])
+        except Exception as e:
+            logger.error("Ошибка применения формулы: %s", e)
+
+    # 5. Пост-обработка (геокодинг) - всегда на активном листе
+    if post_processor is not None and post_processor.prepare(template_ws, t_start_row):
+        last_row = filled_max_row(template_ws.title)
+        if last_row >= t_first_row:
+            active_plan.post_ops.append(_RowOp(last_row, post_processor.process_row, "пост-обработка"))
+
+    return {name: plan for name, plan in plans.items() if plan.ops}
+
+
+def execute_plan(plans, t_start_row, task_id, base_progress=20, progress_weight=70, timer=None,
+                 cancel_check=None, append_after=0, output=None):
+    """
+    Заполняет все строки шаблона за один проход. Значения строки собираются
+    в буфер (values/links) и записываются в лист один раз, когда все
+    операции строки выполнены.
+    timer - StageTimer: время суммируется по группам операций (этапам)
+    и отдельно по записи строк в лист ('write').
+    cancel_check() проверяется после каждого блока строк (вместе с отправкой
+    прогресса); если он вернул True, выбрасывается TaskCancelled.
+    append_after - см. build_execution_plan.
+    output - StreamingWorkbookWriter (services/output_writer.py): строки
+    записываются не в ячейки листа, а в XML во временном файле.
+    """
+    t_first_row = t_start_row + 1 + append_after
+    total_rows = sum(plan.last_row - t_first_row + 1 for plan in plans.values())
     if total_rows <= 0:
-        print(
-            f"[{task_id}] DEBUG: Лист '{sheet_name}' не содержит строк данных (s_start_row: {s_start_row}, s_end_row: {s_end_row}).")
         return
     report_interval = max(200, total_rows // 20)
-    total_rules = len(rules)
-    progress_weight_per_rule = (sheet_progress_weight / total_rules) if total_rules > 0 else 0
-    for i, rule in enumerate(rules):
-        s_col_letter = rule.get('s_col') or get_col_from_cell(rule.get('source_cell'))
-        t_col_letter = rule.get('t_col') or rule.get('template_col')
-        if not s_col_letter or not t_col_letter:
-            continue
-        s_col_idx, t_col_idx = column_index_from_string(s_col_letter), column_index_from_string(t_col_letter)
-        if s_col_idx in used_source_cols or t_col_idx in used_template_cols:
-            print(f"[{task_id}] DEBUG: ПРАВИЛО ПРОПУЩЕНО: Колонка {s_col_letter} или {t_col_letter} уже используется.")
-            continue
-        rule_base_progress = int(sheet_base_progress + (i * progress_weight_per_rule))
-        target_row_counter = 0
-        next_report_at = report_interval
-        for r_idx in range(s_start_row + 1, s_end_row + 1):
-            if visible_rows_only and source_ws.row_dimensions[r_idx].hidden:
-                continue
-            source_cell = source_ws.cell(row=r_idx, column=s_col_idx)
-            target_cell = template_ws.cell(row=t_start_row + 1 + target_row_counter, column=t_col_idx)
-            target_cell.value = source_cell.value
-            if source_cell.hyperlink:
-                target_cell.hyperlink = source_cell.hyperlink.target
-                target_cell.style = "Hyperlink"
-            target_row_counter += 1
-            rows_processed = r_idx - s_start_row
-            if rows_processed >= next_report_at:
-                sheet_completion_ratio = rows_processed / total_rows
-                total_progress = int(rule_base_progress + (sheet_completion_ratio * progress_weight_per_rule))
-                _emit_status(task_id,
-                             f"Лист '{sheet_name}': {rows_processed}/{total_rows} (Колонка {s_col_letter} \u2192 {t_col_letter})",
+    rows_done = 0
+    next_report_at = report_interval
+
+    stage_times = defaultdict(float)
+    perf_counter = time.perf_counter
+
+    for sheet_name, plan in plans.items():
+        ws = plan.ws
+        stage_groups = plan.stage_groups
+        row_writer = output.sheet(ws, t_first_row, plan.last_row) if output is not None else None
+        values, links = {}, {}
+        for t_row_idx in range(t_first_row, plan.last_row + 1):
+            t_offset = t_row_idx - t_first_row
+            started = perf_counter()
+            for stage, ops in stage_groups:
+                for op in ops:
+                    if t_row_idx > op.last_row:
+                        continue
+                    try:
+                        op.apply(t_row_idx, t_offset, values, links)
+                    except Exception as e:
+                        # Как и раньше, ошибка правила прерывает только это правило
+                        logger.error("Лист '%s', строка %s, %s: %s", sheet_name, t_row_idx, op.description, e)
+                        op.last_row = t_row_idx - 1
+                finished = perf_counter()
+                stage_times[stage] += finished - started
+                started = finished
+
+            if row_writer is not None:
+                row_writer.write_row(t_row_idx, values, links)
+            else:
+                for col_idx, value in values.items():
+                    ws.cell(row=t_row_idx, column=col_idx).value = value
+                for col_idx, target in links.items():
+                    target_cell = ws.cell(row=t_row_idx, column=col_idx)
+                    target_cell.hyperlink = target
+                    target_cell.style = "Hyperlink"
+            values.clear()
+            links.clear()
+            stage_times['write'] += perf_counter() - started
+
+            rows_done += 1
+            if rows_done >= next_report_at:
+                total_progress = int(base_progress + rows_done / total_rows * progress_weight)
+                _emit_status(task_id, f"Лист '{sheet_name}': {t_row_idx - t_start_row}/{plan.last_row - t_start_row} строк",
                              total_progress)
                 next_report_at += report_interval
-        used_source_cols.add(s_col_idx)
-        used_template_cols.add(t_col_idx)
-    _emit_status(task_id, f"Лист '{sheet_name}' завершен.", int(sheet_base_progress + sheet_progress_weight))
+                if timer is not None:
+                    timer.sample_rss()
+                _check_cancelled(cancel_check)
+        _emit_status(task_id, f"Лист '{sheet_name}' завершен.",
+                     int(base_progress + rows_done / total_rows * progress_weight))
+
+    if timer is not None:
+        for stage, seconds in stage_times.items():
+            timer.add(stage, seconds)
+        timer.count('rows_written', rows_done)
+        timer.sample_rss()
 
 
 # --- Функция SocketIO (без изменений, использует глобальный socketio) ---
-def _emit_status(task_id, status, progress, is_complete=False, result_ready=False, warnings=None):
-    print(f"--- DEBUG [processor.py]: {task_id} - Вызов _emit_status (Progress: {progress}%) ---")
+def _emit_status(task_id, status, progress, is_complete=False, result_ready=False, warnings=None,
+                 warnings_report=False):
+    logger.debug("_emit_status: %s (%s%%)", status, progress)
+    if task_id is None:
+        return  # Предпросмотр (fill_preview): задачи нет, статус не отправляется
 
-    if task_id in task_statuses:
-        task_data = task_statuses[task_id]
-        if task_data:
-            task_data['status'] = status
-            task_data['progress'] = progress
+    task_statuses.update(task_id, status=status, progress=progress)
 
     payload = {
         'task_id': task_id,
@@ -244,16 +723,37 @@ def _emit_status(task_id, status, progress, is_complete=False, result_ready=Fals
 
     if is_complete:
         payload['warnings'] = warnings or []
+        payload['warnings_report'] = warnings_report
 
     event = 'task_complete' if is_complete else 'status_update'
 
     try:
         # Используем ГЛОБАЛЬНЫЙ 'socketio' (из app.extensions)
         socketio.emit(event, payload, room=task_id)
-        print(f"--- DEBUG [processor.py]: {task_id} - socketio.emit УСПЕХ ---")
-    except Exception as e:
-        print(f"--- DEBUG [processor.py]: {task_id} - ОШИБКА при вызове socketio.emit: {e} ---")
-        traceback.print_exc()
+        metrics_service.socketio_event(event)
+    except Exception:
+        logger.exception("Ошибка при вызове socketio.emit")
+
+
+def fill_preview(source_wb, template_wb, settings, warnings):
+    """
+    Заполняет шаблон для предпросмотра (services/preview_service.py): те же
+    правила и тот же план, что и в process_excel_hybrid, но без задачи,
+    статусов, метрик и сохранения. Возвращает планы по листам шаблона.
+    """
+    template_ws = template_wb.active
+    t_start_row = settings['ranges_settings'].get('t_start_row', 1)
+    _apply_cell_mappings(source_wb, template_ws, settings['cell_mappings'], None)
+    post_processor = GeocodingPostProcessor(None, settings['post_function'], None)
+    plans = build_execution_plan(
+        source_wb, template_wb, template_ws, t_start_row, settings['template_rules'],
+        get_sheet_settings_map(settings['sheet_settings']), settings['source_cell_fill_rules'],
+        settings['static_value_rules'], settings['formula_rules'], settings['visible_rows_only'],
+        None, warnings, post_processor=post_processor, use_column_cache=False
+    )
+    execute_plan(plans, t_start_row, None)
+    post_processor.finish()
+    return plans
 
 
 # --- Основная функция (КЛЮЧЕВОЕ ИЗМЕНЕНИЕ) ---
@@ -261,151 +761,203 @@ def process_excel_hybrid(app, task_id, source_file_obj, template_file_obj, # <--
                          ranges, sheet_settings, template_rules, post_function,
                          original_template_filename, task_statuses, cell_mappings=None,
                          formula_rules=None, static_value_rules=None, visible_rows_only=False,
-                         source_cell_fill_rules=None):
-    print(f"--- DEBUG [processor.py]: ЗАПУСК ЗАДАЧИ {task_id} ---")
-
-    owner_id = task_statuses.get(task_id, {}).get('owner_id')
+                         source_cell_fill_rules=None, cancel_check=None, incremental=None):
+    """
+    Заполняет шаблон данными источника по правилам и сохраняет результат
+    в task_statuses. cancel_check - функция без аргументов, True - задачу
+    отменили (проверяется между этапами и блоками строк).
+    incremental - параметры инкрементального режима (incremental_service.lineage):
+    если источник - продолжение предыдущего прогона той же линии, новые строки
+    дописываются к его результату.
+    """
+    # Все записи лога задачи помечаются ее task_id
+    log_context = TaskLogContext(task_id)
+    log_context.push()
+    logger.debug("Запуск задачи")
+
+    owner_id = (task_statuses.get(task_id) or {}).get('owner_id')
     final_status = "Неизвестная ошибка"
 
     context = app.app_context()
     context.push()
 
-
-    print(f"--- DEBUG [processor.py]: {task_id} - Контекст УЖЕ должен быть (из start_background_task) ---")
-
-    task_warnings = []
+    # Замечания (ошибки формул): в состоянии задачи - сводка по группам,
+    # все случаи - в отчете на диске (services/warning_report.py)
+    warnings = WarningCollector(warning_report.report_path(task_id))
+    # Время этапов и объемы данных задачи (см. services/task_metrics.py)
+    timer = StageTimer()
+    metrics_service.task_started()
 
     try:
-        print(f"--- DEBUG [processor.py]: {task_id} - Вход в блок TRY ---")
-
         _emit_status(task_id, 'Подготовка...', 5)
 
-        print(f"--- DEBUG [processor.py]: {task_id} - _emit_status(5%) ---")
-
-        source_wb = load_workbook(filename=source_file_obj, data_only=True)
-
-        print(f"--- DEBUG [processor.py]: {task_id} - Source WB загружен ---")
-
-        is_macro_enabled = original_template_filename.lower().endswith('.xlsm')
-        template_wb = load_workbook(filename=template_file_obj, keep_vba=is_macro_enabled)
-        template_ws = template_wb.active
-
-        print(f"--- DEBUG [processor.py]: {task_id} - Template WB загружен ---")
-
-        # ... (остальная логика try...catch...finally остается БЕЗ ИЗМЕНЕНИЙ) ...
-        # (включая _apply_cell_mappings, _apply_manual_rules, logging_service.log_task и т.д.)
+        timer.count('source_bytes', file_size(source_file_obj))
+        with timer.measure('load'):
+            # Разбираются только листы, на которые ссылаются правила
+            source_wb, skipped_sheets = load_source_workbook(
+                source_file_obj, template_rules, cell_mappings, formula_rules, source_cell_fill_rules,
+                sheet_settings, backend=app.config.get('SOURCE_READER', 'stream'))
+            logger.debug("Source WB загружен")
+        timer.count('source_sheets_skipped', len(skipped_sheets))
+        _check_cancelled(cancel_check)
 
         sheet_settings_map = get_sheet_settings_map(sheet_settings)
         t_start_row = ranges.get('t_start_row', 1)
-        used_template_cols = set()
-        used_source_cols_by_sheet = defaultdict(set)
+        is_macro_enabled = original_template_filename.lower().endswith('.xlsm')
+
+        # Инкрементальный режим: строки до водяного знака уже есть в предыдущем
+        # результате, он и становится шаблоном
+        watermark, lineage_key, append_after = None, None, None
+        if incremental is not None:
+            _emit_status(task_id, 'Сравниваю источник с предыдущим прогоном...', 7)
+            with timer.measure('fingerprint'):
+                watermark = _SourceWatermark(source_wb, sheet_settings_map, template_rules, formula_rules,
+                                             cell_mappings, source_cell_fill_rules, visible_rows_only)
+                lineage_key = incremental_service.lineage_key(incremental, watermark.signature)
+                previous = incremental_service.load(lineage_key, incremental['config'])
+                append_after = watermark.resume_from(previous)
+            if append_after:
+                logger.info("Инкрементальный прогон: %s строк уже обработаны, дописываются %s новых",
+                            append_after, watermark.rows - append_after)
+                template_file_obj = previous['result_path']
+                sheet_settings_map = watermark.resumed_sheet_settings(sheet_settings_map, previous)
+                # Замечания прежних строк: группы объединяются с новыми, отчет продолжается
+                warnings.resume(previous['warning_groups'], previous.get('report_path'))
+                timer.count('resumed_rows', append_after)
+            else:
+                logger.info("Инкрементальный режим: полный прогон")
+            _check_cancelled(cancel_check)
+
+        timer.count('template_bytes', file_size(template_file_obj))
+        with timer.measure('load'):
+            template_wb = load_workbook(filename=template_file_obj, keep_vba=is_macro_enabled)
+            template_ws = template_wb.active
+            logger.debug("Template WB загружен")
 
         # 1. Точечное копирование ячеек
         _emit_status(task_id, 'Копирую отдельные ячейки...', 10)
-        _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id)
-
-        # 1.5. Заполнение столбцов из ячейки
-        _emit_status(task_id, 'Заполняю столбцы из ячеек...', 15)
-        _apply_source_cell_fill_rules(source_wb, template_wb, source_cell_fill_rules, t_start_row, task_id)
-
-        # 2. Копирование колонок
-        base_progress = 20
-        total_progress_weight = 50
-        sheets_with_rules = set(r.get('source_sheet', source_wb.sheetnames[0]) for r in template_rules)
-        sheets_to_process = [s for s in source_wb.sheetnames if s in sheets_with_rules]
-        if not sheets_to_process and any(r.get('source_sheet') is None for r in template_rules):
-            if source_wb.sheetnames and source_wb.sheetnames[0] not in sheets_to_process:
-                sheets_to_process.append(source_wb.sheetnames[0])
-        total_sheets = len(sheets_to_process)
-        progress_weight_per_sheet = total_progress_weight / total_sheets if total_sheets > 0 else 0
-        _emit_status(task_id, f"Найдено {total_sheets} листов для обработки колонок...", base_progress)
-        for i, sheet_name in enumerate(sheets_to_process):
-            try:
-                source_ws = source_wb[sheet_name]
-                s_start_row = sheet_settings_map.get(sheet_name, 1)
-                used_source_cols = used_source_cols_by_sheet[sheet_name]
-                current_template_rules = [r for r in template_rules if
-                                          r.get('source_sheet', source_wb.sheetnames[0]) == sheet_name]
-                if not current_template_rules:
-                    continue
-                sheet_base_progress = int(base_progress + (i * progress_weight_per_sheet))
-                _apply_manual_rules(
-                    source_ws, template_ws, current_template_rules, s_start_row, t_start_row,
-                    used_source_cols,
-                    used_template_cols, visible_rows_only, task_id,
-                    sheet_name,
-                    sheet_base_progress,
-                    int(progress_weight_per_sheet)
-                )
-            except KeyError:
-                print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' (из правил) не найден в файле-источнике.")
-            except Exception as e:
-                print(f"[{task_id}] ОШИБКА: Ошибка при обработке ручных правил для листа '{sheet_name}': {e}")
-
-        # 3. Заполнение статичных значений
-        _emit_status(task_id, 'Заполняю статичные значения...', 70)
-        _apply_static_value_rules(template_wb, static_value_rules, t_start_row, task_id)
-
-        # 4. Вычисление и вставка результатов формул
-        _emit_status(task_id, 'Вычисляю формулы...', 80)
-        _apply_formula_rules(source_wb, template_wb, formula_rules, sheet_settings_map, t_start_row, task_id,
-                             task_warnings)
-
-        # 5. Финальная пост-обработка
-        _emit_status(task_id, 'Пост-обработка...', 90)
-        apply_post_processing(task_id, template_wb, t_start_row, post_function, task_statuses)
-
-        # 6. Сохранение результата
+        with timer.measure('cell_mappings'):
+            _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id)
+
+        # 2. План заполнения строк: колонки, заполнение из ячеек, статичные значения,
+        # формулы и пост-обработка (геокодинг)
+        _emit_status(task_id, 'Составляю план заполнения...', 15)
+        post_processor = GeocodingPostProcessor(task_id, post_function, task_statuses)
+        with timer.measure('plan'):
+            plans = build_execution_plan(
+                source_wb, template_wb, template_ws, t_start_row, template_rules, sheet_settings_map,
+                source_cell_fill_rules, static_value_rules, formula_rules, visible_rows_only,
+                task_id, warnings, post_processor=post_processor,
+                use_column_cache=app.config.get('COLUMNAR_SOURCE_CACHE', True), timer=timer,
+                append_after=append_after or 0, source_extents=watermark.extents if watermark else None
+            )
+
+        # 3. Заполнение всех строк за один проход
+        _emit_status(task_id, f"Найдено {len(plans)} листов для заполнения...", 20)
+        _check_cancelled(cancel_check)
+        # Строки области данных пишутся сразу в XML на диске (services/output_writer.py)
+        output = None
+        if app.config.get('STREAMING_OUTPUT', True):
+            output = StreamingWorkbookWriter(template_wb, temp_dir=app.config['PROCESSED_FOLDER'])
+        execute_plan(plans, t_start_row, task_id, timer=timer, cancel_check=cancel_check,
+                     append_after=append_after or 0, output=output)
+        post_processor.finish()
+        warnings.close()
+        task_warnings = warnings.summary()
+        _check_cancelled(cancel_check)
+
+        # 4. Сохранение результата
         _emit_status(task_id, 'Сохраняю результат...', 95)
-        processed_file_obj = io.BytesIO()
-        template_wb.save(processed_file_obj)
-        processed_file_obj.seek(0)
-        source_wb.close()
-        template_wb.close()
-
-        print(f"--- DEBUG [processor.py]: {task_id} - Блок TRY УСПЕШНО ЗАВЕРШЕН ---")
-
-        # 7. Логгирование и обновление статуса (УСПЕХ)
+        with timer.measure('save'):
+            source_wb.close()
+            if output is not None:
+                # Результат - временный файл на диске, а не байты в памяти
+                processed_file_obj = tempfile.TemporaryFile(dir=app.config['PROCESSED_FOLDER'])
+                output.save(processed_file_obj)
+            else:
+                processed_file_obj = io.BytesIO()
+                template_wb.save(processed_file_obj)
+            processed_file_obj.seek(0)
+            template_wb.close()
+        timer.count('result_bytes', file_size(processed_file_obj))
+
+        if watermark is not None:
+            try:
+                incremental_service.save(
+                    lineage_key, processed_file_obj,
+                    dict(watermark.as_state(), config=incremental['config'], warning_groups=warnings.groups_state()),
+                    suffix='.xlsm' if is_macro_enabled else '.xlsx',
+                    report_path=warnings.report_path if warnings.has_report else None)
+            except OSError:
+                logger.exception("Не удалось сохранить состояние инкрементального режима")
+
+        # 5. Логгирование и обновление статуса (УСПЕХ)
         final_status = 'Готово!'
+        metrics = timer.as_dict()
         # logging_service.log_task вызывается ВНУТРИ app context'а
         logging_service.log_task(
-            task_id, owner_id, final_status, original_template_filename
+            task_id, owner_id, final_status, original_template_filename, metrics=metrics
+        )
+        task_statuses.save_result(task_id, processed_file_obj)
+        processed_file_obj.close()
+        task_statuses.update(
+            task_id, status=final_status, result_ready=True, template_filename=original_template_filename,
+            warnings=task_warnings, warnings_report=warnings.has_report, metrics=metrics
         )
-        task_statuses[task_id].update({
-            'status': final_status,
-            'result_file': processed_file_obj,
-            'template_filename': original_template_filename,
-            'warnings': task_warnings
-        })
-        _emit_status(task_id, final_status, 100, is_complete=True, result_ready=True, warnings=task_warnings)
+        metrics_service.task_finished(True, metrics)
+        _emit_status(task_id, final_status, 100, is_complete=True, result_ready=True, warnings=task_warnings,
+                     warnings_report=warnings.has_report)
+
+    except TaskCancelled:
+        logger.info("Задача отменена")
+        final_status = CANCELLED_STATUS
+        metrics = timer.as_dict()
+        warnings.close()
+        task_warnings = warnings.summary()
+        logging_service.log_task(
+            task_id, owner_id, final_status, original_template_filename, metrics=metrics
+        )
+        task_statuses.update(
+            task_id, status=final_status, result_ready=False, warnings=task_warnings,
+            warnings_report=warnings.has_report, metrics=metrics
+        )
+        metrics_service.task_finished(False, metrics)
+        _emit_status(task_id, final_status, 100, is_complete=True, result_ready=False, warnings=task_warnings,
+                     warnings_report=warnings.has_report)
 
     except Exception as e:
-        # 8. Логгирование и обновление статуса (ОШИБКА)
-        print(f"[{task_id}] КРИТИЧЕСКАЯ ОШИБКА в фоновом потоке: {e}")
-        traceback.print_exc()
+        # 6. Логгирование и обновление статуса (ОШИБКА)
+        logger.exception("Критическая ошибка в фоновом потоке: %s", e)
         final_status = f"Ошибка: {e}"
+        metrics = timer.as_dict()
+        warnings.close()
+        task_warnings = warnings.summary()
         # logging_service.log_task вызывается ВНУТРИ app context'а
         logging_service.log_task(
-            task_id, owner_id, final_status, original_template_filename
+            task_id, owner_id, final_status, original_template_filename, metrics=metrics
+        )
+        task_statuses.update(
+            task_id, status=final_status, result_ready=False, warnings=task_warnings,
+            warnings_report=warnings.has_report, metrics=metrics
         )
-        task_statuses[task_id].update({
-            'status': final_status,
-            'result_file': None,
-            'warnings': task_warnings
-        })
-        _emit_status(task_id, final_status, 100, is_complete=True, result_ready=False, warnings=task_warnings)
+        metrics_service.task_finished(False, metrics)
+        _emit_status(task_id, final_status, 100, is_complete=True, result_ready=False, warnings=task_warnings,
+                     warnings_report=warnings.has_report)
 
     finally:
-        print(f"--- DEBUG [processor.py]: {task_id} - Вход в блок FINALLY ---")
         context.pop()
 
-        if task_id in task_statuses:
-            task_data = task_statuses[task_id]
-            task_statuses[task_id] = {
-                'result_file': task_data.get('result_file'),
+        task_data = task_statuses.get(task_id)
+        if task_data is not None:
+            task_statuses.replace(task_id, {
+                'status': final_status,
+                'result_ready': task_data.get('result_ready', False),
                 'template_filename': task_data.get('template_filename'),
                 'owner_id': task_data.get('owner_id'),
-                'warnings': task_data.get('warnings')
-            }
+                'warnings': task_data.get('warnings'),
+                'warnings_report': task_data.get('warnings_report', False),
+                'metrics': task_data.get('metrics')
+            })
 
-        print(f"--- DEBUG [processor.py]: {task_id} - ЗАДАЧА ЗАВЕРШЕНА ---")
\ No newline at end of file
+        logger.info("Задача завершена за %.2f с: %s", timer.elapsed, final_status)
+        log_context.pop()
\ No newline at end of file
@@ -1,15 +1,23 @@
 # app/services/geocoding_service.py
 import csv
 import os
+from array import array
 import re
+import logging
 from threading import Lock
-import numpy as np
-from scipy.spatial import cKDTree
-from thefuzz import process as fuzz_process
 from flask import current_app
 
 from app.utils.helpers import find_column_indices
 
+logger = logging.getLogger(__name__)
+
+# numpy, scipy.spatial и thefuzz импортируются при первом использовании
+# (загрузка адресов, нечеткий поиск), а не при импорте модуля: модуль
+# импортируется каждым веб-процессом через excel_processor, а геокодинг
+# нужен только задачам с постобработкой.
+
+_NOT_WORD_RE = re.compile(r'[\W_]+')
+
 
 def _normalize_address_string(s):
     """
@@ -17,7 +25,142 @@ def _normalize_address_string(s):
     """
     if not isinstance(s, str):
         return ""
-    return re.sub(r'[\W_]+', '', s).lower()
+    return _NOT_WORD_RE.sub('', s).lower()
+
+
+class AddressIndex:
+    """
+    База адресов в компактном виде. Раньше на каждый адрес приходилось
+    несколько объектов Python (ключи и значения двух словарей, строки
+    координат, элемент списка для cKDTree) - около 1 КБ на адрес. Теперь:
+
+    coords - массив NumPy (n, 2) float64: широта и долгота строки (он же
+        данные cKDTree, без копии);
+    адреса - одна строка-буфер на всю базу и массив смещений: адрес строки
+        i - addresses[offsets[i]:offsets[i + 1]];
+    нормализованные ключи - так же, строка-буфер (через '\n') и смещения;
+    хеш-индекс "нормализованный ключ -> строка" - открытая адресация:
+        в ячейке номер строки + 1 (int32, 0 - пусто) и 64-битный hash()
+        ключа (int64), таблица заполнена не больше чем наполовину.
+
+    Для одинаковых ключей действует последняя строка файла (как раньше в
+    словаре). При поиске ключ сравнивается сначала по 64-битному хешу, и
+    только при совпадении хеша - с самим ключом из буфера, так что поиск
+    точный, как в словаре. Массивы читаются через memoryview: отдельные
+    элементы так получаются в несколько раз быстрее, чем индексированием
+    NumPy. hash() строк случаен для каждого процесса: индекс строится и
+    используется в одном процессе (или до fork).
+    """
+    __slots__ = ('coords', '_coords', '_addresses', '_address_offsets', '_keys', '_key_offsets', '_slot_rows',
+                 '_slot_hashes', '_mask')
+
+    def __init__(self, addresses, keys, coords):
+        """
+        addresses, keys - списки строк; coords - пары (широта, долгота) или
+        широты и долготы подряд (array('d')).
+        """
+        import numpy as np
+
+        self.coords = np.array(coords, dtype=np.float64).reshape(len(addresses), 2)
+        # Плоский вид: широта строки i - [2 * i], долгота - [2 * i + 1]
+        # (reshape(-1) массива C-порядка - вид без копии, в т.ч. для пустой базы)
+        self._coords = memoryview(self.coords.reshape(-1))
+        self._addresses, self._address_offsets = _pack_strings(addresses)
+        # Нормализованные ключи состоят из букв и цифр: '\n' после каждого
+        # позволяет keys() получить список одним split()
+        self._keys, self._key_offsets = _pack_strings([key + '\n' for key in keys])
+
+        size = 8
+        while size < 2 * len(keys):
+            size *= 2
+        mask = size - 1
+        slot_rows = [0] * size
+        slot_hashes = [0] * size
+        for row, key in enumerate(keys):
+            key_hash = hash(key)
+            i = key_hash & mask
+            while slot_rows[i] and keys[slot_rows[i] - 1] != key:
+                i = (i + 1) & mask
+            slot_rows[i] = row + 1
+            slot_hashes[i] = key_hash
+        self._slot_rows = memoryview(np.array(slot_rows, dtype=np.int32))
+        self._slot_hashes = memoryview(np.array(slot_hashes, dtype=np.int64))
+        self._mask = mask
+
+    @classmethod
+    def from_csv(cls, path):
+        """Строки файла "адрес,широта,долгота"; строки с ошибками пропускаются."""
+        # Координаты - в array('d'), а не в списке кортежей: меньше пик памяти при загрузке
+        addresses, keys, coords = [], [], array('d')
+        with open(path, mode='r', encoding='utf-8') as infile:
+            for row in csv.reader(infile):
+                if len(row) != 3:
+                    continue
+                address, lat_str, lon_str = row
+                try:
+                    lat, lon = float(lat_str), float(lon_str)
+                except (ValueError, TypeError):
+                    continue
+                original_address = address.strip()
+                addresses.append(original_address)
+                keys.append(_normalize_address_string(original_address))
+                coords.append(lat)
+                coords.append(lon)
+        return cls(addresses, keys, coords)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def find(self, key):
+        """Номер строки с нормализованным ключом key или None."""
+        slot_rows, slot_hashes, mask = self._slot_rows, self._slot_hashes, self._mask
+        keys, key_offsets = self._keys, self._key_offsets
+        key_hash = hash(key)
+        i = key_hash & mask
+        while True:
+            row = slot_rows[i]
+            if not row:
+                return None
+            if slot_hashes[i] == key_hash:
+                # Совпадение хеша проверяется самим ключом (без вызова key() - он на горячем пути)
+                if keys[key_offsets[row - 1]:key_offsets[row] - 1] == key:
+                    return row - 1
+            i = (i + 1) & mask
+
+    def lookup(self, key):
+        """(широта, долгота) строки с ключом key или None - find() и point() одним вызовом."""
+        row = self.find(key)
+        if row is None:
+            return None
+        coords = self._coords
+        return coords[2 * row], coords[2 * row + 1]
+
+    def key(self, row):
+        """Нормализованный ключ строки."""
+        offsets = self._key_offsets
+        return self._keys[offsets[row]:offsets[row + 1] - 1]
+
+    def address(self, row):
+        offsets = self._address_offsets
+        return self._addresses[offsets[row]:offsets[row + 1]]
+
+    def point(self, row):
+        """(широта, долгота) строки."""
+        coords = self._coords
+        return coords[2 * row], coords[2 * row + 1]
+
+    def keys(self):
+        """Все нормализованные ключи (новый список - для нечеткого поиска)."""
+        return self._keys.split('\n')[:-1]
+
+
+def _pack_strings(strings):
+    """Одна строка-буфер и смещения (memoryview массива int64, n + 1) начала каждой строки в ней."""
+    import numpy as np
+
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, strings), dtype=np.int64, count=len(strings)), out=offsets[1:])
+    return ''.join(strings), memoryview(offsets)
 
 
 class LocalAddressService:
@@ -25,7 +168,7 @@ class LocalAddressService:
     _lock = Lock()
 
     def __new__(cls, *args, **kwargs):
-        # Реализуем Singleton, чтобы kdtree и словари загружались один раз
+        # Реализуем Singleton, чтобы kdtree и индекс адресов загружались один раз
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super(LocalAddressService, cls).__new__(cls)
@@ -39,19 +182,19 @@ class LocalAddressService:
             if self._initialized:
                 return
 
-            # Данные для поиска "Адрес -> Координаты"
-            self.normalized_address_to_coords = {}
-            self.address_choices = {}
-
-            # Данные для поиска "Координаты -> Адрес"
+            # База адресов: "Адрес -> Координаты" по хеш-индексу,
+            # "Координаты -> Адрес" по kdtree (см. AddressIndex)
+            self.index = None
             self.kdtree = None
-            self.kdtree_data = []
 
             self._initialized = True
             # Загрузка данных будет вызвана при первом обращении,
             # когда будет доступен current_app
             self._data_loaded = False
 
+    def __len__(self):
+        return 0 if self.index is None else len(self.index)
+
     def _load_data(self):
         """Ленивая загрузка данных, требующая контекста приложения."""
         if self._data_loaded:
@@ -63,53 +206,42 @@ class LocalAddressService:
 
             csv_file_path = current_app.config['ADDRESS_CSV_FILE']
             if not os.path.exists(csv_file_path):
-                current_app.logger.warning(f"Внимание: Файл с адресами не найден: {csv_file_path}")
+                logger.warning("Файл с адресами не найден: %s", csv_file_path)
                 self._data_loaded = True  # Считаем "загруженным", чтобы не пытаться снова
                 return
 
-            points = []
             try:
-                with open(csv_file_path, mode='r', encoding='utf-8') as infile:
-                    reader = csv.reader(infile)
-                    for row in reader:
-                        if len(row) == 3:
-                            address, lat_str, lon_str = row
-                            try:
-                                original_address = address.strip()
-                                normalized_addr = _normalize_address_string(original_address)
-                                lat, lon = float(lat_str), float(lon_str)
-
-                                self.normalized_address_to_coords[normalized_addr] = (lat_str.strip(), lon_str.strip())
-                                self.address_choices[normalized_addr] = original_address
-
-                                points.append((lat, lon))
-                                self.kdtree_data.append(original_address)
-                            except (ValueError, TypeError):
-                                continue
-                if points:
-                    self.kdtree = cKDTree(np.array(points))
+                index = AddressIndex.from_csv(csv_file_path)
+                if len(index):
+                    from scipy.spatial import cKDTree
+                    self.kdtree = cKDTree(index.coords)
+                self.index = index
 
                 self._data_loaded = True
-                current_app.logger.info(f"Служба геокодинга успешно загрузила {len(points)} адресов.")
+                logger.info("Служба геокодинга успешно загрузила %s адресов.", len(index))
 
             except Exception as e:
-                current_app.logger.error(f"Ошибка при загрузке файла с адресами: {e}")
+                logger.error("Ошибка при загрузке файла с адресами: %s", e)
+                # Как и без файла: не перечитывать его для каждой строки
+                self._data_loaded = True
 
     def get_coords(self, address):
-        """Ищет координаты по адресу."""
+        """Ищет координаты (широта, долгота) по адресу."""
         self._load_data()  # Гарантируем, что данные загружены
-        if not address: return None, None
+        index = self.index
+        if not address or index is None: return None, None
 
         normalized_query = _normalize_address_string(address)
-        exact_match = self.normalized_address_to_coords.get(normalized_query)
-        if exact_match:
+        exact_match = index.lookup(normalized_query)
+        if exact_match is not None:
             return exact_match
 
-        if not self.address_choices: return None, None
+        if not len(index): return None, None
 
-        best_match_normalized, score = fuzz_process.extractOne(normalized_query, self.address_choices.keys())
+        from thefuzz import process as fuzz_process
+        best_match_normalized, score = fuzz_process.extractOne(normalized_query, index.keys())
         if score > 85:
-            return self.normalized_address_to_coords.get(best_match_normalized)
+            return index.point(index.find(best_match_normalized))
 
         return None, None
 
@@ -119,8 +251,8 @@ class LocalAddressService:
         if self.kdtree is None: return None
         if lat is None or lon is None: return None
         try:
-            distance, index = self.kdtree.query(np.array([float(lat), float(lon)]))
-            return self.kdtree_data[index]
+            distance, index = self.kdtree.query((float(lat), float(lon)))
+            return self.index.address(index)
         except (ValueError, TypeError):
             return None
 
@@ -138,55 +270,85 @@ def get_address_by_coords(lat, lon):
     return address_service.get_address(lat, lon)
 
 
-def apply_post_processing(task_id, workbook, start_row, function_name, task_statuses):
+def preload_addresses():
+    """Загружает индекс адресов заранее (режим pre-fork, см. services/prefork.py). Возвращает число адресов."""
+    address_service._load_data()
+    return len(address_service)
+
+
+class GeocodingPostProcessor:
     """
-    Применяет функции пост-обработки (геокодинга).
+    Пост-обработка (геокодинг) строк шаблона. Выполняется как последняя
+    операция в общем проходе по строкам (см. excel_processor.build_execution_plan):
+    читает итоговое значение адреса в строке и записывает координаты.
+    task_statuses=None - статус задачи не обновляется (предпросмотр).
     """
-    if function_name not in ['address_to_coords', 'coords_to_address']:
-        current_app.logger.info(f"[{task_id}] Пост-обработка не требуется (function_name: {function_name}).")
-        return
-
     ROUNDING_PRECISION = 4
-    worksheet = workbook.active
-    cols = find_column_indices(worksheet, start_row, {'lat': 'Широта', 'lon': 'Долгота', 'addr': 'Адрес'})
-
-    if not all(k in cols for k in ['lat', 'lon', 'addr']):
-        msg = "Ошибка: не найдены все обязательные колонки ('Широта', 'Долгота', 'Адрес'). Геокодинг пропущен."
-        current_app.logger.error(f"[{task_id}] {msg}")
-        task_statuses[task_id]['status'] = msg
-        return
-
-    rows_processed = 0
-    total_rows = worksheet.max_row - start_row
-
-    if function_name == 'address_to_coords':
-        current_app.logger.info(f"[{task_id}] Запущен геокодинг 'Адрес -> Координаты'.")
-        for i, row_cells in enumerate(worksheet.iter_rows(min_row=start_row + 1, max_row=worksheet.max_row)):
-            address_cell = row_cells[cols['addr'] - 1]
-            address_value = address_cell.value
-
-            if address_value and isinstance(address_value, str):
-                lat, lon = get_coordinates(address_value)
-                if lat and lon:
-                    try:
-                        rounded_lat = round(float(lat), ROUNDING_PRECISION)
-                        rounded_lon = round(float(lon), ROUNDING_PRECISION)
-
-                        worksheet.cell(row=start_row + 1 + i, column=cols['lat']).value = rounded_lat
-                        worksheet.cell(row=start_row + 1 + i, column=cols['lon']).value = rounded_lon
-                        rows_processed += 1
-                    except ValueError:
-                        current_app.logger.warning(f"[{task_id}] Не удалось записать lat/lon: {lat}, {lon}")
-
-            if (i + 1) % 100 == 0:
-                print(f'Геокодинг: обработано {i + 1}/{total_rows} строк...')
-                pass
-
-    elif function_name == 'coords_to_address':
-        current_app.logger.info(f"[{task_id}] Запущен геокодинг 'Координаты -> Адрес'.")
-        # (Логика не была реализована в исходном файле, оставлено пустым)
-        pass
-
-    msg = f"Геокодинг '{function_name}' завершен: {rows_processed} записей."
-    current_app.logger.info(f"[{task_id}] {msg}")
-    task_statuses[task_id]['status'] = msg
\ No newline at end of file
+
+    def __init__(self, task_id, function_name, task_statuses):
+        self.task_id = task_id
+        self.function_name = function_name
+        self.task_statuses = task_statuses
+        self.worksheet = None
+        self.cols = {}
+        self.rows_processed = 0
+        self.started = False
+
+    def prepare(self, worksheet, start_row):
+        """Находит колонки по заголовкам. Возвращает True, если нужно обрабатывать строки."""
+        task_id = self.task_id
+        if self.function_name not in ['address_to_coords', 'coords_to_address']:
+            logger.info("Пост-обработка не требуется (function_name: %s).", self.function_name)
+            return False
+
+        self.worksheet = worksheet
+        self.cols = find_column_indices(worksheet, start_row, {'lat': 'Широта', 'lon': 'Долгота', 'addr': 'Адрес'})
+
+        if not all(k in self.cols for k in ['lat', 'lon', 'addr']):
+            msg = "Ошибка: не найдены все обязательные колонки ('Широта', 'Долгота', 'Адрес'). Геокодинг пропущен."
+            logger.error(msg)
+            if self.task_statuses is not None:
+                self.task_statuses.update(task_id, status=msg)
+            return False
+
+        self.started = True
+        if self.function_name == 'address_to_coords':
+            logger.info("Запущен геокодинг 'Адрес -> Координаты'.")
+        elif self.function_name == 'coords_to_address':
+            logger.info("Запущен геокодинг 'Координаты -> Адрес'.")
+            # (Логика не была реализована в исходном файле, оставлено пустым)
+            return False
+        return True
+
+    def process_row(self, row_idx, row_offset, values, links):
+        """Обрабатывает строку: values - уже вычисленные значения строки {колонка: значение}."""
+        addr_col = self.cols['addr']
+        if addr_col in values:
+            address_value = values[addr_col]
+        else:
+            # ws._cells: чтение не создает пустую ячейку в строке (при потоковой
+            # записи строки в листе не остаются, см. services/output_writer.py)
+            cell = self.worksheet._cells.get((row_idx, addr_col))
+            address_value = cell.value if cell is not None else None
+
+        if address_value and isinstance(address_value, str):
+            lat, lon = get_coordinates(address_value)
+            if lat is not None and lon is not None:
+                try:
+                    rounded_lat = round(float(lat), self.ROUNDING_PRECISION)
+                    rounded_lon = round(float(lon), self.ROUNDING_PRECISION)
+
+                    values[self.cols['lat']] = rounded_lat
+                    values[self.cols['lon']] = rounded_lon
+                    self.rows_processed += 1
+                except ValueError:
+                    logger.warning("Не удалось записать lat/lon: %s, %s", lat, lon)
+
+    def finish(self):
+        """Записывает итоговый статус геокодинга."""
+        if not self.started:
+            return
+        msg = f"Геокодинг '{self.function_name}' завершен: {self.rows_processed} записей."
+        logger.info(msg)
+        if self.task_statuses is not None:
+            self.task_statuses.update(self.task_id, status=msg)
@@ -0,0 +1,127 @@
+# app/services/incremental_service.py
+"""
+Инкрементальный режим для растущих источников: ежедневная выгрузка -
+вчерашний файл плюс несколько тысяч новых строк.
+
+Для каждой линии источника (владелец, шаблон и подпись источника - строки
+заголовков и первая строка данных листов с правилами) хранится состояние
+последнего прогона: водяной знак (сколько строк данных уже в результате и
+до какой строки каждого листа-источника они взяты), отпечатки строк
+источника до водяного знака и сам результат. Если в новом источнике строки
+до водяного знака не изменились, а правила и шаблон те же, обрабатываются
+только новые строки и дописываются к прежнему результату; иначе выполняется
+полный прогон. Водяной знак считает excel_processor (_SourceWatermark).
+
+Замечания прежних строк хранятся группами (warning_report.WarningCollector)
+вместе с копией их CSV-отчета: дописывающий прогон объединяет их с новыми.
+
+Файлы: PROCESSED_FOLDER/incremental/<ключ>.json, <ключ>.xlsx (.xlsm) и
+<ключ>.csv (отчет о замечаниях, если они были).
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from flask import current_app
+
+from app.services import result_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _state_dir():
+    return os.path.join(current_app.config['PROCESSED_FOLDER'], 'incremental')
+
+
+def lineage(owner_id, settings):
+    """
+    Параметры инкрементального режима для задания (settings - результат
+    main._collect_task_settings): владелец, шаблон и отпечаток правил.
+    """
+    return {'owner_id': owner_id, 'template_id': settings.get('template_id'),
+            'config': result_cache.settings_digest(settings)}
+
+
+def lineage_key(incremental, signature):
+    """Ключ линии источника: владелец, шаблон и подпись источника."""
+    description = json.dumps([incremental.get('owner_id'), incremental.get('template_id'), signature])
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def load(key, config):
+    """
+    Состояние предыдущего прогона линии с путем к его результату
+    ('result_path') и отчету о замечаниях ('report_path', если он есть)
+    или None, если его нет или правила с тех пор изменились.
+    """
+    try:
+        with open(os.path.join(_state_dir(), f"{key}.json"), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('config') != config:
+        logger.info("Правила линии %s изменились, нужен полный прогон", key[:12])
+        return None
+    if 'warning_groups' not in state:
+        # Состояние прежнего формата: замечания хранились только сводкой
+        return None
+    state['result_path'] = os.path.join(_state_dir(), state['result_file'])
+    if not os.path.exists(state['result_path']):
+        return None
+    if state.get('report_file'):
+        state['report_path'] = os.path.join(_state_dir(), state['report_file'])
+    return state
+
+
+def save(key, result_file, state, suffix='.xlsx', report_path=None):
+    """
+    Сохраняет результат (файловый объект), копию отчета о замечаниях
+    report_path (None - замечаний нет) и состояние прогона, затем удаляет
+    устаревшие линии.
+    """
+    state_dir = _state_dir()
+    os.makedirs(state_dir, exist_ok=True)
+    result_name = key + suffix
+    result_path = os.path.join(state_dir, result_name)
+    position = result_file.tell()
+    result_file.seek(0)
+    with open(f"{result_path}.{os.getpid()}.tmp", 'wb') as f:
+        shutil.copyfileobj(result_file, f)
+    result_file.seek(position)
+    os.replace(f"{result_path}.{os.getpid()}.tmp", result_path)
+
+    report_name = key + '.csv' if report_path is not None else None
+    state_report_path = os.path.join(state_dir, key + '.csv')
+    if report_path is not None:
+        shutil.copyfile(report_path, f"{state_report_path}.{os.getpid()}.tmp")
+        os.replace(f"{state_report_path}.{os.getpid()}.tmp", state_report_path)
+    elif os.path.exists(state_report_path):
+        os.remove(state_report_path)
+
+    # Состояние пишется последним: load видит либо прежний прогон, либо новый целиком
+    state = dict(state, result_file=result_name, report_file=report_name, saved_at=time.time())
+    state_path = os.path.join(state_dir, f"{key}.json")
+    with open(f"{state_path}.{os.getpid()}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, default=str)
+    os.replace(f"{state_path}.{os.getpid()}.tmp", state_path)
+
+    purge(current_app.config['INCREMENTAL_STATE_TTL_DAYS'])
+
+
+def purge(max_age_days):
+    """Удаляет состояния линий, которые не обновлялись max_age_days дней."""
+    state_dir = _state_dir()
+    threshold = time.time() - max_age_days * 86400
+    with os.scandir(state_dir) as it:
+        stale = [entry.name[:-len('.json')] for entry in it
+                 if entry.name.endswith('.json') and entry.stat().st_mtime < threshold]
+    for key in stale:
+        for name in (f"{key}.json", f"{key}.xlsx", f"{key}.xlsm", f"{key}.csv"):
+            try:
+                os.remove(os.path.join(state_dir, name))
+            except OSError:
+                pass
+        logger.debug("Состояние линии %s удалено как устаревшее", key[:12])
@@ -0,0 +1,216 @@
+# app/services/job_queue.py
+"""
+Очередь заданий обработки, переживающая перезапуск процессов.
+
+Задание (job) - запись в таблице SQLite: параметры задачи в JSON и
+состояние queued/running. Обработчик (см. services/job_worker.py) забирает
+задание с арендой (lease) на lease_seconds и продлевает ее сердцебиением,
+пока задача выполняется. Если обработчик упал, аренда истекает и задание
+возвращается в очередь (до max_attempts попыток). Выполненное задание
+удаляется: его итог хранится в task_statuses и журнале задач.
+
+Планирование (claim): задание не выдается, если выполняется уже
+max_running заданий или max_running_per_user заданий его владельца.
+Из остальных сначала берутся приоритетные (небольшие файлы), затем -
+по кругу: задание пользователя, который дольше всех не получал обработчик,
+чтобы один пользователь с десятками файлов не занимал очередь целиком.
+"""
+import json
+import os
+import threading
+import time
+
+from app.utils.sqlite import SQLiteFile
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+_JOB_COLUMNS = ("job.id, job.owner_id, job.payload, job.state, job.attempts, job.worker_id, job.created_at, "
+                "job.cancel_requested")
+
+
+class SQLiteJobQueue:
+    def __init__(self, path, busy_timeout_ms=5000):
+        self.path = path
+        self._db = SQLiteFile(path, busy_timeout_ms)
+        with self._db.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS job ("
+                         "id TEXT PRIMARY KEY, owner_id TEXT, payload TEXT NOT NULL, state TEXT NOT NULL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, worker_id TEXT, lease_expires REAL, "
+                         "heartbeat_at REAL, created_at REAL NOT NULL)")
+            # Колонки, добавленные после первой версии очереди
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(job)")}
+            if 'priority' not in columns:
+                conn.execute("ALTER TABLE job ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+            if 'cancel_requested' not in columns:
+                conn.execute("ALTER TABLE job ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_job_state_created_at ON job (state, created_at)")
+            # Когда пользователь последний раз получил обработчик (очередность по кругу)
+            conn.execute("CREATE TABLE IF NOT EXISTS job_owner_turn ("
+                         "owner_key TEXT PRIMARY KEY, last_claimed_at REAL NOT NULL)")
+
+    @staticmethod
+    def _row_to_job(row):
+        job_id, owner_id, payload, state, attempts, worker_id, created_at, cancel_requested = row
+        return {'id': job_id, 'owner_id': owner_id, 'payload': json.loads(payload), 'state': state,
+                'attempts': attempts, 'worker_id': worker_id, 'created_at': created_at,
+                'cancel_requested': bool(cancel_requested)}
+
+    def enqueue(self, job_id, owner_id, payload, priority=PRIORITY_NORMAL):
+        with self._db.transaction() as conn:
+            conn.execute("INSERT INTO job (id, owner_id, payload, state, priority, created_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (job_id, owner_id, json.dumps(payload, ensure_ascii=False), STATE_QUEUED, priority,
+                          time.time()))
+
+    def claim(self, worker_id, lease_seconds, max_running=0, max_running_per_user=0):
+        """
+        Забирает следующее задание по правилам планирования (см. описание
+        модуля; 0 - без ограничения). Возвращает задание или None.
+        """
+        now = time.time()
+        with self._db.transaction() as conn:
+            running = dict(conn.execute("SELECT COALESCE(owner_id, ''), COUNT(*) FROM job WHERE state = ? "
+                                        "GROUP BY COALESCE(owner_id, '')", (STATE_RUNNING,)).fetchall())
+            if max_running and sum(running.values()) >= max_running:
+                return None
+            busy_owners = [owner for owner, count in running.items()
+                           if max_running_per_user and count >= max_running_per_user]
+            exclude = ''
+            if busy_owners:
+                exclude = f"AND COALESCE(job.owner_id, '') NOT IN ({', '.join('?' * len(busy_owners))}) "
+            row = conn.execute(
+                f"SELECT {_JOB_COLUMNS} FROM job "
+                "LEFT JOIN job_owner_turn turn ON turn.owner_key = COALESCE(job.owner_id, '') "
+                f"WHERE job.state = ? {exclude}"
+                "ORDER BY job.priority DESC, COALESCE(turn.last_claimed_at, 0), job.created_at LIMIT 1",
+                (STATE_QUEUED, *busy_owners)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE job SET state = ?, worker_id = ?, attempts = attempts + 1, lease_expires = ?, "
+                         "heartbeat_at = ? WHERE id = ?", (STATE_RUNNING, worker_id, now + lease_seconds, now, row[0]))
+            conn.execute("INSERT OR REPLACE INTO job_owner_turn (owner_key, last_claimed_at) VALUES (?, ?)",
+                         (row[1] or '', now))
+        job = self._row_to_job(row)
+        job.update(state=STATE_RUNNING, worker_id=worker_id, attempts=job['attempts'] + 1)
+        return job
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        """Продлевает аренду. False - задание больше не принадлежит этому обработчику."""
+        now = time.time()
+        with self._db.transaction() as conn:
+            cursor = conn.execute("UPDATE job SET lease_expires = ?, heartbeat_at = ? "
+                                  "WHERE id = ? AND worker_id = ? AND state = ?",
+                                  (now + lease_seconds, now, job_id, worker_id, STATE_RUNNING))
+            return cursor.rowcount > 0
+
+    def complete(self, job_id, worker_id):
+        """Удаляет выполненное задание (если аренду не перехватил другой обработчик)."""
+        with self._db.transaction() as conn:
+            cursor = conn.execute("DELETE FROM job WHERE id = ? AND worker_id = ?", (job_id, worker_id))
+            return cursor.rowcount > 0
+
+    def cancel(self, job_id):
+        """
+        Отмена задания. Ожидающее задание удаляется из очереди, у
+        выполняющегося устанавливается флаг cancel_requested (обработчик
+        проверяет его между блоками строк). Возвращает задание в состоянии
+        до отмены или None, если его нет в очереди.
+        """
+        with self._db.transaction() as conn:
+            row = conn.execute(f"SELECT {_JOB_COLUMNS} FROM job WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = self._row_to_job(row)
+            if job['state'] == STATE_QUEUED:
+                conn.execute("DELETE FROM job WHERE id = ?", (job_id,))
+            else:
+                conn.execute("UPDATE job SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        return job
+
+    def is_cancel_requested(self, job_id):
+        row = self._db.connection().execute("SELECT cancel_requested FROM job WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def recover_expired(self, max_attempts):
+        """
+        Задания с истекшей арендой (обработчик упал или завис): возвращаются
+        в очередь, а исчерпавшие max_attempts попыток и отмененные удаляются.
+        Возвращает (вернувшиеся в очередь, удаленные) - списки заданий.
+        """
+        now = time.time()
+        with self._db.transaction() as conn:
+            rows = conn.execute(f"SELECT {_JOB_COLUMNS} FROM job WHERE state = ? AND lease_expires < ?",
+                                (STATE_RUNNING, now)).fetchall()
+            requeued, failed = [], []
+            for row in rows:
+                job = self._row_to_job(row)
+                if job['attempts'] >= max_attempts or job['cancel_requested']:
+                    conn.execute("DELETE FROM job WHERE id = ?", (job['id'],))
+                    failed.append(job)
+                else:
+                    conn.execute("UPDATE job SET state = ?, worker_id = NULL, lease_expires = NULL WHERE id = ?",
+                                 (STATE_QUEUED, job['id']))
+                    requeued.append(job)
+        return requeued, failed
+
+    def stats(self):
+        """Число заданий по состояниям."""
+        rows = self._db.connection().execute("SELECT state, COUNT(*) FROM job GROUP BY state").fetchall()
+        counts = {STATE_QUEUED: 0, STATE_RUNNING: 0}
+        counts.update(rows)
+        return counts
+
+
+class JobQueue:
+    """
+    Расширение Flask: общий объект job_queue (app.extensions).
+    Очередь SQLite создается в init_app (JOB_QUEUE_PATH).
+    Обработчики в том же процессе будятся сразу при постановке задания,
+    остальные опрашивают очередь раз в JOB_POLL_INTERVAL секунд.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self._wakeup = threading.Event()
+
+    def init_app(self, app):
+        path = app.config.get('JOB_QUEUE_PATH') or os.path.join(app.config['UPLOAD_FOLDER'], 'jobs', 'queue.db')
+        self.backend = SQLiteJobQueue(path, busy_timeout_ms=app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+        app.extensions['job_queue'] = self
+
+    def enqueue(self, job_id, owner_id, payload, priority=PRIORITY_NORMAL):
+        self.backend.enqueue(job_id, owner_id, payload, priority)
+        self._wakeup.set()
+
+    def claim(self, worker_id, lease_seconds, max_running=0, max_running_per_user=0):
+        return self.backend.claim(worker_id, lease_seconds, max_running, max_running_per_user)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        return self.backend.heartbeat(job_id, worker_id, lease_seconds)
+
+    def complete(self, job_id, worker_id):
+        completed = self.backend.complete(job_id, worker_id)
+        # Освободилось место: задания, ждавшие из-за ограничений, можно выдать
+        self._wakeup.set()
+        return completed
+
+    def cancel(self, job_id):
+        return self.backend.cancel(job_id)
+
+    def is_cancel_requested(self, job_id):
+        return self.backend.is_cancel_requested(job_id)
+
+    def recover_expired(self, max_attempts):
+        return self.backend.recover_expired(max_attempts)
+
+    def stats(self):
+        return self.backend.stats()
+
+    def wait(self, timeout):
+        """Ждет постановки задания в этом процессе (или timeout секунд)."""
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
@@ -0,0 +1,269 @@
+# app/services/job_worker.py
+"""
+Постановка задач обработки в очередь (services/job_queue.py) и их выполнение.
+
+Файлы задачи (источник и шаблон) сохраняются в UPLOAD_FOLDER/jobs/<task_id>,
+поэтому задание можно выполнить в любом процессе: в обработчиках внутри
+веб-процесса (JOB_QUEUE_WEB_WORKERS) или в отдельных процессах
+
+    flask --app manage.py worker --threads 2
+
+Папка задачи удаляется после выполнения; если обработчик упал, она остается
+для повторной попытки.
+"""
+import logging
+import os
+import shutil
+import signal
+import socket
+import threading
+
+from app.extensions import job_queue, task_statuses
+from app.services import incremental_service, logging_service, result_cache, warning_report
+from app.services.excel_processor import process_excel_hybrid, CANCELLED_STATUS
+from app.services.job_queue import PRIORITY_HIGH, PRIORITY_NORMAL, STATE_QUEUED
+from app.services.task_metrics import file_size
+
+logger = logging.getLogger(__name__)
+
+_web_workers_pid = None
+_web_workers_lock = threading.Lock()
+
+
+def _jobs_root(app):
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'jobs')
+
+
+def submit_processing_job(app, task_id, owner_id, source_file, settings, cache_key=None):
+    """
+    Сохраняет файлы задачи на диск и ставит задание в очередь.
+    source_file - файловый объект в памяти или путь к файлу на диске
+    (собранная загрузка по частям - файл перемещается в папку задачи).
+    Небольшие файлы (до JOB_SMALL_FILE_BYTES) получают приоритет.
+    cache_key - ключ кэша результатов (services/result_cache.py), под которым
+    сохраняется успешный результат.
+    settings['incremental'] - инкрементальный режим (services/incremental_service.py).
+    """
+    job_dir = os.path.join(_jobs_root(app), task_id)
+    os.makedirs(job_dir)
+    try:
+        source_path = os.path.join(job_dir, 'source.xlsx')
+        if isinstance(source_file, (str, os.PathLike)):
+            shutil.move(source_file, source_path)
+        else:
+            source_file.seek(0)
+            with open(source_path, 'wb') as f:
+                shutil.copyfileobj(source_file, f)
+
+        template_name = settings['original_template_filename'] or 'template.xlsx'
+        template_path = os.path.join(job_dir, 'template.xlsm' if template_name.lower().endswith('.xlsm')
+                                     else 'template.xlsx')
+        template_file = settings['template_file_in_memory']
+        template_file.seek(0)
+        with open(template_path, 'wb') as f:
+            shutil.copyfileobj(template_file, f)
+
+        payload = {key: value for key, value in settings.items() if key != 'template_file_in_memory'}
+        payload.update(source_path=source_path, template_path=template_path, result_cache_key=cache_key,
+                       incremental=incremental_service.lineage(owner_id, settings)
+                       if settings.get('incremental') else None)
+        is_small = file_size(source_path) <= app.config['JOB_SMALL_FILE_BYTES']
+        job_queue.enqueue(task_id, owner_id, payload, priority=PRIORITY_HIGH if is_small else PRIORITY_NORMAL)
+    except Exception:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+
+
+def run_job(app, job):
+    """Выполняет задание: process_excel_hybrid по сохраненным файлам и параметрам."""
+    payload = job['payload']
+    try:
+        process_excel_hybrid(
+            app, job['id'], payload['source_path'], payload['template_path'],
+            payload['ranges_settings'], payload['sheet_settings'], payload['template_rules'],
+            payload['post_function'], payload['original_template_filename'], task_statuses,
+            payload['cell_mappings'], payload['formula_rules'], payload['static_value_rules'],
+            payload['visible_rows_only'], payload['source_cell_fill_rules'],
+            cancel_check=lambda: job_queue.is_cancel_requested(job['id']),
+            incremental=payload.get('incremental')
+        )
+        if payload.get('result_cache_key'):
+            _store_in_cache(app, job['id'], payload['result_cache_key'])
+    finally:
+        shutil.rmtree(os.path.dirname(payload['source_path']), ignore_errors=True)
+
+
+def _store_in_cache(app, task_id, cache_key):
+    task = task_statuses.get(task_id)
+    if not task or not task.get('result_ready'):
+        return
+    result_file = task_statuses.open_result(task_id)
+    if result_file is None:
+        return
+    try:
+        with app.app_context(), result_file:
+            report_path = warning_report.report_path(task_id) if task.get('warnings_report') else None
+            result_cache.store(cache_key, result_file, {'template_filename': task.get('template_filename'),
+                                                        'warnings': task.get('warnings') or []},
+                               report_path=report_path)
+    except OSError:
+        logger.exception("Не удалось сохранить результат задачи %s в кэш", task_id)
+
+
+class _Heartbeat(threading.Thread):
+    """Продлевает аренду задания, пока оно выполняется."""
+
+    def __init__(self, job_id, worker_id, lease_seconds, interval):
+        super().__init__(name=f"heartbeat-{job_id[:8]}", daemon=True)
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not job_queue.heartbeat(self.job_id, self.worker_id, self.lease_seconds):
+                    logger.warning("Аренда задания %s потеряна: его забрал другой обработчик", self.job_id)
+                    return
+            except Exception:
+                logger.exception("Не удалось продлить аренду задания %s", self.job_id)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Worker:
+    """Обработчик очереди: забирает задания по одному и выполняет их."""
+
+    def __init__(self, app, name='0'):
+        self.app = app
+        self.name = name
+        config = app.config
+        self.poll_interval = config['JOB_POLL_INTERVAL']
+        self.lease_seconds = config['JOB_LEASE_SECONDS']
+        self.heartbeat_interval = config['JOB_HEARTBEAT_INTERVAL']
+        self.max_attempts = config['JOB_MAX_ATTEMPTS']
+        self.max_running = config['JOB_MAX_RUNNING']
+        self.max_running_per_user = config['JOB_MAX_RUNNING_PER_USER']
+
+    @property
+    def worker_id(self):
+        # Вычисляется при обращении: после fork у процесса другой pid
+        return f"{socket.gethostname()}:{os.getpid()}:{self.name}"
+
+    def run(self, stop_event, burst=False):
+        """Выполняет задания, пока не установлен stop_event (burst - до опустошения очереди)."""
+        logger.info("Обработчик очереди %s запущен", self.worker_id)
+        while not stop_event.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                logger.exception("Ошибка обработчика очереди %s", self.worker_id)
+            if burst:
+                break
+            job_queue.wait(self.poll_interval)
+        logger.info("Обработчик очереди %s остановлен", self.worker_id)
+
+    def run_once(self):
+        """Выполняет одно задание. Возвращает False, если очередь пуста."""
+        self.recover_expired()
+        worker_id = self.worker_id
+        job = job_queue.claim(worker_id, self.lease_seconds, self.max_running, self.max_running_per_user)
+        if job is None:
+            return False
+
+        logger.info("Задание %s взято в работу (попытка %s)", job['id'], job['attempts'])
+        heartbeat = _Heartbeat(job['id'], worker_id, self.lease_seconds, self.heartbeat_interval)
+        heartbeat.start()
+        try:
+            run_job(self.app, job)
+        finally:
+            heartbeat.stop()
+            job_queue.complete(job['id'], worker_id)
+        return True
+
+    def recover_expired(self):
+        """Возвращает в очередь задания упавших обработчиков, исчерпавшие попытки - завершает ошибкой."""
+        requeued, failed = job_queue.recover_expired(self.max_attempts)
+        for job in requeued:
+            logger.warning("Аренда задания %s истекла (обработчик %s), задание возвращено в очередь",
+                           job['id'], job['worker_id'])
+            task_statuses.update(job['id'], status='Обработчик остановлен, задача снова в очереди...', progress=0)
+        for job in failed:
+            self._fail_abandoned(job)
+
+    def _fail_abandoned(self, job):
+        if job['cancel_requested']:
+            status = CANCELLED_STATUS
+        else:
+            logger.error("Задание %s прервано %s раз и снято с очереди", job['id'], job['attempts'])
+            status = f"Ошибка: обработка прерывалась {job['attempts']} раз(а), задача снята с очереди"
+        _finish_unprocessed(self.app, job, status)
+
+
+def _finish_unprocessed(app, job, status):
+    """Итог задания, которое так и не было выполнено: статус задачи, журнал, удаление файлов."""
+    task_statuses.update(job['id'], status=status, progress=100, result_ready=False)
+    with app.app_context():
+        logging_service.log_task(job['id'], job['owner_id'], status, job['payload'].get('original_template_filename'))
+    shutil.rmtree(os.path.dirname(job['payload']['source_path']), ignore_errors=True)
+
+
+def cancel_job(app, task_id):
+    """
+    Отменяет задачу. Ожидающая в очереди снимается сразу, выполняющаяся
+    останавливается обработчиком на ближайшей границе блока строк.
+    Возвращает текущий статус задачи или None, если задача уже завершена.
+    """
+    job = job_queue.cancel(task_id)
+    if job is None:
+        return None
+    if job['state'] == STATE_QUEUED:
+        logger.info("Задача %s отменена до начала обработки", task_id)
+        _finish_unprocessed(app, job, CANCELLED_STATUS)
+        return CANCELLED_STATUS
+    logger.info("Запрошена отмена выполняющейся задачи %s", task_id)
+    return 'Отмена...'
+
+
+def start_web_workers(app):
+    """
+    Запускает JOB_QUEUE_WEB_WORKERS обработчиков в текущем процессе (один
+    раз на процесс; вызывается перед запросами, поэтому после перезапуска
+    веб-процесса оставшиеся в очереди задания подхватываются с первым запросом).
+    """
+    global _web_workers_pid
+    if _web_workers_pid == os.getpid():
+        return
+    with _web_workers_lock:
+        if _web_workers_pid == os.getpid():
+            return
+        _web_workers_pid = os.getpid()
+        stop_event = threading.Event()
+        for i in range(app.config['JOB_QUEUE_WEB_WORKERS']):
+            worker = Worker(app, name=f"web-{i}")
+            threading.Thread(target=worker.run, args=(stop_event,), name=f"job-worker-{i}", daemon=True).start()
+
+
+def run_workers(app, threads=1, burst=False):
+    """Отдельный процесс-обработчик (manage.py worker). SIGTERM/Ctrl+C - остановка после текущих заданий."""
+    stop_event = threading.Event()
+
+    def stop(signum, frame):
+        logger.info("Получен сигнал %s, обработчики завершают текущие задания", signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    workers = [threading.Thread(target=Worker(app, name=str(i)).run, args=(stop_event, burst),
+                                name=f"job-worker-{i}") for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        while thread.is_alive():
+            thread.join(timeout=1)
@@ -1,40 +1,209 @@
 # app/services/logging_service.py
 import datetime
+import logging
+from flask import current_app
+from sqlalchemy import func
 from app.extensions import db
-from app.models import TaskLog
+from app.models import TaskLog, TaskStageTiming
+from app.services.task_log_writer import TaskLogWriter, register_flush_at_exit
 
+logger = logging.getLogger(__name__)
 
-# Lock больше не нужен, DB управляет этим.
 
-def load_logs():
-    """Загружает все логи задач из DB."""
-    # Загружаем логи, сортируя по дате (сначала новые)
-    # .options(joinedload('owner')) - оптимизация, сразу грузит пользователя
-    from sqlalchemy.orm import joinedload
-    return TaskLog.query.options(joinedload(TaskLog.owner)).order_by(TaskLog.timestamp.desc()).all()
+# Значения TaskLog.status_kind
+STATUS_SUCCESS = 'success'
+STATUS_ERROR = 'error'
+STATUS_CANCELLED = 'cancelled'
 
 
-def log_task(task_id, owner_id, status, template_name):
+def get_status_kind(status):
+    """
+    Вид статуса задачи: ошибкой считается статус, содержащий 'Ошибка',
+    отменой - начинающийся с 'Отменено'.
+    """
+    if status and "Ошибка" in status:
+        return STATUS_ERROR
+    if status and status.startswith("Отменено"):
+        return STATUS_CANCELLED
+    return STATUS_SUCCESS
+
+
+def _filter_by_date(query, date_from=None, date_to=None):
+    """Ограничивает запрос диапазоном дат [date_from, date_to] (обе границы - datetime.date, включительно)."""
+    if date_from:
+        query = query.filter(TaskLog.timestamp >= datetime.datetime.combine(date_from, datetime.time.min))
+    if date_to:
+        query = query.filter(TaskLog.timestamp < datetime.datetime.combine(date_to + datetime.timedelta(days=1),
+                                                                           datetime.time.min))
+    return query
+
+
+def get_task_counts_by_owner(date_from=None, date_to=None):
+    """
+    Количество задач по пользователям одним сгруппированным запросом:
+    {owner_id: {'tasks_run': ..., 'tasks_success': ..., 'tasks_error': ...}}.
+    """
+    query = db.session.query(TaskLog.owner_id, TaskLog.status_kind, func.count(TaskLog.id))
+    query = _filter_by_date(query, date_from, date_to).group_by(TaskLog.owner_id, TaskLog.status_kind)
+    counts = {}
+    for owner_id, status_kind, count in query:
+        owner_counts = counts.setdefault(owner_id, {'tasks_run': 0, 'tasks_success': 0, 'tasks_error': 0})
+        owner_counts['tasks_run'] += count
+        if status_kind == STATUS_ERROR:
+            owner_counts['tasks_error'] += count
+        elif status_kind != STATUS_CANCELLED:
+            owner_counts['tasks_success'] += count
+    return counts
+
+
+def get_recent_tasks(owner_id, limit=10, date_from=None, date_to=None):
+    """Последние задачи пользователя (по индексу owner_id + timestamp)."""
+    query = _filter_by_date(TaskLog.query.filter(TaskLog.owner_id == owner_id), date_from, date_to)
+    return query.order_by(TaskLog.timestamp.desc()).limit(limit).all()
+
+
+def get_task_log_page(owner_id, page=1, per_page=50, date_from=None, date_to=None):
+    """Страница журнала задач пользователя (flask_sqlalchemy Pagination), сначала новые."""
+    query = _filter_by_date(TaskLog.query.filter(TaskLog.owner_id == owner_id), date_from, date_to)
+    return query.order_by(TaskLog.timestamp.desc()).paginate(page=page, per_page=per_page, error_out=False)
+
+
+def _make_task_log(record):
+    """TaskLog (со временем этапов) из записи, поставленной log_task."""
+    stages = record.pop('stages', {})
+    entry = TaskLog(**record)
+    entry.stages = [TaskStageTiming(stage=stage, seconds=seconds) for stage, seconds in stages.items()]
+    return entry
+
+
+def _write_task_logs(app, records):
+    """Сохраняет пачку записей журнала одним commit (вызывается потоком-писателем)."""
+    with app.app_context():
+        try:
+            db.session.add_all([_make_task_log(dict(record)) for record in records])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+
+_writer = TaskLogWriter(_write_task_logs)
+register_flush_at_exit(_writer)
+
+
+def configure_writer(app):
+    """Размер пачки и интервал записи журнала из конфигурации."""
+    _writer.batch_size = app.config.get('TASK_LOG_BATCH_SIZE', _writer.batch_size)
+    _writer.flush_interval = app.config.get('TASK_LOG_FLUSH_INTERVAL', _writer.flush_interval)
+
+
+def flush_task_logs(timeout=None):
+    """Дожидается записи всех поставленных в очередь записей журнала."""
+    return _writer.flush(timeout)
+
+
+def pending_task_logs():
+    """Число записей журнала, ожидающих записи в DB."""
+    return _writer.qsize()
+
+
+def log_task(task_id, owner_id, status, template_name, metrics=None):
     """
     Добавляет запись о завершенной задаче в лог DB.
+    metrics - результат StageTimer.as_dict(): время этапов, строки, байты, RSS.
+
+    При TASK_LOG_ASYNC (по умолчанию) запись только ставится в очередь,
+    а сохраняет ее фоновый поток пачками (см. services/task_log_writer.py).
 
     ВАЖНО: Эта функция должна вызываться ИЗНУТРИ
-    Flask app_context(), так как она использует db.session.
+    Flask app_context(): из него берется приложение для записи.
     """
+    record = {
+        'task_uuid': task_id,
+        'owner_id': owner_id,
+        'template_name': template_name,
+        'status': status,
+        'status_kind': get_status_kind(status),
+        'timestamp': datetime.datetime.now()
+    }
+    if metrics:
+        counters = metrics.get('counters', {})
+        record.update({
+            'duration': metrics.get('duration'),
+            'source_rows': counters.get('source_rows'),
+            'target_rows': counters.get('rows_written'),
+            'input_bytes': counters.get('source_bytes', 0) + counters.get('template_bytes', 0),
+            'output_bytes': counters.get('result_bytes'),
+            'peak_rss_bytes': metrics.get('peak_rss') or None,
+            'stages': dict(metrics.get('stages', {}))
+        })
 
-    new_log_entry = TaskLog(
-        task_uuid=task_id,
-        owner_id=owner_id,
-        template_name=template_name,
-        status=status,
-        timestamp=datetime.datetime.now()
-    )
+    app = current_app._get_current_object()
+    if app.config.get('TASK_LOG_ASYNC', True):
+        _writer.submit(app, record)
+        return
 
     try:
-        db.session.add(new_log_entry)
+        db.session.add(_make_task_log(record))
         db.session.commit()
     except Exception as e:
         db.session.rollback()
-        # Мы не можем использовать current_app.logger, т.к. можем быть в потоке
-        # без контекста. Просто выводим в stdout.
-        print(f"[logging_service] Ошибка записи в DB: {e}")
\ No newline at end of file
+        # Логгер модуля работает и в потоке без контекста приложения
+        logger.error("Ошибка записи в DB: %s", e)
+
+
+def get_slowest_templates(limit=10, date_from=None, date_to=None):
+    """
+    Шаблоны с наибольшим средним временем обработки (только задачи с метриками).
+    Возвращает список словарей: шаблон, число запусков, среднее и максимальное
+    время, средние строки и объем входных файлов, максимальный RSS.
+    """
+    query = db.session.query(
+        TaskLog.template_name,
+        func.count(TaskLog.id),
+        func.avg(TaskLog.duration),
+        func.max(TaskLog.duration),
+        func.avg(TaskLog.target_rows),
+        func.avg(TaskLog.input_bytes),
+        func.max(TaskLog.peak_rss_bytes)
+    ).filter(TaskLog.duration.isnot(None))
+    rows = _filter_by_date(query, date_from, date_to) \
+        .group_by(TaskLog.template_name) \
+        .order_by(func.avg(TaskLog.duration).desc()) \
+        .limit(limit).all()
+    return [{
+        'template_name': template_name,
+        'runs': runs,
+        'avg_duration': avg_duration or 0,
+        'max_duration': max_duration or 0,
+        'avg_rows': avg_rows or 0,
+        'avg_input_bytes': avg_input_bytes or 0,
+        'max_rss_bytes': max_rss_bytes or 0
+    } for template_name, runs, avg_duration, max_duration, avg_rows, avg_input_bytes, max_rss_bytes in rows]
+
+
+def get_stage_breakdown(date_from=None, date_to=None):
+    """
+    Суммарное и среднее время по этапам обработки для всех задач с метриками,
+    этапы отсортированы по суммарному времени. share - доля этапа в общем времени.
+    """
+    query = db.session.query(
+        TaskStageTiming.stage,
+        func.sum(TaskStageTiming.seconds),
+        func.avg(TaskStageTiming.seconds),
+        func.count(TaskStageTiming.id)
+    )
+    if date_from or date_to:
+        query = _filter_by_date(query.join(TaskLog, TaskStageTiming.task_log_id == TaskLog.id), date_from, date_to)
+    rows = query.group_by(TaskStageTiming.stage) \
+        .order_by(func.sum(TaskStageTiming.seconds).desc()).all()
+    grand_total = sum(total or 0 for _, total, _, _ in rows)
+    return [{
+        'stage': stage,
+        'total': total or 0,
+        'average': average or 0,
+        'runs': runs,
+        'share': (total or 0) / grand_total if grand_total else 0
+    } for stage, total, average, runs in rows]
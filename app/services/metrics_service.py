@@ -0,0 +1,189 @@
+# app/services/metrics_service.py
+"""
+Метрики процесса для /metrics (текстовый формат Prometheus).
+
+Счетчики и гистограммы обновляются по месту событий (постановка задачи,
+завершение, отправка события Socket.IO) и хранятся в памяти процесса.
+Значения, которые можно вычислить из состояния (хранилище задач, индекс
+геокодера, RSS), считаются только в момент запроса, поэтому запрос
+метрик не зависит от числа обработанных задач.
+"""
+import time
+from threading import Lock
+
+from app.services.task_metrics import current_rss
+
+# Границы корзин гистограмм времени (секунды)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Окно, по которому считается число событий Socket.IO в секунду
+EVENT_RATE_WINDOW = 60
+
+
+class _Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def copy(self):
+        histogram = _Histogram()
+        histogram.counts, histogram.total, histogram.count = list(self.counts), self.total, self.count
+        return histogram
+
+
+class _EventRate:
+    """Число событий за последние EVENT_RATE_WINDOW секунд (кольцо секундных корзин)."""
+
+    def __init__(self):
+        self.seconds = [0] * EVENT_RATE_WINDOW
+        self.counts = [0] * EVENT_RATE_WINDOW
+
+    def add(self, now):
+        second = int(now)
+        slot = second % EVENT_RATE_WINDOW
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+
+    def per_second(self, now):
+        oldest = int(now) - EVENT_RATE_WINDOW
+        return sum(c for s, c in zip(self.seconds, self.counts) if s > oldest) / EVENT_RATE_WINDOW
+
+
+_lock = Lock()
+_tasks_queued = 0
+_tasks_running = 0
+_tasks_finished = {'success': 0, 'error': 0}
+_task_duration = _Histogram()
+_stage_latency = {}
+_socketio_events = {}
+_socketio_rate = _EventRate()
+
+
+def task_queued():
+    global _tasks_queued
+    with _lock:
+        _tasks_queued += 1
+
+
+def task_started():
+    global _tasks_queued, _tasks_running
+    with _lock:
+        _tasks_queued = max(0, _tasks_queued - 1)
+        _tasks_running += 1
+
+
+def task_finished(success, metrics=None):
+    """Учитывает завершенную задачу; metrics - StageTimer.as_dict()."""
+    global _tasks_running
+    with _lock:
+        _tasks_running = max(0, _tasks_running - 1)
+        _tasks_finished['success' if success else 'error'] += 1
+        if metrics:
+            _task_duration.observe(metrics.get('duration', 0))
+            for stage, seconds in metrics.get('stages', {}).items():
+                histogram = _stage_latency.get(stage)
+                if histogram is None:
+                    histogram = _stage_latency[stage] = _Histogram()
+                histogram.observe(seconds)
+
+
+def socketio_event(event):
+    now = time.time()
+    with _lock:
+        _socketio_events[event] = _socketio_events.get(event, 0) + 1
+        _socketio_rate.add(now)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name, histogram, labels=''):
+    lines = []
+    cumulative = 0
+    prefix = f"{labels}," if labels else ''
+    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    suffix = f"{{{labels}}}" if labels else ''
+    lines.append(f"{name}_sum{suffix} {histogram.total:.6f}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
+
+
+def render(task_statuses, address_service=None, pending_task_logs=0, job_stats=None):
+    """Текст метрик в формате Prometheus."""
+    now = time.time()
+    with _lock:
+        queued, running = _tasks_queued, _tasks_running
+        finished = dict(_tasks_finished)
+        task_duration = _task_duration.copy()
+        stages = {stage: histogram.copy() for stage, histogram in _stage_latency.items()}
+        events = dict(_socketio_events)
+        events_per_second = _socketio_rate.per_second(now)
+    store_stats = task_statuses.stats()
+
+    lines = [
+        '# HELP excel_tasks Задачи обработки по состоянию.',
+        '# TYPE excel_tasks gauge',
+        f'excel_tasks{{state="queued"}} {queued}',
+        f'excel_tasks{{state="running"}} {running}',
+        '# HELP excel_tasks_finished_total Завершенные задачи.',
+        '# TYPE excel_tasks_finished_total counter',
+    ]
+    lines += [f'excel_tasks_finished_total{{result="{result}"}} {count}' for result, count in finished.items()]
+
+    lines += ['# HELP excel_task_duration_seconds Полное время задачи.',
+              '# TYPE excel_task_duration_seconds histogram']
+    lines += _histogram_lines('excel_task_duration_seconds', task_duration)
+    lines += ['# HELP excel_stage_duration_seconds Время этапов обработки.',
+              '# TYPE excel_stage_duration_seconds histogram']
+    for stage, histogram in stages.items():
+        lines += _histogram_lines('excel_stage_duration_seconds', histogram, f'stage="{_escape(stage)}"')
+
+    lines += ['# HELP socketio_events_total Отправленные события Socket.IO.',
+              '# TYPE socketio_events_total counter']
+    lines += [f'socketio_events_total{{event="{_escape(event)}"}} {count}' for event, count in events.items()]
+    lines += [f'# HELP socketio_events_per_second События Socket.IO в секунду (среднее за {EVENT_RATE_WINDOW} с).',
+              '# TYPE socketio_events_per_second gauge',
+              f'socketio_events_per_second {events_per_second:.3f}']
+
+    lines += ['# HELP task_statuses_size Записей в task_statuses.',
+              '# TYPE task_statuses_size gauge',
+              f'task_statuses_size {store_stats["tasks"]}',
+              '# HELP result_store_bytes Размер сохраненных результатов задач.',
+              '# TYPE result_store_bytes gauge',
+              f'result_store_bytes {store_stats["result_bytes"]}',
+              '# HELP task_log_pending Записей журнала задач, ожидающих записи в DB.',
+              '# TYPE task_log_pending gauge',
+              f'task_log_pending {pending_task_logs}']
+
+    if job_stats is not None:
+        lines += ['# HELP excel_jobs Задания в общей очереди (все процессы).',
+                  '# TYPE excel_jobs gauge']
+        lines += [f'excel_jobs{{state="{state}"}} {count}' for state, count in job_stats.items()]
+
+    if address_service is not None:
+        # Индекс не загружается ради метрик: до первого запроса геокодинга он пустой
+        lines += ['# HELP geocoder_addresses Адресов в индексе геокодера.',
+                  '# TYPE geocoder_addresses gauge',
+                  f'geocoder_addresses {len(address_service)}']
+
+    lines += ['# HELP process_resident_memory_bytes RSS процесса.',
+              '# TYPE process_resident_memory_bytes gauge',
+              f'process_resident_memory_bytes {current_rss()}']
+    return '\n'.join(lines) + '\n'
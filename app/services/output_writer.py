@@ -0,0 +1,256 @@
+# app/services/output_writer.py
+"""
+Потоковая запись результата (STREAMING_OUTPUT).
+
+Раньше строки данных записывались в ячейки листа шаблона, и template_wb.save
+строил XML из всех ячеек в памяти: на пике в памяти были источник, весь
+заполненный шаблон и байты результата. Теперь строки области данных по мере
+заполнения (excel_processor.execute_plan) переводятся в XML <row> и
+дописываются во временный файл на диске, а ячейки в лист не попадают.
+При сохранении шаблон (заголовки, стили, строки вне области данных, все
+остальные части книги) сохраняется openpyxl как обычно, а в XML листа
+между строками до и после области данных вставляются записанные строки.
+Гиперссылки строк данных так же копятся во временных файлах и
+вставляются в <hyperlinks> листа и в его связи (.rels).
+
+Ячейки шаблона в области данных (форматирование, заранее заполненные
+значения) объединяются со значениями строки, как при записи в лист. Листы,
+у которых в области данных есть ячейки с комментариями или гиперссылками
+шаблона, записываются по-прежнему через лист (sheet() возвращает None).
+"""
+import logging
+import re
+import shutil
+import tempfile
+import zipfile
+from copy import copy
+
+from openpyxl.cell import Cell
+from openpyxl.cell._writer import etree_write_cell
+from openpyxl.packaging.relationship import get_rels_path
+from openpyxl.utils.cell import get_column_letter, range_boundaries
+from openpyxl.xml.constants import REL_NS
+from openpyxl.xml.functions import Element, tostring
+
+logger = logging.getLogger(__name__)
+
+_HYPERLINK_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink'
+
+# Элементы листа, которые по схеме идут после <hyperlinks>: перед первым
+# из них вставляется <hyperlinks>, если в листе шаблона его не было
+_AFTER_HYPERLINKS = (b'<printOptions', b'<pageMargins', b'<pageSetup', b'<headerFooter', b'<rowBreaks',
+                     b'<colBreaks', b'<customProperties', b'<cellWatches', b'<ignoredErrors', b'<smartTags',
+                     b'<drawing', b'<legacyDrawing', b'<picture', b'<oleObjects', b'<controls',
+                     b'<webPublishItems', b'<tableParts', b'<extLst', b'</worksheet>')
+
+_ROW_START = re.compile(rb'<row\b[^>]*?\br="(\d+)"')
+_DIMENSION = re.compile(rb'<dimension ref="([^"]+)"\s*/>')
+
+_COPY_CHUNK = 1024 * 1024
+
+
+class _RowElement:
+    """Приемник etree_write_cell: ячейки добавляются в элемент <row>."""
+    __slots__ = ('write',)
+
+    def __init__(self, row):
+        self.write = row.append
+
+
+class SheetRowWriter:
+    """
+    Строки области данных одного листа (first_row..last_row) во временных
+    файлах: XML строк, гиперссылок и их связей.
+    """
+
+    def __init__(self, ws, first_row, last_row, temp_dir):
+        self.ws = ws
+        self.first_row = first_row
+        self.last_row = last_row
+        self.rows_file = tempfile.TemporaryFile(dir=temp_dir)
+        self.links_file = tempfile.TemporaryFile(dir=temp_dir)
+        self.rels_file = tempfile.TemporaryFile(dir=temp_dir)
+        self.links_count = 0
+        self.max_row = 0
+        self.max_col = 0
+        # Ячейки шаблона в области данных: {строка: [колонки]}
+        self.template_rows = {}
+        for row_idx, col_idx in ws._cells:
+            if first_row <= row_idx <= last_row:
+                self.template_rows.setdefault(row_idx, []).append(col_idx)
+        # Стиль "Hyperlink" - как у ячеек со ссылками при записи через лист
+        probe = Cell(ws)
+        probe.style = 'Hyperlink'
+        self.link_style = probe._style
+
+    @staticmethod
+    def can_stream(ws, first_row, last_row):
+        """False, если в области данных есть ячейки шаблона с комментариями или гиперссылками."""
+        for (row_idx, _), cell in ws._cells.items():
+            if first_row <= row_idx <= last_row and (cell.comment is not None or cell.hyperlink is not None):
+                return False
+        return True
+
+    def write_row(self, row_idx, values, links):
+        """Записывает строку: values/links - {колонка: значение}/{колонка: адрес ссылки}."""
+        ws = self.ws
+        cells = {col_idx: ws._cells.pop((row_idx, col_idx)) for col_idx in self.template_rows.pop(row_idx, ())}
+        for col_idx, value in values.items():
+            cell = cells.get(col_idx)
+            if cell is None:
+                cell = cells[col_idx] = Cell(ws, row=row_idx, column=col_idx)
+            cell.value = value
+        for col_idx, target in links.items():
+            cell = cells.get(col_idx)
+            if cell is None:
+                cell = cells[col_idx] = Cell(ws, row=row_idx, column=col_idx)
+            cell._style = copy(self.link_style)
+            # У внутренних ссылок источника (только location) target None:
+            # как и при записи через лист, остается только стиль
+            if target is not None:
+                self._write_link(cell.coordinate, target)
+
+        # Высота, скрытость строки шаблона и т.п. - в атрибутах <row>
+        dimension = ws.row_dimensions.pop(row_idx, None)
+        if not cells and dimension is None:
+            return
+        attributes = {'r': str(row_idx)}
+        if dimension is not None:
+            attributes.update(dimension)
+        row = Element('row', attributes)
+        receiver = _RowElement(row)
+        for col_idx in sorted(cells):
+            cell = cells[col_idx]
+            if cell._value is None and not cell.has_style:
+                continue
+            etree_write_cell(receiver, ws, cell, cell.has_style)
+            self.max_col = max(self.max_col, col_idx)
+        self.rows_file.write(tostring(row))
+        self.max_row = row_idx
+
+    def _write_link(self, ref, target):
+        self.links_count += 1
+        rel_id = f"rIdStream{self.links_count}"
+        self.links_file.write(tostring(Element('hyperlink', {'ref': ref, f'{{{REL_NS}}}id': rel_id})))
+        self.rels_file.write(tostring(Element('Relationship', {
+            'Type': _HYPERLINK_REL_TYPE, 'Target': target, 'TargetMode': 'External', 'Id': rel_id})))
+
+    def close(self):
+        for f in (self.rows_file, self.links_file, self.rels_file):
+            f.close()
+
+
+def _copy_file(src, dst):
+    src.seek(0)
+    shutil.copyfileobj(src, dst, _COPY_CHUNK)
+
+
+class StreamingWorkbookWriter:
+    """
+    Потоковая запись книги-результата: sheet() - приемник строк области
+    данных листа, save() - книга шаблона со вставленными строками.
+    temp_dir - папка временных файлов (на диске, не tmpfs: файлы размером
+    с результат).
+    """
+
+    def __init__(self, workbook, temp_dir=None):
+        self.workbook = workbook
+        self.temp_dir = temp_dir
+        self.sheets = []
+
+    def sheet(self, ws, first_row, last_row):
+        """SheetRowWriter листа или None, если лист нужно заполнять через ячейки."""
+        if not SheetRowWriter.can_stream(ws, first_row, last_row):
+            logger.info("Лист '%s': в области данных есть комментарии или ссылки шаблона, "
+                        "запись без потоковой вставки", ws.title)
+            return None
+        writer = SheetRowWriter(ws, first_row, last_row, self.temp_dir)
+        self.sheets.append(writer)
+        return writer
+
+    def save(self, out_file):
+        """Сохраняет книгу в out_file (файловый объект) и удаляет временные файлы."""
+        try:
+            with tempfile.TemporaryFile(dir=self.temp_dir) as template_file:
+                self.workbook.save(template_file)
+                template_file.seek(0)
+                by_path = {writer.ws.path.lstrip('/'): writer for writer in self.sheets}
+                by_rels = {get_rels_path(path): writer for path, writer in by_path.items() if writer.links_count}
+                with zipfile.ZipFile(template_file) as zin, \
+                        zipfile.ZipFile(out_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zout:
+                    for info in zin.infolist():
+                        if info.filename in by_path:
+                            with zout.open(info.filename, 'w', force_zip64=True) as dst:
+                                self._splice_sheet(zin.read(info.filename), by_path[info.filename], dst)
+                        elif info.filename in by_rels:
+                            with zout.open(info.filename, 'w', force_zip64=True) as dst:
+                                self._splice_rels(zin.read(info.filename), by_rels.pop(info.filename), dst)
+                        else:
+                            zout.writestr(info, zin.read(info.filename))
+                    # Связей у листа шаблона не было - файл создается
+                    for rels_path, writer in by_rels.items():
+                        with zout.open(rels_path, 'w', force_zip64=True) as dst:
+                            self._splice_rels(None, writer, dst)
+        finally:
+            for writer in self.sheets:
+                writer.close()
+
+    @staticmethod
+    def _splice_sheet(xml, writer, dst):
+        """XML листа шаблона со строками writer внутри <sheetData> и ссылками в <hyperlinks>."""
+        if b'<sheetData/>' in xml:
+            xml = xml.replace(b'<sheetData/>', b'<sheetData></sheetData>', 1)
+        data_start = xml.index(b'<sheetData>') + len(b'<sheetData>')
+        data_end = xml.index(b'</sheetData>', data_start)
+        # Строки шаблона после области данных остаются после вставленных
+        insert_at = data_end
+        for match in _ROW_START.finditer(xml, data_start, data_end):
+            if int(match.group(1)) > writer.last_row:
+                insert_at = match.start()
+                break
+
+        head = xml[:insert_at]
+        if writer.max_row:
+            head = _DIMENSION.sub(lambda m: b'<dimension ref="%s"/>' % _extend_dimension(
+                m.group(1).decode(), writer.max_row, writer.max_col).encode(), head, count=1)
+        dst.write(head)
+        _copy_file(writer.rows_file, dst)
+        tail = xml[insert_at:]
+        if not writer.links_count:
+            dst.write(tail)
+            return
+
+        links_end = tail.find(b'</hyperlinks>')
+        if links_end >= 0:
+            dst.write(tail[:links_end])
+            _copy_file(writer.links_file, dst)
+            dst.write(tail[links_end:])
+            return
+        sheet_data_end = tail.index(b'</sheetData>')
+        insert_links_at = min(position for position in (tail.find(tag, sheet_data_end) for tag in _AFTER_HYPERLINKS)
+                              if position >= 0)
+        dst.write(tail[:insert_links_at])
+        dst.write(b'<hyperlinks>')
+        _copy_file(writer.links_file, dst)
+        dst.write(b'</hyperlinks>')
+        dst.write(tail[insert_links_at:])
+
+    @staticmethod
+    def _splice_rels(xml, writer, dst):
+        """Связи листа с добавленными связями гиперссылок writer."""
+        if xml is None:
+            xml = b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"></Relationships>'
+        elif xml.rstrip().endswith(b'/>') and b'</Relationships>' not in xml:
+            xml = xml.rstrip()[:-2] + b'></Relationships>'
+        end = xml.rindex(b'</Relationships>')
+        dst.write(xml[:end])
+        _copy_file(writer.rels_file, dst)
+        dst.write(xml[end:])
+
+
+def _extend_dimension(ref, max_row, max_col):
+    """Диапазон <dimension>, расширенный до строки max_row и колонки max_col."""
+    min_col, min_row, old_max_col, old_max_row = range_boundaries(ref if ':' in ref else f"{ref}:{ref}")
+    last_col = max(old_max_col or 1, max_col or 1)
+    last_row = max(old_max_row or 1, max_row)
+    return f"{get_column_letter(min_col or 1)}{min_row or 1}:{get_column_letter(last_col)}{last_row}"
@@ -0,0 +1,42 @@
+# app/services/prefork.py
+"""
+Режим pre-fork (gunicorn с preload_app, см. gunicorn.conf.py).
+
+Без него каждый воркер сам загружает индекс адресов геокодера
+(LocalAddressService: словари и cKDTree по addresses.csv) и описания
+сохраненных шаблонов, и память под них умножается на число воркеров.
+В режиме pre-fork мастер-процесс загружает их один раз до fork, а воркеры
+получают эти страницы памяти общими (копирование при записи).
+
+После загрузки вызывается gc.freeze(): объекты мастера переносятся в
+постоянное поколение сборщика мусора, и сборки в воркерах не обходят их
+(обход меняет заголовки объектов и копирует страницы). Счетчики ссылок
+объектов Python меняются при любом обращении, поэтому общими надолго
+остаются прежде всего большие буферы (массивы NumPy, cKDTree).
+"""
+import gc
+import logging
+
+from app.extensions import db
+from app.services import geocoding_service, template_plans
+
+logger = logging.getLogger(__name__)
+
+
+def preload(app):
+    """Загрузка в мастер-процессе перед fork воркеров."""
+    with app.app_context():
+        addresses = geocoding_service.preload_addresses()
+        templates = template_plans.preload()
+        # Соединения, открытые при загрузке, воркерам не передаются
+        db.engine.dispose()
+    gc.collect()
+    gc.freeze()
+    logger.info("Pre-fork: загружено адресов: %s, шаблонов: %s; объектов в постоянном поколении: %s",
+                addresses, templates, gc.get_freeze_count())
+
+
+def after_fork(app):
+    """В воркере сразу после fork: пул соединений SQLAlchemy мастера не используется."""
+    with app.app_context():
+        db.engine.dispose(close=False)
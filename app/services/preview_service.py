@@ -0,0 +1,147 @@
+# app/services/preview_service.py
+"""
+Предпросмотр обработки: первые N строк результата в JSON без постановки
+задачи в очередь (POST /preview).
+
+Из источника читаются только общие строки, стили и описание книги (без
+обхода листов, как при load_workbook(read_only=True), который ищет размеры
+листов без <dimension> по всему XML), и с каждого листа, на который
+ссылаются правила, - потоковым разбором (services/xlsx_reader.py) только
+строки заголовков и первые N строк данных (с visible_rows_only - N
+видимых), а также строки ячеек точечных правил.
+Из них собирается маленькая книга-источник, и к ней применяются все правила
+тем же планом, что и при обработке (excel_processor.fill_preview). Чтение
+останавливается по истечении PREVIEW_TIME_BUDGET секунд - тогда ответ
+помечается как неполный (truncated).
+"""
+import datetime
+import logging
+import time
+from decimal import Decimal
+
+from openpyxl import load_workbook
+from openpyxl.utils.cell import coordinate_from_string
+
+from app.services.excel_processor import fill_preview, get_sheet_settings_map
+from app.services.warning_report import WarningCollector
+from app.services.xlsx_reader import StreamedSheet, StreamedWorkbook, XlsxStreamReader
+
+logger = logging.getLogger(__name__)
+
+
+def _rows_to_read(source_sheetnames, settings, max_rows):
+    """
+    Что читать с каждого листа: {имя: (последняя нужная строка заголовков
+    и ячеек, число нужных строк данных после заголовков)}.
+    """
+    default_sheet = source_sheetnames[0]
+    sheet_settings_map = get_sheet_settings_map(settings['sheet_settings'])
+    needed = {}
+
+    def need(name, last_row, data_rows=0):
+        if name not in source_sheetnames:
+            return
+        prev_last_row, prev_data_rows = needed.get(name, (0, 0))
+        needed[name] = (max(prev_last_row, last_row), max(prev_data_rows, data_rows))
+
+    for rule in settings['template_rules']:
+        name = rule.get('source_sheet', default_sheet)
+        need(name, sheet_settings_map.get(name, 1), max_rows)
+    for rule in settings['formula_rules']:
+        name = rule.get('source_sheet')
+        if name in sheet_settings_map:
+            need(name, sheet_settings_map[name], max_rows)
+    for rule in settings['cell_mappings'] + settings['source_cell_fill_rules']:
+        try:
+            _, row = coordinate_from_string(rule.get('source_cell') or '')
+        except ValueError:
+            continue
+        need(rule.get('source_sheet', default_sheet), row)
+    return needed
+
+
+def read_source_head(source_file, settings, max_rows, deadline):
+    """
+    Книга с началом листов источника (см. _rows_to_read): все листы на
+    своих местах, непрочитанные - пустые. Возвращает (книга, {лист: прочитано
+    строк}, truncated - чтение прервано по времени).
+    """
+    sheets = []
+    rows_read = {}
+    truncated = False
+    with XlsxStreamReader(source_file) as reader:
+        needed = _rows_to_read(list(reader.sheet_paths), settings, max_rows)
+        sheet_settings_map = get_sheet_settings_map(settings['sheet_settings'])
+        for name in reader.sheet_paths:
+            head_ws = StreamedSheet(name)
+            sheets.append(head_ws)
+            if name not in needed or truncated:
+                continue
+            last_row, data_rows = needed[name]
+            rows_read[name], truncated = _read_sheet_head(
+                reader, head_ws, last_row, sheet_settings_map.get(name, 1), data_rows,
+                settings['visible_rows_only'], deadline)
+    return StreamedWorkbook(sheets), rows_read, truncated
+
+
+def _read_sheet_head(reader, head_ws, last_row, data_start, data_rows, visible_rows_only, deadline):
+    """
+    Копирует строки листа в head_ws, пока не прочитаны строки до last_row
+    и data_rows строк данных после data_start (с visible_rows_only - видимых).
+    """
+    rows_read, data_seen = 0, 0
+    for row_idx, values, hidden in reader.iter_rows(head_ws.title):
+        if row_idx > last_row and data_seen >= data_rows:
+            break
+        if time.monotonic() > deadline:
+            return rows_read, True
+        if values:
+            head_ws.rows[row_idx] = values
+        if hidden:
+            head_ws.hidden_rows.add(row_idx)
+        if row_idx > data_start and not (visible_rows_only and hidden):
+            data_seen += 1
+        rows_read = row_idx
+    return rows_read, False
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def build_preview(source_file, settings, max_rows, time_budget):
+    """
+    Предпросмотр: {'sheets': [{'name', 'header', 'rows'}], 'source_rows',
+    'truncated', 'warnings', 'elapsed_ms'}. settings - результат
+    main._collect_task_settings, max_rows - число строк данных.
+    """
+    started = time.monotonic()
+    source_wb, rows_read, truncated = read_source_head(source_file, settings, max_rows, started + time_budget)
+
+    settings['template_file_in_memory'].seek(0)
+    template_wb = load_workbook(filename=settings['template_file_in_memory'])
+    warnings = WarningCollector()  # Без отчета на диске: в ответе только сводка
+    plans = fill_preview(source_wb, template_wb, settings, warnings)
+
+    t_start_row = settings['ranges_settings'].get('t_start_row', 1)
+    sheet_names = [template_wb.active.title] + [name for name in plans if name != template_wb.active.title]
+    sheets = []
+    for name in sheet_names:
+        ws = template_wb[name]
+        plan = plans.get(name)
+        last_row = min(plan.last_row if plan else t_start_row, t_start_row + max_rows)
+        rows = [[_json_value(value) for value in row]
+                for row in ws.iter_rows(min_row=t_start_row, max_row=max(last_row, t_start_row),
+                                        max_col=ws.max_column, values_only=True)]
+        sheets.append({'name': name, 'header': rows[0] if rows else [], 'rows': rows[1:]})
+
+    elapsed_ms = round((time.monotonic() - started) * 1000)
+    logger.debug("Предпросмотр за %s мс, прочитано строк: %s", elapsed_ms, rows_read)
+    return {'sheets': sheets, 'source_rows': rows_read, 'truncated': truncated,
+            'warnings': warnings.summary(), 'elapsed_ms': elapsed_ms}
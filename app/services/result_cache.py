@@ -0,0 +1,180 @@
+# app/services/result_cache.py
+"""
+Кэш результатов обработки: повторный запуск того же источника с тем же
+шаблоном и правилами возвращает готовый файл без обработки.
+
+Ключ - SHA-256 от байтов источника, id шаблона, байтов файла-шаблона,
+правил (JSON) и версий справочников и адресов геокодера (размер и время
+изменения файлов). Результаты лежат в PROCESSED_FOLDER/result_cache:
+<ключ>.xlsx, <ключ>.json (предупреждения и имя шаблона) и <ключ>.csv
+(полный отчет о замечаниях, если они были). Время изменения
+файла результата обновляется при каждом попадании, и при превышении
+RESULT_CACHE_MAX_BYTES удаляются давно не использованные записи (LRU).
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# Меняется, если обработка начинает давать другой результат для тех же входных данных
+CACHE_FORMAT_VERSION = 2  # 2 - вместе с результатом хранится отчет о замечаниях
+
+_HASH_CHUNK = 1024 * 1024
+
+# Файлы записи; описание удаляется первым, чтобы lookup не нашел неполную запись
+_ENTRY_SUFFIXES = ('.json', '.xlsx', '.csv')
+
+
+def _cache_dir():
+    return os.path.join(current_app.config['PROCESSED_FOLDER'], 'result_cache')
+
+
+def _hash_file(digest, file_obj):
+    """Добавляет в digest содержимое файла: путь на диске или файловый объект в памяти."""
+    if isinstance(file_obj, (str, os.PathLike)):
+        with open(file_obj, 'rb') as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+                digest.update(chunk)
+    elif hasattr(file_obj, 'getbuffer'):
+        digest.update(file_obj.getbuffer())
+    else:
+        position = file_obj.tell()
+        file_obj.seek(0)
+        for chunk in iter(lambda: file_obj.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+        file_obj.seek(position)
+
+
+def _data_versions():
+    """Версии данных, от которых зависит результат: справочники и адреса геокодера."""
+    versions = {}
+    for key in ('COLUMN_DICTIONARY_FILE', 'VALUE_DICTIONARY_FILE', 'ADDRESS_CSV_FILE'):
+        try:
+            stat = os.stat(current_app.config[key])
+            versions[key] = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            versions[key] = None
+    return versions
+
+
+def settings_digest(settings):
+    """
+    SHA-256 параметров задачи без источника: id и байты шаблона, правила и
+    версии данных. Используется также инкрементальным режимом
+    (services/incremental_service.py), чтобы узнать, что правила не менялись.
+    """
+    template_digest = hashlib.sha256()
+    _hash_file(template_digest, settings['template_file_in_memory'])
+
+    rules = {key: value for key, value in settings.items() if key != 'template_file_in_memory'}
+    description = json.dumps({
+        'version': CACHE_FORMAT_VERSION,
+        'template_id': settings.get('template_id'),
+        'template': template_digest.hexdigest(),
+        'rules': rules,
+        'data': _data_versions(),
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def make_key(source_file, settings):
+    """Ключ кэша для задачи (settings - результат main._collect_task_settings)."""
+    source_digest = hashlib.sha256()
+    _hash_file(source_digest, source_file)
+    description = f"{source_digest.hexdigest()}:{settings_digest(settings)}"
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def lookup(key):
+    """
+    Путь к закэшированному результату и его описание ({'warnings',
+    'template_filename', 'report_path'} - путь к отчету о замечаниях или None)
+    или None. Отмечает запись как использованную.
+    """
+    result_path = os.path.join(_cache_dir(), f"{key}.xlsx")
+    report_path = os.path.join(_cache_dir(), f"{key}.csv")
+    try:
+        with open(os.path.join(_cache_dir(), f"{key}.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        os.utime(result_path)
+    except (OSError, ValueError):
+        return None
+    meta['report_path'] = report_path if meta.get('warnings_report') and os.path.exists(report_path) else None
+    return result_path, meta
+
+
+def store(key, result_file, meta, report_path=None):
+    """
+    Сохраняет результат (файловый объект), копию отчета о замечаниях
+    report_path (None - замечаний нет) и описание, затем ограничивает размер кэша.
+    """
+    cache_dir = _cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    result_path = os.path.join(cache_dir, f"{key}.xlsx")
+    tmp_path = f"{result_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(result_file, f)
+    os.replace(tmp_path, result_path)
+    if report_path is not None:
+        cached_report_path = os.path.join(cache_dir, f"{key}.csv")
+        shutil.copyfile(report_path, f"{cached_report_path}.{os.getpid()}.tmp")
+        os.replace(f"{cached_report_path}.{os.getpid()}.tmp", cached_report_path)
+    meta = dict(meta, warnings_report=report_path is not None)
+
+    # Описание пишется последним: lookup видит запись только целиком
+    meta_path = os.path.join(cache_dir, f"{key}.json")
+    with open(f"{meta_path}.{os.getpid()}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(f"{meta_path}.{os.getpid()}.tmp", meta_path)
+
+    evict(current_app.config['RESULT_CACHE_MAX_BYTES'])
+
+
+def evict(max_bytes):
+    """
+    Удаляет давно не использованные записи, пока кэш больше max_bytes.
+    Размер записи - результат вместе с отчетом о замечаниях и описанием;
+    отчеты и описания без результата (запись удалена не до конца)
+    удаляются сразу.
+    """
+    cache_dir = _cache_dir()
+    used = {}    # {ключ: время использования результата}
+    sizes = {}   # {ключ: размер всех файлов записи}
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            key, suffix = os.path.splitext(entry.name)
+            if suffix not in _ENTRY_SUFFIXES:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            sizes[key] = sizes.get(key, 0) + stat.st_size
+            if suffix == '.xlsx':
+                used[key] = stat.st_mtime
+
+    for key in sizes.keys() - used.keys():
+        _remove_entry(cache_dir, key)
+    total = sum(sizes[key] for key in used)
+    if total <= max_bytes:
+        return
+
+    for _, key in sorted((mtime, key) for key, mtime in used.items()):
+        if total <= max_bytes:
+            break
+        _remove_entry(cache_dir, key)
+        total -= sizes[key]
+        logger.debug("Результат %s удален из кэша", key)
+
+
+def _remove_entry(cache_dir, key):
+    for suffix in _ENTRY_SUFFIXES:
+        try:
+            os.remove(os.path.join(cache_dir, key + suffix))
+        except OSError:
+            pass
@@ -0,0 +1,129 @@
+# app/services/source_cache.py
+import numpy as np
+
+# Целые, которые помещаются в int64 без потерь
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class _Column:
+    """
+    Одна колонка листа-источника в компактном виде.
+    Числовые колонки хранятся в NumPy-массиве (int64/float64) с маской пустых ячеек,
+    остальные - в object-массиве. Гиперссылки хранятся отдельно и только для
+    тех строк, где они есть.
+    """
+    __slots__ = ('data', 'empty', 'to_python', 'hyperlinks')
+
+    def __init__(self, values, hyperlinks):
+        self.hyperlinks = hyperlinks
+        self.empty = None
+        self.to_python = None
+
+        kind = _numeric_kind(values)
+        if kind is None:
+            self.data = np.empty(len(values), dtype=object)
+            self.data[:] = values
+            return
+
+        dtype, self.to_python = (np.int64, int) if kind is int else (np.float64, float)
+        self.empty = np.fromiter((v is None for v in values), dtype=np.bool_, count=len(values))
+        self.data = np.fromiter((0 if v is None else v for v in values), dtype=dtype, count=len(values))
+
+    def get(self, index):
+        if self.to_python is None:
+            return self.data[index]
+        if self.empty[index]:
+            return None
+        return self.to_python(self.data[index])
+
+
+def _numeric_kind(values):
+    """int, float или None (колонку нельзя хранить числовым массивом без потери типов)."""
+    kind = None
+    for value in values:
+        if value is None:
+            continue
+        value_type = type(value)
+        if value_type is int:
+            if not _INT64_MIN <= value <= _INT64_MAX:
+                return None
+            if kind is float:
+                return None
+            kind = int
+        elif value_type is float:
+            if kind is int:
+                return None
+            kind = float
+        else:
+            return None
+    return kind
+
+
+class SourceSheetData:
+    """
+    Доступ к данным листа-источника для всех этапов обработки.
+
+    Если включен колоночный кэш, колонки, на которые ссылаются правила,
+    извлекаются из листа один раз (строки first_row..last_row) и дальше все
+    правила колонок и формул читают их из кэша. Остальные ячейки (и весь
+    лист, если кэш выключен) читаются напрямую из листа.
+    last_row - последняя строка с данными (по умолчанию max_row листа).
+    """
+
+    def __init__(self, source_ws, columns=(), first_row=1, last_row=None, use_cache=True):
+        self.ws = source_ws
+        self.first_row = first_row
+        self.last_row = source_ws.max_row if last_row is None else last_row
+        self.columns = {}
+        if use_cache:
+            for col_idx in sorted(columns):
+                self.columns[col_idx] = self._extract_column(col_idx)
+
+    def _extract_column(self, col_idx):
+        if hasattr(self.ws, 'column_values'):  # лист потокового чтения (services/xlsx_reader.py)
+            return _Column(*self.ws.column_values(col_idx, self.first_row, self.last_row))
+        # ws._cells содержит только существующие ячейки: в отличие от ws.cell(),
+        # чтение не создает объекты для пустых ячеек
+        cells = self.ws._cells
+        values = []
+        hyperlinks = {}
+        for row_idx in range(self.first_row, self.last_row + 1):
+            cell = cells.get((row_idx, col_idx))
+            if cell is None:
+                values.append(None)
+                continue
+            values.append(cell.value)
+            if cell.hyperlink:
+                hyperlinks[row_idx] = cell.hyperlink.target
+        return _Column(values, hyperlinks)
+
+    def value(self, row_idx, col_idx):
+        column = self.columns.get(col_idx)
+        if column is None or row_idx < self.first_row:
+            return self.ws.cell(row=row_idx, column=col_idx).value
+        index = row_idx - self.first_row
+        if index >= len(column.data):
+            return None
+        return column.get(index)
+
+    def value_and_link(self, row_idx, col_idx):
+        """
+        Значение ячейки и гиперссылка: (value, has_link, link_target).
+        has_link нужен отдельно - у внутренних ссылок target бывает None.
+        """
+        column = self.columns.get(col_idx)
+        if column is None or row_idx < self.first_row:
+            cell = self.ws.cell(row=row_idx, column=col_idx)
+            if cell.hyperlink:
+                return cell.value, True, cell.hyperlink.target
+            return cell.value, False, None
+        index = row_idx - self.first_row
+        if index >= len(column.data):
+            return None, False, None
+        if row_idx in column.hyperlinks:
+            return column.get(index), True, column.hyperlinks[row_idx]
+        return column.get(index), False, None
+
+    def cell_value(self, cell_ref):
+        """Значение по адресу ячейки ('B5')."""
+        return self.ws[cell_ref].value
@@ -0,0 +1,90 @@
+# app/services/source_loader.py
+"""
+Загрузка книги-источника: разбираются только листы, на которые ссылаются
+правила. Клиентские файлы часто содержат десятки сводных и отчетных листов,
+а правила читают один-два; load_workbook разбирает XML всех листов, и время
+загрузки и память растут с размером всей книги, а не используемых данных.
+
+Остальные листы остаются в книге пустыми на своих местах: порядок листов
+важен (правила без source_sheet читают первый лист), имена - тоже.
+
+Читает книгу openpyxl (backend='openpyxl') или потоковое чтение
+services/xlsx_reader.py (backend='stream', по умолчанию, см. SOURCE_READER).
+"""
+import logging
+
+from openpyxl.reader.excel import ExcelReader
+
+from app.services import xlsx_reader
+
+logger = logging.getLogger(__name__)
+
+
+def referenced_sheets(sheetnames, template_rules=None, cell_mappings=None, formula_rules=None,
+                      source_cell_fill_rules=None, sheet_settings=None):
+    """
+    Листы источника (из sheetnames), которые читают правила. Правила без
+    source_sheet читают первый лист; формулы - только листы из sheet_settings
+    (как в excel_processor.build_execution_plan).
+    """
+    default_sheet = sheetnames[0] if sheetnames else None
+    settings_sheets = {setting.get('sheet_name') for setting in sheet_settings or []}
+    needed = set()
+    for rule in list(template_rules or []) + list(cell_mappings or []) + list(source_cell_fill_rules or []):
+        needed.add(rule.get('source_sheet', default_sheet))
+    for rule in formula_rules or []:
+        if rule.get('source_sheet') in settings_sheets:
+            needed.add(rule['source_sheet'])
+    return needed & set(sheetnames)
+
+
+class _SelectiveReader(ExcelReader):
+    """ExcelReader, который разбирает только листы, выбранные select_sheets(имена листов)."""
+
+    def __init__(self, fn, select_sheets, **kwargs):
+        super().__init__(fn, **kwargs)
+        self.select_sheets = select_sheets
+        self.skipped = []
+
+    def read_worksheets(self):
+        all_sheets = list(self.parser.find_sheets())
+        needed = self.select_sheets([sheet.name for sheet, _ in all_sheets])
+        selected = [(sheet, rel) for sheet, rel in all_sheets if sheet.name in needed]
+        self.parser.find_sheets = lambda: iter(selected)
+        super().read_worksheets()
+
+        # Пропущенные листы - пустые, на прежних местах (на позиции листов
+        # ссылаются и определенные имена, см. WorkbookParser.assign_names)
+        loaded = {ws.title: ws for ws in self.wb._sheets}
+        self.wb._sheets = []
+        for sheet, _ in all_sheets:
+            ws = loaded.get(sheet.name)
+            if ws is None:
+                ws = self.wb.create_sheet(sheet.name)
+                ws.sheet_state = sheet.state
+                self.skipped.append(sheet.name)
+            else:
+                self.wb._sheets.append(ws)
+
+
+def load_source_workbook(source_file, template_rules=None, cell_mappings=None, formula_rules=None,
+                         source_cell_fill_rules=None, sheet_settings=None, backend='stream'):
+    """
+    Книга-источник (data_only) с разобранными листами правил.
+    Возвращает (книга, имена пропущенных листов).
+    """
+    def select_sheets(sheetnames):
+        return referenced_sheets(sheetnames, template_rules, cell_mappings, formula_rules,
+                                 source_cell_fill_rules, sheet_settings)
+
+    if backend == 'stream':
+        wb, skipped = xlsx_reader.load_workbook(source_file, select_sheets)
+    elif backend == 'openpyxl':
+        reader = _SelectiveReader(source_file, select_sheets, data_only=True)
+        reader.read()
+        wb, skipped = reader.wb, reader.skipped
+    else:
+        raise ValueError(f"Неизвестный способ чтения источника: {backend}")
+    if skipped:
+        logger.debug("Пропущены листы источника без правил: %s", ", ".join(skipped))
+    return wb, skipped
@@ -0,0 +1,108 @@
+# app/services/task_log_writer.py
+"""
+Фоновая запись журнала задач (TaskLog).
+
+Потоки обработки только кладут запись в очередь, а один фоновый поток
+забирает их пачками и сохраняет одним commit. Так завершение задачи не
+ждет блокировку SQLite, а параллельные задачи не конкурируют за запись.
+"""
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TaskLogWriter:
+    """
+    Очередь записей журнала с фоновым потоком-писателем.
+    write_batch(app, records) вызывается в потоке-писателе для каждой пачки
+    (записи одной пачки относятся к одному приложению Flask).
+    """
+    RETRY_DELAYS = (0.5, 2.0)
+
+    def __init__(self, write_batch, batch_size=100, flush_interval=1.0):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, app, record):
+        self._ensure_started()
+        self._queue.put((app, record))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """Ждет, пока все поставленные записи будут сохранены (или timeout секунд)."""
+        if self._thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _ensure_started(self):
+        # После fork поток родителя в дочернем процессе не существует - запускаем свой
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='task-log-writer', daemon=True)
+            self._thread.start()
+
+    def _next_batch(self):
+        """Блокируется до первой записи, затем добирает пачку в течение flush_interval."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                by_app = {}
+                for app, record in batch:
+                    by_app.setdefault(app, []).append(record)
+                for app, records in by_app.items():
+                    self._write_with_retry(app, records)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_with_retry(self, app, records):
+        for attempt, delay in enumerate((0,) + self.RETRY_DELAYS):
+            if delay:
+                time.sleep(delay)
+            try:
+                self.write_batch(app, records)
+                return
+            except Exception as e:
+                logger.warning("Не удалось записать %s записей журнала (попытка %s): %s", len(records), attempt + 1, e)
+        logger.error("Записи журнала задач потеряны: %s", [r.get('task_uuid') for r in records])
+
+
+def register_flush_at_exit(writer, timeout=10):
+    """Перед выходом процесса дописывает оставшиеся записи."""
+    atexit.register(writer.flush, timeout)
@@ -0,0 +1,84 @@
+# app/services/task_metrics.py
+import os
+import sys
+import time
+import resource
+from contextlib import contextmanager
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss():
+    """
+    Текущий RSS процесса в байтах. Без /proc (не Linux) - пиковый RSS
+    процесса (ru_maxrss), что для замера по этапам тоже годится как оценка сверху.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss: на macOS в байтах, на Linux в килобайтах
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageTimer:
+    """
+    Время этапов обработки одной задачи и счетчики (строки, байты).
+    Этапы сохраняются в порядке первого появления, повторные замеры
+    одного этапа суммируются. peak_rss - максимум RSS процесса,
+    замеренный в конце каждого этапа (sample_rss).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.peak_rss = 0
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+            self.sample_rss()
+
+    def sample_rss(self):
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {
+            'stages': {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+            'counters': dict(self.counters),
+            'total': round(self.total, 4),
+            'duration': round(self.elapsed, 4),
+            'peak_rss': self.peak_rss
+        }
+
+
+def file_size(file_obj):
+    """Размер файла в байтах: путь на диске или файловый объект (позиция не меняется)."""
+    if isinstance(file_obj, (str, os.PathLike)):
+        return os.path.getsize(file_obj)
+    if hasattr(file_obj, 'getbuffer'):
+        return file_obj.getbuffer().nbytes
+    position = file_obj.tell()
+    size = file_obj.seek(0, os.SEEK_END)
+    file_obj.seek(position)
+    return size
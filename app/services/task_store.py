@@ -0,0 +1,249 @@
+# app/services/task_store.py
+"""
+Хранилище состояния задач обработки (task_statuses).
+
+Состояние задачи - словарь (status, progress, owner_id, warnings, metrics,
+result_ready...), результат - файл .xlsx. Маршруты и обработчик работают
+только через методы хранилища, а не со словарем напрямую, поэтому
+хранилище можно заменить:
+
+    memory - в памяти процесса (один процесс: отладка, тесты);
+    sqlite - файл SQLite и папка с результатами на диске, общие для всех
+             процессов: /status, /download и join_task_room работают
+             в любом воркере, независимо от того, где выполнялась задача.
+
+Бэкенд выбирается настройкой TASK_STORE при init_app.
+"""
+import io
+import json
+import os
+import shutil
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+from app.utils.sqlite import SQLiteFile
+
+
+class MemoryTaskStore:
+    """Состояние задач в словаре процесса, результаты - байты в памяти."""
+
+    def __init__(self):
+        self._tasks = {}
+        self._results = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    def create(self, task_id, data):
+        with self._lock:
+            self._tasks[task_id] = dict(data)
+            self._updated[task_id] = time.time()
+
+    def get(self, task_id):
+        with self._lock:
+            data = self._tasks.get(task_id)
+            return dict(data) if data is not None else None
+
+    def update(self, task_id, **fields):
+        with self._lock:
+            data = self._tasks.get(task_id)
+            if data is None:
+                return False
+            data.update(fields)
+            self._updated[task_id] = time.time()
+            return True
+
+    def replace(self, task_id, data):
+        with self._lock:
+            if task_id not in self._tasks:
+                return False
+            self._tasks[task_id] = dict(data)
+            self._updated[task_id] = time.time()
+            return True
+
+    def delete(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            self._results.pop(task_id, None)
+            self._updated.pop(task_id, None)
+
+    def save_result(self, task_id, file_obj):
+        file_obj.seek(0)
+        data = file_obj.read()
+        with self._lock:
+            self._results[task_id] = data
+
+    def open_result(self, task_id):
+        with self._lock:
+            data = self._results.get(task_id)
+        return io.BytesIO(data) if data is not None else None
+
+    def purge(self, max_age_hours):
+        threshold = time.time() - max_age_hours * 3600
+        with self._lock:
+            for task_id in [t for t, updated in self._updated.items() if updated < threshold]:
+                self._tasks.pop(task_id, None)
+                self._results.pop(task_id, None)
+                self._updated.pop(task_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'tasks': len(self._tasks), 'result_bytes': sum(len(d) for d in self._results.values())}
+
+
+class SQLiteTaskStore:
+    """Состояние задач в таблице SQLite (JSON), результаты - файлы в results_folder."""
+    RESULT_SUFFIX = '.xlsx'
+
+    def __init__(self, path, results_folder, busy_timeout_ms=5000):
+        self.path = path
+        self.results_folder = results_folder
+        self._db = SQLiteFile(path, busy_timeout_ms)
+        os.makedirs(results_folder, exist_ok=True)
+        with self._db.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS task_state ("
+                         "task_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_task_state_updated_at ON task_state (updated_at)")
+
+    def _result_path(self, task_id):
+        return os.path.join(self.results_folder, secure_filename(task_id) + self.RESULT_SUFFIX)
+
+    def create(self, task_id, data):
+        with self._db.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO task_state (task_id, data, updated_at) VALUES (?, ?, ?)",
+                         (task_id, json.dumps(data, ensure_ascii=False), time.time()))
+
+    def get(self, task_id):
+        row = self._db.connection().execute("SELECT data FROM task_state WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, task_id, **fields):
+        # BEGIN IMMEDIATE: чтение и запись под одной блокировкой, параллельные
+        # обновления одной задачи не теряют поля друг друга
+        with self._db.transaction() as conn:
+            row = conn.execute("SELECT data FROM task_state WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return False
+            data = json.loads(row[0])
+            data.update(fields)
+            conn.execute("UPDATE task_state SET data = ?, updated_at = ? WHERE task_id = ?",
+                         (json.dumps(data, ensure_ascii=False), time.time(), task_id))
+            return True
+
+    def replace(self, task_id, data):
+        with self._db.transaction() as conn:
+            cursor = conn.execute("UPDATE task_state SET data = ?, updated_at = ? WHERE task_id = ?",
+                                  (json.dumps(data, ensure_ascii=False), time.time(), task_id))
+            return cursor.rowcount > 0
+
+    def delete(self, task_id):
+        with self._db.transaction() as conn:
+            conn.execute("DELETE FROM task_state WHERE task_id = ?", (task_id,))
+        self._remove_result(task_id)
+
+    def save_result(self, task_id, file_obj):
+        """Записывает результат атомарно: читатель видит либо весь файл, либо никакого."""
+        path = self._result_path(task_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        file_obj.seek(0)
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(file_obj, f)
+        os.replace(tmp_path, path)
+
+    def open_result(self, task_id):
+        try:
+            return open(self._result_path(task_id), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def _remove_result(self, task_id):
+        try:
+            os.remove(self._result_path(task_id))
+        except FileNotFoundError:
+            pass
+
+    def purge(self, max_age_hours):
+        """Удаляет задачи, не обновлявшиеся max_age_hours часов, вместе с результатами."""
+        threshold = time.time() - max_age_hours * 3600
+        with self._db.transaction() as conn:
+            task_ids = [row[0] for row in
+                        conn.execute("SELECT task_id FROM task_state WHERE updated_at < ?", (threshold,))]
+            conn.execute("DELETE FROM task_state WHERE updated_at < ?", (threshold,))
+        for task_id in task_ids:
+            self._remove_result(task_id)
+
+    def stats(self):
+        tasks = self._db.connection().execute("SELECT COUNT(*) FROM task_state").fetchone()[0]
+        result_bytes = 0
+        with os.scandir(self.results_folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.RESULT_SUFFIX):
+                    try:
+                        result_bytes += entry.stat().st_size
+                    except OSError:
+                        continue
+        return {'tasks': tasks, 'result_bytes': result_bytes}
+
+
+class TaskStore:
+    """
+    Расширение Flask: общий объект task_statuses (app.extensions), методы
+    которого передаются бэкенду, выбранному в init_app. До init_app
+    работает в памяти.
+    """
+    BACKENDS = ('memory', 'sqlite')
+
+    def __init__(self):
+        self.backend = MemoryTaskStore()
+
+    def init_app(self, app):
+        kind = app.config.get('TASK_STORE', 'memory')
+        if kind == 'memory':
+            self.backend = MemoryTaskStore()
+        elif kind == 'sqlite':
+            processed_folder = app.config['PROCESSED_FOLDER']
+            self.backend = SQLiteTaskStore(
+                app.config.get('TASK_STORE_PATH') or os.path.join(processed_folder, 'tasks.db'),
+                os.path.join(processed_folder, 'results'),
+                busy_timeout_ms=app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+        else:
+            raise ValueError(f"Неизвестное хранилище задач TASK_STORE='{kind}' (допустимо: {', '.join(self.BACKENDS)})")
+        app.extensions['task_store'] = self
+
+    def __contains__(self, task_id):
+        return self.backend.get(task_id) is not None
+
+    def create(self, task_id, data):
+        """Регистрирует задачу (перезаписывает существующую с тем же task_id)."""
+        self.backend.create(task_id, data)
+
+    def get(self, task_id):
+        """Копия состояния задачи или None. Изменения копии не сохраняются - используйте update."""
+        return self.backend.get(task_id)
+
+    def update(self, task_id, **fields):
+        """Обновляет поля состояния. Возвращает False, если задачи нет."""
+        return self.backend.update(task_id, **fields)
+
+    def replace(self, task_id, data):
+        """Заменяет состояние задачи целиком. Возвращает False, если задачи нет."""
+        return self.backend.replace(task_id, data)
+
+    def delete(self, task_id):
+        self.backend.delete(task_id)
+
+    def save_result(self, task_id, file_obj):
+        """Сохраняет файл результата (файловый объект в памяти)."""
+        self.backend.save_result(task_id, file_obj)
+
+    def open_result(self, task_id):
+        """Бинарный файловый объект результата или None. Закрывает вызывающий."""
+        return self.backend.open_result(task_id)
+
+    def purge(self, max_age_hours):
+        self.backend.purge(max_age_hours)
+
+    def stats(self):
+        """{'tasks': число задач, 'result_bytes': размер сохраненных результатов}."""
+        return self.backend.stats()
@@ -0,0 +1,124 @@
+# app/services/template_plans.py
+"""
+Сохраненные шаблоны (TEMPLATES_DB_FOLDER/<id>.json), разобранные один раз
+на процесс.
+
+Раньше главная страница, список шаблонов и запуск обработки на каждый
+запрос читали и разбирали JSON всех (или выбранного) шаблонов. Теперь
+разобранное описание хранится в памяти процесса вместе с формулами
+правил, уже разобранными для excel_processor (compile_formula). Описание
+перечитывается, если файл изменился (время изменения или размер), и
+забывается, если файл удален.
+
+В режиме pre-fork (см. services/prefork.py) все шаблоны загружаются в
+мастер-процессе до fork, и воркеры используют их копию при записи.
+"""
+import copy
+import json
+import logging
+import os
+import threading
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from app.services.excel_processor import compile_formula
+
+logger = logging.getLogger(__name__)
+
+
+class TemplatePlan:
+    """Описание шаблона из JSON и разобранные формулы его правил."""
+    __slots__ = ('template_id', 'signature', 'data', 'formulas')
+
+    def __init__(self, template_id, signature, data, formulas):
+        self.template_id = template_id
+        self.signature = signature
+        self.data = data
+        self.formulas = formulas
+
+
+_plans = {}  # {путь к JSON: TemplatePlan}
+_lock = threading.Lock()
+
+
+def _templates_dir():
+    return current_app.config['TEMPLATES_DB_FOLDER']
+
+
+def _load(path, template_id):
+    """TemplatePlan файла path (из кэша, если файл не менялся) или None, если файла нет."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        with _lock:
+            _plans.pop(path, None)
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    plan = _plans.get(path)
+    if plan is not None and plan.signature == signature:
+        return plan
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    formulas = [compile_formula(rule.get('formula')) for rule in data.get('formula_rules', [])]
+    plan = TemplatePlan(template_id, signature, data, formulas)
+    with _lock:
+        _plans[path] = plan
+    return plan
+
+
+def _path(template_id):
+    return os.path.join(_templates_dir(), f"{secure_filename(template_id)}.json")
+
+
+def get(template_id):
+    """
+    Копия описания шаблона template_id (ее можно изменять) или None, если
+    шаблона нет. Ошибки чтения JSON не перехватываются.
+    """
+    plan = _load(_path(template_id), template_id)
+    return None if plan is None else copy.deepcopy(plan.data)
+
+
+def all_templates():
+    """
+    Список (id, описание) всех шаблонов. Описания общие для всех запросов -
+    только для чтения. Нечитаемые файлы пропускаются с записью в журнал.
+    """
+    templates_path = _templates_dir()
+    if not os.path.isdir(templates_path):
+        return []
+    result = []
+    paths = set()
+    for f_name in sorted(os.listdir(templates_path)):
+        if not f_name.endswith('.json'):
+            continue
+        path = os.path.join(templates_path, f_name)
+        paths.add(path)
+        try:
+            plan = _load(path, f_name[:-len('.json')])
+        except Exception as e:
+            logger.error("Ошибка чтения шаблона %s: %s", f_name, e)
+            continue
+        if plan is not None:
+            result.append((plan.template_id, plan.data))
+    # Удаленные шаблоны
+    with _lock:
+        for path in [p for p in _plans if os.path.dirname(p) == templates_path and p not in paths]:
+            del _plans[path]
+    return result
+
+
+def forget(template_id):
+    """
+    Забывает шаблон после записи или удаления его JSON в этом процессе.
+    Другие процессы заметят изменение по времени изменения и размеру файла.
+    """
+    with _lock:
+        _plans.pop(_path(template_id), None)
+
+
+def preload():
+    """Загружает все шаблоны (в контексте приложения). Возвращает их число."""
+    return len(all_templates())
@@ -0,0 +1,241 @@
+# app/services/upload_service.py
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import datetime
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+# Имя файла-описания загрузки внутри папки с частями
+MANIFEST_NAME = 'manifest.json'
+
+
+def _get_chunks_root():
+    """Папка, в которой лежат незавершенные загрузки (по подпапке на загрузку)."""
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'chunks')
+
+
+def _get_upload_dir(upload_id):
+    return os.path.join(_get_chunks_root(), secure_filename(upload_id))
+
+
+def _read_manifest(upload_dir):
+    with open(os.path.join(upload_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(upload_dir, manifest):
+    """Атомарно перезаписывает manifest.json (через временный файл)."""
+    tmp_path = os.path.join(upload_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(upload_dir, MANIFEST_NAME))
+
+
+def _chunk_path(upload_dir, index):
+    return os.path.join(upload_dir, f"{index:06d}.part")
+
+
+def _last_activity(upload_dir):
+    """
+    Время последнего изменения загрузки: самый новый из файлов папки.
+    manifest при получении частей не перезаписывается, поэтому его времени
+    недостаточно - медленная, но идущая загрузка не должна считаться брошенной.
+    """
+    return max(entry.stat().st_mtime for entry in os.scandir(upload_dir))
+
+
+def cleanup_stale_uploads(max_age_hours):
+    """Удаляет брошенные и давно завершенные загрузки (части и manifest)."""
+    root = _get_chunks_root()
+    if not os.path.isdir(root):
+        return
+    threshold = datetime.datetime.now().timestamp() - max_age_hours * 3600
+    for name in os.listdir(root):
+        upload_dir = os.path.join(root, name)
+        try:
+            if _last_activity(upload_dir) < threshold:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+        except (OSError, ValueError):
+            continue
+
+
+def create_upload(owner_id, filename, total_size, sha256=None, task_settings=None, template_filename=None):
+    """
+    Регистрирует новую загрузку по частям.
+    task_settings - параметры задачи обработки, которая будет запущена
+    сразу после получения последней части, template_filename - имя
+    файла-шаблона ручной настройки (сам файл сохраняется по get_template_path).
+    """
+    if not filename:
+        raise ValueError("Не указано имя файла.")
+    try:
+        total_size = int(total_size)
+    except (TypeError, ValueError):
+        raise ValueError("Некорректный размер файла.")
+    if total_size <= 0:
+        raise ValueError("Файл пустой.")
+    if total_size > current_app.config['UPLOAD_MAX_SIZE']:
+        raise ValueError("Файл слишком большой.")
+
+    cleanup_stale_uploads(current_app.config['UPLOAD_STALE_HOURS'])
+
+    chunk_size = current_app.config['UPLOAD_CHUNK_SIZE']
+    upload_id = str(uuid.uuid4())
+    upload_dir = _get_upload_dir(upload_id)
+    os.makedirs(upload_dir, exist_ok=True)
+
+    manifest = {
+        'upload_id': upload_id,
+        'owner_id': owner_id,
+        'filename': filename,
+        'total_size': total_size,
+        'chunk_size': chunk_size,
+        'total_chunks': (total_size + chunk_size - 1) // chunk_size,
+        'sha256': sha256.lower() if sha256 else None,
+        'task_settings': task_settings or {},
+        'template_filename': template_filename,
+        'task_id': None,
+        'created': datetime.datetime.now().isoformat()
+    }
+    _write_manifest(upload_dir, manifest)
+    return manifest
+
+
+def get_template_path(manifest):
+    """Путь к файлу-шаблону ручной настройки, сохраненному рядом с частями."""
+    _, extension = os.path.splitext(secure_filename(manifest['template_filename']))
+    return os.path.join(_get_upload_dir(manifest['upload_id']), f"template{extension}")
+
+
+def get_upload(upload_id):
+    """Возвращает manifest загрузки (или None) и список уже полученных частей."""
+    upload_dir = _get_upload_dir(upload_id)
+    if not os.path.isfile(os.path.join(upload_dir, MANIFEST_NAME)):
+        return None, []
+    manifest = _read_manifest(upload_dir)
+    received = [i for i in range(manifest['total_chunks']) if os.path.exists(_chunk_path(upload_dir, i))]
+    return manifest, received
+
+
+def save_chunk(upload_id, index, data, chunk_sha256=None):
+    """
+    Сохраняет одну часть файла. Повторная отправка той же части безопасна.
+    Возвращает (manifest, received).
+    """
+    manifest, _ = get_upload(upload_id)
+    if manifest is None:
+        raise ValueError("Загрузка не найдена.")
+    if manifest.get('assembled'):
+        raise ValueError("Загрузка уже завершена.")
+    if not 0 <= index < manifest['total_chunks']:
+        raise ValueError(f"Некорректный номер части: {index}.")
+
+    # Все части, кроме последней, должны быть ровно chunk_size
+    is_last = index == manifest['total_chunks'] - 1
+    expected_size = manifest['total_size'] - index * manifest['chunk_size'] if is_last else manifest['chunk_size']
+    if len(data) != expected_size:
+        raise ValueError(f"Часть {index}: ожидалось {expected_size} байт, получено {len(data)}.")
+
+    if chunk_sha256 and hashlib.sha256(data).hexdigest() != chunk_sha256.lower():
+        raise ValueError(f"Часть {index}: контрольная сумма не совпадает.")
+
+    upload_dir = _get_upload_dir(upload_id)
+    part_path = _chunk_path(upload_dir, index)
+    tmp_path = f"{part_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, part_path)
+
+    return get_upload(upload_id)
+
+
+def claim_assembly(upload_id):
+    """
+    Атомарно "захватывает" сборку файла: при параллельной отправке последних
+    частей сборку и запуск задачи выполнит только один запрос. Ошибка
+    предыдущей попытки (fail_upload) при этом сбрасывается.
+    Manifest после создания изменяет только владелец блокировки.
+    """
+    upload_dir = _get_upload_dir(upload_id)
+    lock_path = os.path.join(upload_dir, '.assembling')
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    manifest = _read_manifest(upload_dir)
+    if manifest.pop('error', None) is not None:
+        _write_manifest(upload_dir, manifest)
+    return True
+
+
+def assemble_upload(upload_id):
+    """
+    Склеивает все части в один файл в UPLOAD_FOLDER и проверяет итоговый
+    SHA-256. Части остаются до finish_upload: если задачу запустить не
+    удалось, сборку можно повторить.
+    Возвращает (путь к собранному файлу, sha256).
+    """
+    manifest, received = get_upload(upload_id)
+    if manifest is None:
+        raise ValueError("Загрузка не найдена.")
+    if len(received) != manifest['total_chunks']:
+        raise ValueError("Получены не все части файла.")
+
+    upload_dir = _get_upload_dir(upload_id)
+    _, extension = os.path.splitext(secure_filename(manifest['filename']))
+    dest_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}{extension}")
+    tmp_path = dest_path + '.tmp'
+
+    digest = hashlib.sha256()
+    with open(tmp_path, 'wb') as out:
+        for i in range(manifest['total_chunks']):
+            with open(_chunk_path(upload_dir, i), 'rb') as part:
+                for block in iter(lambda: part.read(1024 * 1024), b''):
+                    digest.update(block)
+                    out.write(block)
+
+    if manifest['sha256'] and digest.hexdigest() != manifest['sha256']:
+        os.remove(tmp_path)
+        # Части повреждены - удаляем загрузку целиком, клиент начнет заново
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise ValueError("Контрольная сумма файла не совпадает. Загрузите файл заново.")
+
+    os.replace(tmp_path, dest_path)
+    return dest_path, digest.hexdigest()
+
+
+def finish_upload(upload_id, task_id, sha256):
+    """
+    Загрузка завершена - задача запущена: удаляет части и запоминает task_id,
+    чтобы повторный запрос статуса загрузки вернул уже запущенную задачу.
+    Manifest остается до cleanup_stale_uploads.
+    """
+    upload_dir = _get_upload_dir(upload_id)
+    manifest = _read_manifest(upload_dir)
+    for i in range(manifest['total_chunks']):
+        part_path = _chunk_path(upload_dir, i)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    manifest.update(sha256=sha256, assembled=True, task_id=task_id)
+    _write_manifest(upload_dir, manifest)
+
+
+def fail_upload(upload_id, error):
+    """
+    Сборка или запуск задачи не удались: ошибка сохраняется в manifest (ее
+    вернет запрос статуса загрузки), блокировка сборки снимается - повторная
+    отправка последней части повторит сборку.
+    """
+    upload_dir = _get_upload_dir(upload_id)
+    if not os.path.isfile(os.path.join(upload_dir, MANIFEST_NAME)):
+        return  # Загрузка удалена целиком (не совпала контрольная сумма)
+    manifest = _read_manifest(upload_dir)
+    manifest['error'] = error
+    _write_manifest(upload_dir, manifest)
+    lock_path = os.path.join(upload_dir, '.assembling')
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
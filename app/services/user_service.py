@@ -1,4 +1,11 @@
 # app/services/user_service.py
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import event
+
 from app.extensions import db
 from app.models import User  # <-- Импортируем нашу новую модель
 
@@ -10,6 +17,79 @@ def get_user_by_id(user_id):
     return db.session.get(User, user_id)
 
 
+# --- Кэш пользователей для load_user ---
+# Flask-Login загружает пользователя на каждый запрос, в том числе на каждый
+# опрос /status. Загруженный пользователь хранится USER_CACHE_TTL секунд
+# (не более USER_CACHE_SIZE записей, вытесняются давно не использованные).
+# Кэш у каждого процесса свой: изменения, сделанные в другом процессе,
+# видны не позже чем через USER_CACHE_TTL секунд.
+
+class UserCache:
+    """LRU-кэш {user_id: User} с ограничением времени жизни записи."""
+
+    def __init__(self):
+        self._entries = OrderedDict()  # {user_id: (срок, пользователь или None)}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """(True, пользователь) для живой записи, иначе (False, None)."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False, None
+            if entry[0] < time.monotonic():
+                del self._entries[user_id]
+                return False, None
+            self._entries.move_to_end(user_id)
+            return True, entry[1]
+
+    def put(self, user_id, user, ttl, max_size):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """Удаляет запись пользователя (None - все записи)."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+user_cache = UserCache()
+
+
+def load_user(user_id):
+    """
+    Пользователь для Flask-Login (login_manager.user_loader) через кэш.
+    В кэш кладется объект, отсоединенный от сессии (expunge): его загруженные
+    поля (id, username, role) доступны в любом запросе. Отсутствующий
+    пользователь тоже кэшируется - как None.
+    """
+    ttl = current_app.config['USER_CACHE_TTL']
+    if ttl <= 0:
+        return get_user_by_id(user_id)
+    found, user = user_cache.get(user_id)
+    if found:
+        return user
+    user = get_user_by_id(user_id)
+    if user is not None:
+        db.session.expunge(user)
+    user_cache.put(user_id, user, ttl, current_app.config['USER_CACHE_SIZE'])
+    return user
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_cached_user(mapper, connection, target):
+    """Любое изменение пользователя (create_user, delete_user, смена роли) сбрасывает его запись."""
+    user_cache.invalidate(target.id)
+
+
 def get_user_by_username(username):
     """Находит пользователя по username."""
     return User.query.filter_by(username=username).first()
@@ -0,0 +1,124 @@
+# app/services/warning_report.py
+"""
+Замечания обработки (ошибки формул), сгруппированные по правилу и типу ошибки.
+
+Раньше на каждую строку с ошибкой в список замечаний задачи добавлялась
+строка: сломанная формула на 500 000 строк давала полмиллиона строк в
+состоянии задачи и многомегабайтное сообщение task_complete. Теперь в
+задаче хранится сводка - по строке на группу (правило и тип ошибки) с
+числом случаев и первыми примерами ячеек, а все случаи построчно пишутся в
+CSV-отчет на диске (PROCESSED_FOLDER/warnings/<task_id>.csv), который
+можно скачать (GET /download_warnings/<task_id>).
+"""
+import csv
+import os
+import time
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+REPORT_HEADER = ['Правило', 'Ошибка', 'Ячейка', 'Подробности']
+
+
+def _reports_dir():
+    return os.path.join(current_app.config['PROCESSED_FOLDER'], 'warnings')
+
+
+def report_path(task_id):
+    """Путь к полному отчету о замечаниях задачи."""
+    return os.path.join(_reports_dir(), secure_filename(task_id) + '.csv')
+
+
+class WarningCollector:
+    """
+    Замечания одной обработки. add() - очередной случай; summary() - сводка
+    для состояния задачи. report_path - куда писать все случаи (None - не
+    писать, как в предпросмотре); файл создается при первом замечании.
+    """
+
+    def __init__(self, report_path=None, max_examples=5):
+        self.report_path = report_path
+        self.max_examples = max_examples
+        self.groups = {}  # {(правило, ошибка): {'count', 'examples'}}
+        self.total = 0
+        self._report_file = None
+        self._report = None
+
+    def resume(self, groups, report_path=None):
+        """
+        Продолжение предыдущего прогона (инкрементальный режим): его группы
+        (groups_state()) объединяются с новыми по правилу и типу ошибки, а
+        строки его отчета report_path переносятся в начало нового отчета.
+        Вызывается до первого add().
+        """
+        for rule, error, count, examples in groups:
+            group = self.groups.setdefault((rule, error), {'count': 0, 'examples': []})
+            group['count'] += count
+            group['examples'].extend(examples[:self.max_examples - len(group['examples'])])
+            self.total += count
+        if report_path and self.report_path is not None and os.path.exists(report_path):
+            self._open_report()
+            with open(report_path, 'r', encoding='utf-8-sig', newline='') as f:
+                rows = csv.reader(f, delimiter=';')
+                next(rows, None)  # заголовок
+                self._report.writerows(rows)
+
+    def add(self, rule, error, cell=None, details=''):
+        """Случай ошибки error правила rule в ячейке cell ('C5' или None)."""
+        group = self.groups.get((rule, error))
+        if group is None:
+            group = self.groups[(rule, error)] = {'count': 0, 'examples': []}
+        group['count'] += 1
+        if len(group['examples']) < self.max_examples:
+            group['examples'].append(f"{cell} ({details})" if cell and details else cell or details)
+        self.total += 1
+        if self.report_path is not None:
+            self._write(rule, error, cell, details)
+
+    def _open_report(self):
+        os.makedirs(os.path.dirname(self.report_path), exist_ok=True)
+        # utf-8-sig: Excel открывает CSV с кириллицей без выбора кодировки
+        self._report_file = open(self.report_path, 'w', encoding='utf-8-sig', newline='')
+        self._report = csv.writer(self._report_file, delimiter=';')
+        self._report.writerow(REPORT_HEADER)
+
+    def _write(self, rule, error, cell, details):
+        if self._report is None:
+            self._open_report()
+        self._report.writerow([rule, error, cell or '', details])
+
+    @property
+    def has_report(self):
+        return self._report is not None
+
+    def groups_state(self):
+        """Группы в виде для JSON (состояние инкрементального режима): [правило, ошибка, число, примеры]."""
+        return [[rule, error, group['count'], group['examples']] for (rule, error), group in self.groups.items()]
+
+    def summary(self):
+        """Сводка: по строке на группу, с числом случаев и примерами."""
+        lines = []
+        for (rule, error), group in self.groups.items():
+            examples = ', '.join(group['examples'])
+            more = ' и др.' if group['count'] > len(group['examples']) else ''
+            lines.append(f"{rule}: {error} (случаев: {group['count']}), например: {examples}{more}")
+        return lines
+
+    def close(self):
+        if self._report_file is not None:
+            self._report_file.close()
+
+
+def purge(max_age_hours):
+    """Удаляет отчеты старше max_age_hours часов (как и результаты задач)."""
+    reports_dir = _reports_dir()
+    if not os.path.isdir(reports_dir):
+        return
+    threshold = time.time() - max_age_hours * 3600
+    with os.scandir(reports_dir) as it:
+        stale = [entry.path for entry in it if entry.is_file() and entry.stat().st_mtime < threshold]
+    for path in stale:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,363 @@
+# app/services/xlsx_reader.py
+"""
+Потоковое чтение .xlsx для книг-источников (SOURCE_READER = 'stream').
+
+openpyxl создает объект Cell на каждое значение (и в режиме read_only -
+ReadOnlyCell), а обработке источника нужны только значения, скрытость строк
+и гиперссылки. Здесь XML листа разбирается lxml.etree.iterparse построчно,
+строка превращается в кортеж значений (колонка 1 - индекс 0), а разобранные
+элементы сразу освобождаются. Общие строки (sharedStrings.xml) читаются в
+список один раз; одинаковые строки (общие и встроенные) хранятся одним
+объектом.
+
+Значения - те же, что у load_workbook(data_only=True): числа int/float,
+даты по формату ячейки, bool, строки ошибок ('#N/A'), у формул - последнее
+вычисленное значение. Описание книги, стили (форматы дат) и связи листов
+читает openpyxl - это небольшие части файла.
+
+StreamedSheet повторяет ту часть интерфейса листа openpyxl, которой
+пользуется обработка источника (ws['B5'], ws.cell(), row_dimensions,
+iter_rows), а для быстрых путей предоставляет data_extent, column_values и
+iter_row_values (см. utils/helpers.py и services/source_cache.py).
+"""
+from collections import namedtuple
+
+from lxml import etree
+from openpyxl.packaging.relationship import get_dependents, get_rels_path
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.styles.stylesheet import apply_stylesheet
+from openpyxl.utils.cell import column_index_from_string, coordinate_to_tuple, range_boundaries
+from openpyxl.utils.datetime import from_excel, from_ISO8601
+from openpyxl.xml.constants import SHARED_STRINGS, SHEET_MAIN_NS
+
+_ROW_TAG = f'{{{SHEET_MAIN_NS}}}row'
+_CELL_TAG = f'{{{SHEET_MAIN_NS}}}c'
+_VALUE_TAG = f'{{{SHEET_MAIN_NS}}}v'
+_INLINE_STRING_TAG = f'{{{SHEET_MAIN_NS}}}is'
+_TEXT_TAG = f'{{{SHEET_MAIN_NS}}}t'
+_RUN_TAG = f'{{{SHEET_MAIN_NS}}}r'
+_STRING_ITEM_TAG = f'{{{SHEET_MAIN_NS}}}si'
+_HYPERLINK_TAG = f'{{{SHEET_MAIN_NS}}}hyperlink'
+_REL_ID_ATTR = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+_DIGITS = '0123456789'
+
+# Гиперссылка в том же виде, что у openpyxl: важен только target
+# (у ссылок внутри книги он None)
+Link = namedtuple('Link', 'target')
+
+
+class _HiddenRow:
+    hidden = True
+
+
+_HIDDEN_ROW = _HiddenRow()
+
+
+class StreamedCell:
+    """Ячейка, возвращаемая ws['B5'] / ws.cell() / iter_rows(): значение и гиперссылка."""
+    __slots__ = ('row', 'column', 'value', 'hyperlink')
+
+    def __init__(self, row, column, value, hyperlink=None):
+        self.row = row
+        self.column = column
+        self.value = value
+        self.hyperlink = hyperlink
+
+
+class StreamedSheet:
+    """Лист источника: rows - {номер строки: кортеж значений}, только непустые строки."""
+
+    def __init__(self, title, rows=None, hidden_rows=(), hyperlinks=None):
+        self.title = title
+        self.rows = rows or {}
+        self.hidden_rows = set(hidden_rows)
+        self.hyperlinks = hyperlinks or {}  # {(строка, колонка): target}
+
+    @property
+    def max_row(self):
+        return max(self.rows, default=1)
+
+    @property
+    def max_column(self):
+        return max(map(len, self.rows.values()), default=1)
+
+    @property
+    def row_dimensions(self):
+        return {r_idx: _HIDDEN_ROW for r_idx in self.hidden_rows}
+
+    def value(self, row_idx, col_idx):
+        row = self.rows.get(row_idx)
+        if row is None or col_idx > len(row):
+            return None
+        return row[col_idx - 1]
+
+    def cell(self, row, column):
+        key = (row, column)
+        link = Link(self.hyperlinks[key]) if key in self.hyperlinks else None
+        return StreamedCell(row, column, self.value(row, column), link)
+
+    def __getitem__(self, coordinate):
+        row, column = coordinate_to_tuple(coordinate)
+        return self.cell(row, column)
+
+    def data_extent(self, columns=None):
+        """Последняя строка со значением в колонках columns (None - в любой), см. helpers.get_data_extent."""
+        for row_idx in sorted(self.rows, reverse=True):
+            row = self.rows[row_idx]
+            if columns is None:
+                if any(value is not None for value in row):
+                    return row_idx
+            elif any(col_idx <= len(row) and row[col_idx - 1] is not None for col_idx in columns):
+                return row_idx
+        return 0
+
+    def column_values(self, col_idx, first_row, last_row):
+        """Значения колонки в строках first_row..last_row и гиперссылки {строка: target}."""
+        rows = self.rows
+        index = col_idx - 1
+        values = []
+        for row_idx in range(first_row, last_row + 1):
+            row = rows.get(row_idx)
+            values.append(row[index] if row is not None and index < len(row) else None)
+        hyperlinks = {row_idx: target for (row_idx, link_col), target in self.hyperlinks.items()
+                      if link_col == col_idx and first_row <= row_idx <= last_row}
+        return values, hyperlinks
+
+    def iter_row_values(self, max_row):
+        """(номер строки, [(колонка, значение), ...]) для строк 1..max_row, см. helpers.iter_row_values."""
+        rows = self.rows
+        for row_idx in range(1, max_row + 1):
+            row = rows.get(row_idx, ())
+            yield row_idx, [(col_idx, value) for col_idx, value in enumerate(row, 1) if value is not None]
+
+    def iter_rows(self, min_row=None, max_row=None, min_col=None, max_col=None, values_only=False):
+        """
+        Строки min_row..max_row в колонках min_col..max_col (по умолчанию - весь
+        лист), как у openpyxl: кортежи ячеек или, с values_only, значений.
+        """
+        min_row, min_col = min_row or 1, min_col or 1
+        max_row = self.max_row if max_row is None else max_row
+        max_col = self.max_column if max_col is None else max_col
+        width = max_col - min_col + 1
+        for row_idx in range(min_row, max_row + 1):
+            if values_only:
+                row = self.rows.get(row_idx, ())
+                if min_col > 1 or len(row) > max_col:
+                    row = row[min_col - 1:max_col]
+                yield row if len(row) == width else row + (None,) * (width - len(row))
+            else:
+                yield tuple(self.cell(row_idx, col_idx) for col_idx in range(min_col, max_col + 1))
+
+
+class StreamedWorkbook:
+    """
+    Книга-источник из StreamedSheet в порядке листов файла. Листы диаграмм
+    (chartsheet) ячеек не содержат и в книгу не попадают: sheetnames здесь
+    совпадает с openpyxl wb.worksheets, а не с wb.sheetnames.
+    """
+
+    def __init__(self, sheets):
+        self._sheets = {ws.title: ws for ws in sheets}
+
+    @property
+    def sheetnames(self):
+        return list(self._sheets)
+
+    @property
+    def worksheets(self):
+        return list(self._sheets.values())
+
+    def __getitem__(self, name):
+        return self._sheets[name]
+
+    def __contains__(self, name):
+        return name in self._sheets
+
+    def close(self):
+        pass
+
+
+def _text_content(element):
+    """Текст строки (<si> или <is>): <t> и <r><t>, без фонетических подсказок (<rPh>)."""
+    parts = []
+    for child in element:
+        if child.tag == _TEXT_TAG:
+            parts.append(child.text or '')
+        elif child.tag == _RUN_TAG:
+            text = child.find(_TEXT_TAG)
+            if text is not None:
+                parts.append(text.text or '')
+    return ''.join(parts)
+
+
+class XlsxStreamReader:
+    """
+    Открытый .xlsx: sheet_paths - {имя листа: путь XML в архиве} в порядке
+    книги (только листы с ячейками, без листов диаграмм), iter_rows(имя) - строки листа по мере разбора, read_sheet(имя) -
+    лист целиком (StreamedSheet). Закрывается close() или через with.
+    """
+
+    def __init__(self, source_file):
+        reader = ExcelReader(source_file, read_only=True, data_only=True)
+        self.archive = reader.archive
+        try:
+            reader.read_manifest()
+            reader.read_workbook()
+            apply_stylesheet(reader.archive, reader.wb)  # форматы дат
+            wb = reader.wb
+            self.epoch = wb.epoch
+            # Номера стилей - как в XML (строками), чтобы не переводить атрибут s каждой ячейки
+            self.date_styles = {str(style_id) for style_id in wb._date_formats}
+            self.timedelta_styles = {str(style_id) for style_id in wb._timedelta_formats}
+            self.sheet_paths = {sheet.name: rel.target for sheet, rel in reader.parser.find_sheets()
+                                if rel.target in reader.valid_files and 'chartsheet' not in rel.Type}
+            self._strings = {}
+            self.shared_strings = self._read_shared_strings(reader.package)
+        except Exception:
+            self.archive.close()
+            raise
+        self._column_indexes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.archive.close()
+
+    def _memo(self, text):
+        # Одинаковые строки - один объект
+        return self._strings.setdefault(text, text)
+
+    def _read_shared_strings(self, package):
+        content_type = package.find(SHARED_STRINGS)
+        if content_type is None:
+            return []
+        strings = []
+        with self.archive.open(content_type.PartName[1:]) as src:
+            for _, element in etree.iterparse(src, events=('end',), tag=_STRING_ITEM_TAG):
+                strings.append(self._memo(_text_content(element).replace('x005F_', '')))
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        return strings
+
+    def _column_index(self, coordinate):
+        letters = coordinate.rstrip(_DIGITS)
+        col_idx = self._column_indexes.get(letters)
+        if col_idx is None:
+            col_idx = self._column_indexes[letters] = column_index_from_string(letters)
+        return col_idx
+
+    def _cell_value(self, cell, data_type):
+        if data_type == 'inlineStr':
+            inline = cell.find(_INLINE_STRING_TAG)
+            return self._memo(_text_content(inline)) if inline is not None else None
+        value = cell.findtext(_VALUE_TAG)
+        if not value:
+            return None
+        if data_type is None or data_type == 'n':
+            value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+            style_id = cell.get('s')
+            if style_id in self.date_styles:
+                try:
+                    return from_excel(value, self.epoch, timedelta=style_id in self.timedelta_styles)
+                except (OverflowError, ValueError):
+                    return '#VALUE!'
+            return value
+        if data_type == 'b':
+            return bool(int(value))
+        if data_type == 'd':
+            return from_ISO8601(value)
+        return self._memo(value)  # 'str' (результат формулы), 'e' (ошибка)
+
+    def iter_rows(self, name, hyperlinks=None):
+        """
+        Строки листа по мере разбора: (номер строки, кортеж значений, скрыта ли).
+        Пустые строки, которых нет в XML, пропускаются. hyperlinks - список,
+        в который добавляются (ref, r:id, location) гиперссылок листа
+        (они в XML после данных, поэтому заполнен только после полного прохода).
+        """
+        shared_strings = self.shared_strings
+        column_index = self._column_index
+        cell_value = self._cell_value
+        row_counter = 0
+        with self.archive.open(self.sheet_paths[name]) as src:
+            for _, element in etree.iterparse(src, events=('end',), tag=(_ROW_TAG, _HYPERLINK_TAG)):
+                if element.tag == _HYPERLINK_TAG:
+                    if hyperlinks is not None:
+                        hyperlinks.append((element.get('ref'), element.get(_REL_ID_ATTR), element.get('location')))
+                    continue
+                row_ref = element.get('r')
+                row_counter = int(row_ref) if row_ref else row_counter + 1
+                values = []
+                col_idx = 0
+                for cell in element:
+                    if cell.tag != _CELL_TAG:
+                        continue
+                    cell_ref = cell.get('r')
+                    col_idx = column_index(cell_ref) if cell_ref else col_idx + 1
+                    data_type = cell.get('t')
+                    if data_type == 's':  # самый частый тип - общая строка
+                        index = cell.findtext(_VALUE_TAG)
+                        value = shared_strings[int(index)] if index else None
+                    else:
+                        value = cell_value(cell, data_type)
+                    if value is None:
+                        continue
+                    if col_idx > len(values):
+                        values.extend([None] * (col_idx - len(values)))
+                    values[col_idx - 1] = value
+                yield row_counter, tuple(values), element.get('hidden') in ('1', 'true')
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+    def read_sheet(self, name):
+        """Лист целиком: значения, скрытые строки и гиперссылки."""
+        rows, hidden_rows, links = {}, [], []
+        for row_idx, values, hidden in self.iter_rows(name, hyperlinks=links):
+            if values:
+                rows[row_idx] = values
+            if hidden:
+                hidden_rows.append(row_idx)
+        return StreamedSheet(name, rows, hidden_rows, self._resolve_hyperlinks(name, links))
+
+    def _resolve_hyperlinks(self, name, links):
+        if not links:
+            return {}
+        sheet_path = self.sheet_paths[name]
+        rels_path = get_rels_path(sheet_path)
+        targets = {}
+        if rels_path in self.archive.namelist():
+            # RelationshipList.get ищет перебором, а ссылок на листе - тысячи
+            targets = {rel.Id: rel.Target for rel in get_dependents(self.archive, rels_path)}
+        hyperlinks = {}
+        for ref, rel_id, _location in links:
+            target = targets.get(rel_id) if rel_id else None
+            min_col, min_row, max_col, max_row = range_boundaries(ref)
+            for row_idx in range(min_row, max_row + 1):
+                for col_idx in range(min_col, max_col + 1):
+                    hyperlinks[(row_idx, col_idx)] = target
+        return hyperlinks
+
+
+def load_workbook(source_file, select_sheets=None):
+    """
+    Книга-источник StreamedWorkbook. select_sheets(имена листов) - какие
+    листы читать (остальные пустые). Возвращает (книга, имена пропущенных листов).
+    """
+    with XlsxStreamReader(source_file) as reader:
+        names = list(reader.sheet_paths)
+        needed = set(names) if select_sheets is None else select_sheets(names)
+        sheets, skipped = [], []
+        for name in names:
+            if name in needed:
+                sheets.append(reader.read_sheet(name))
+            else:
+                sheets.append(StreamedSheet(name))
+                skipped.append(name)
+    return StreamedWorkbook(sheets), skipped
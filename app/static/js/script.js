@@ -24,6 +24,8 @@ document.addEventListener('DOMContentLoaded', function() {
         socket.on('task_complete', function(data) {
             console.log('Socket event (task_complete):', data);
             updateProgress(data.status, 100);
+            const cancelButton = document.getElementById('cancel-task');
+            if (cancelButton) cancelButton.style.display = 'none';
 
             // --- ОБРАБОТКА ПРЕДУПРЕЖДЕНИЙ ---
             if (data.warnings && data.warnings.length > 0) {
@@ -47,6 +49,13 @@ document.addEventListener('DOMContentLoaded', function() {
                          warningList.appendChild(li);
                     }
 
+                    // Сводка по группам; все случаи - в отчете на сервере
+                    const reportLink = document.getElementById('warnings-report-link');
+                    if (reportLink && data.warnings_report) {
+                        reportLink.href = `/download_warnings/${data.task_id}`;
+                        reportLink.style.display = 'inline-block';
+                    }
+
                     warningContainer.style.display = 'block';
                 }
             }
@@ -68,6 +77,27 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
 
+    // --- Отмена задачи ---
+    function showCancelButton(taskId) {
+        const cancelButton = document.getElementById('cancel-task');
+        if (!cancelButton) return;
+        cancelButton.disabled = false;
+        cancelButton.style.display = 'inline-block';
+        cancelButton.onclick = function() {
+            cancelButton.disabled = true;
+            fetch(`/cancel/${taskId}`, { method: 'POST' })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error) { throw new Error(data.error); }
+                    document.getElementById('status-text').textContent = data.status;
+                })
+                .catch(error => {
+                    console.error('Не удалось отменить задачу:', error);
+                    cancelButton.style.display = 'none';
+                });
+        };
+    }
+
     // --- Общая функция обновления UI Прогресс-бара ---
     function updateProgress(status, progress) {
         const statusBar = document.getElementById('progress-bar');
@@ -82,6 +112,94 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
 
+    // --- Загрузка больших файлов по частям ---
+    const CHUNKED_UPLOAD_THRESHOLD = 20 * 1024 * 1024;
+    const CHUNK_MAX_RETRIES = 5;
+    // Сколько ждать запуска задачи, если файл собирает параллельный запрос
+    const UPLOAD_TASK_WAIT_MS = 5 * 60 * 1000;
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    async function sha256Hex(buffer) {
+        // crypto.subtle доступен только по HTTPS/localhost - без него сервер проверит лишь размер
+        if (!window.crypto || !window.crypto.subtle) return null;
+        const digest = await window.crypto.subtle.digest('SHA-256', buffer);
+        return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function getJson(url, options) {
+        const response = await fetch(url, options);
+        const data = await response.json();
+        if (data.error) { throw new Error(data.error); }
+        return data;
+    }
+
+    async function sendChunk(uploadId, index, buffer) {
+        const headers = {'Content-Type': 'application/octet-stream'};
+        const hash = await sha256Hex(buffer);
+        if (hash) headers['X-Chunk-SHA256'] = hash;
+
+        for (let attempt = 1; ; attempt++) {
+            try {
+                return await getJson(`/upload/${uploadId}/chunk/${index}`, { method: 'PUT', headers: headers, body: buffer });
+            } catch (error) {
+                if (attempt >= CHUNK_MAX_RETRIES) throw error;
+                console.warn(`Часть ${index}: попытка ${attempt} не удалась, повторяю...`, error);
+                await sleep(1000 * attempt);
+            }
+        }
+    }
+
+    async function uploadInChunks(file, formData) {
+        // Ключ для докачки: тот же файл с тем же шаблоном продолжит прерванную загрузку
+        const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}:${formData.get('saved_template') || ''}`;
+        let state = null;
+
+        const savedUploadId = localStorage.getItem(resumeKey);
+        if (savedUploadId) {
+            state = await getJson(`/upload/${savedUploadId}`).catch(() => null);
+        }
+
+        if (!state) {
+            const initData = new FormData();
+            initData.append('filename', file.name);
+            initData.append('size', file.size);
+            ['saved_template', 'template_range_start', 'template_file', 'incremental'].forEach(key => {
+                const value = formData.get(key);
+                if (value && !(value instanceof File && !value.name)) initData.append(key, value);
+            });
+            state = await getJson('/upload/init', { method: 'POST', body: initData });
+            localStorage.setItem(resumeKey, state.upload_id);
+        }
+
+        const received = new Set(state.received);
+        for (let index = 0; index < state.total_chunks && !state.complete; index++) {
+            if (received.has(index)) continue;
+            const blob = file.slice(index * state.chunk_size, (index + 1) * state.chunk_size);
+            state = await sendChunk(state.upload_id, index, await blob.arrayBuffer());
+            received.add(index);
+            const percent = Math.floor(received.size * 100 / state.total_chunks);
+            updateProgress(`Загрузка файла на сервер: ${percent}%`, percent);
+        }
+
+        // Сборку файла мог выполнить параллельный запрос - ждем, пока задача будет создана.
+        // Ошибку сборки или запуска задачи сервер возвращает в error (getJson ее выбросит)
+        const deadline = Date.now() + UPLOAD_TASK_WAIT_MS;
+        while (!state.task_id) {
+            if (Date.now() > deadline) {
+                throw new Error('Сервер не запустил задачу после загрузки файла. Попробуйте еще раз.');
+            }
+            await sleep(1000);
+            state = await getJson(`/upload/${state.upload_id}`);
+        }
+
+        localStorage.removeItem(resumeKey);
+        return {task_id: state.task_id};
+    }
+
+
     // --- Логика для главной страницы (index.html) ---
     const form = document.getElementById('process-form');
     const savedTemplateSelect = document.getElementById('saved_template');
@@ -131,15 +249,21 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             updateProgress('Загрузка файлов на сервер...', 0);
 
-            // Отправляем файлы на /process
-            fetch(form.action, { method: 'POST', body: formData })
-                .then(response => response.json())
+            // Большие файлы отправляем по частям (с возможностью докачки),
+            // остальные - одним запросом на /process
+            const sourceFile = formData.get('source_file');
+            const startRequest = (sourceFile && sourceFile.size > CHUNKED_UPLOAD_THRESHOLD)
+                ? uploadInChunks(sourceFile, formData)
+                : fetch(form.action, { method: 'POST', body: formData }).then(response => response.json());
+
+            startRequest
                 .then(data => {
                     if (data.error) { throw new Error(data.error); }
 
                     if (socket && data.task_id) {
                         console.log('Подписка на комнату:', data.task_id);
                         socket.emit('join_task_room', {'task_id': data.task_id});
+                        showCancelButton(data.task_id);
                     } else {
                         throw new Error('Не удалось подключиться к WebSocket для отслеживания задачи.');
                     }
@@ -42,3 +42,43 @@ def find_column_indices(worksheet, start_row, headers_to_find):
         # Ошибка, если start_row не существует
         pass
     return indices
+
+
+def get_data_extent(worksheet, columns=None):
+    """
+    Номер последней строки листа, в которой есть значение (0, если значений нет).
+    columns - индексы колонок, которые учитываются (None - все колонки).
+
+    В отличие от worksheet.max_row не учитывает ячейки только с форматированием:
+    у листов, отформатированных "до конца", max_row равен 1 048 576.
+    """
+    if hasattr(worksheet, 'data_extent'):  # лист потокового чтения (services/xlsx_reader.py)
+        return worksheet.data_extent(columns)
+    last_row = 0
+    # ws._cells содержит только существующие ячейки и не создает новые при чтении
+    for (row_idx, col_idx), cell in worksheet._cells.items():
+        if row_idx <= last_row or cell.value is None:
+            continue
+        if columns is None or col_idx in columns:
+            last_row = row_idx
+    return last_row
+
+
+def iter_row_values(worksheet, max_row):
+    """
+    Непустые значения строк 1..max_row: (номер строки, [(колонка, значение), ...]).
+    Одинаково для листов openpyxl и потокового чтения, поэтому отпечатки
+    источника не зависят от SOURCE_READER.
+    """
+    if hasattr(worksheet, 'iter_row_values'):
+        yield from worksheet.iter_row_values(max_row)
+        return
+    cells = worksheet._cells
+    columns = sorted({col_idx for (_, col_idx), cell in cells.items() if cell.value is not None})
+    for row_idx in range(1, max_row + 1):
+        row = []
+        for col_idx in columns:
+            cell = cells.get((row_idx, col_idx))
+            if cell is not None and cell.value is not None:
+                row.append((col_idx, cell.value))
+        yield row_idx, row
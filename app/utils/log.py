@@ -0,0 +1,105 @@
+# app/utils/log.py
+"""
+Логирование приложения.
+
+Все логгеры пакета 'app' (logging.getLogger(__name__) в модулях и
+app.logger самого Flask) пишут через QueueHandler: запись только кладется
+в очередь, а форматирование и вывод в поток выполняет отдельный поток
+QueueListener. Так обработка задачи не ждет синхронной записи в stdout.
+
+К каждой записи добавляется task_id текущей задачи (см. TaskLogContext),
+поэтому в сообщениях его не нужно повторять.
+
+Поток QueueListener не переживает fork (gunicorn с preload_app создает
+приложение в мастере): дочерний процесс сразу после fork получает свою
+очередь и свой поток, иначе его записи копились бы в очереди, которую
+никто не читает.
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(task_id)s] %(name)s: %(message)s'
+
+_task_id = ContextVar('task_id', default='-')
+_listener = None
+_queue_handler = None
+
+
+class TaskContextFilter(logging.Filter):
+    """Добавляет к записи task_id задачи, в контексте которой она создана."""
+
+    def filter(self, record):
+        record.task_id = _task_id.get()
+        return True
+
+
+class TaskLogContext:
+    """
+    Все записи лога внутри контекста помечаются task_id.
+    Используется как with TaskLogContext(task_id): ... или, как контекст
+    приложения Flask, через push()/pop().
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self._token = None
+
+    def push(self):
+        self._token = _task_id.set(self.task_id)
+
+    def pop(self):
+        _task_id.reset(self._token)
+
+    def __enter__(self):
+        self.push()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pop()
+
+
+def setup_logging(app):
+    """
+    Настраивает логгер 'app': уровень LOG_LEVEL из конфигурации и вывод
+    через очередь. Повторный вызов (несколько create_app в одном процессе)
+    только обновляет уровень.
+    """
+    global _queue_handler
+    logger = logging.getLogger('app')
+    logger.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    _queue_handler = QueueHandler(queue.SimpleQueue())
+    # Фильтр выполняется в потоке, создавшем запись, - там, где известен task_id
+    _queue_handler.addFilter(TaskContextFilter())
+    logger.addHandler(_queue_handler)
+    logger.propagate = False
+
+    _start_listener(stream_handler)
+    atexit.register(_stop_listener)
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+def _start_listener(*handlers):
+    global _listener
+    _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener():
+    # Записи, не выведенные родителем до fork, остаются ему
+    _queue_handler.queue = queue.SimpleQueue()
+    _start_listener(*_listener.handlers)
+
+
+def _stop_listener():
+    _listener.stop()
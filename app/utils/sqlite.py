@@ -0,0 +1,48 @@
+# app/utils/sqlite.py
+"""
+Соединения с файлами SQLite служебных хранилищ (состояние задач, очередь
+заданий). Эти файлы общие для всех процессов приложения, поэтому:
+WAL (чтение не блокируется записью), ожидание блокировки вместо ошибки
+'database is locked' и отдельное соединение на поток и на процесс
+(после fork соединение родителя не используется).
+"""
+import os
+import sqlite3
+import threading
+
+
+class SQLiteFile:
+    def __init__(self, path, busy_timeout_ms=5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def connection(self):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def transaction(self):
+        """
+        with db.transaction() as conn: ... - BEGIN IMMEDIATE / COMMIT / ROLLBACK.
+        Блокировка записи берется сразу, поэтому чтение и запись внутри
+        транзакции не пересекаются с другими процессами.
+        """
+        return _Transaction(self.connection())
+
+
+class _Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,101 @@
+# benchmarks/geocoder.py
+"""
+Бенчмарк базы адресов геокодера (geocoding_service.AddressIndex) на
+синтетическом справочнике: время загрузки CSV, память индекса (байт на
+адрес, по tracemalloc, без cKDTree), время точного поиска "адрес ->
+координаты" и нечеткого поиска.
+
+    python -m benchmarks.geocoder                      # 200 000 адресов
+    python -m benchmarks.geocoder --addresses 50000    # объем справочника
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import synthetic
+
+
+def run(addresses, lookups, fuzzy_lookups):
+    from app.services.geocoding_service import AddressIndex, _normalize_address_string
+
+    directory = tempfile.mkdtemp(prefix='bench-geocoder-')
+    try:
+        path = os.path.join(directory, 'addresses.csv')
+        synthetic.make_addresses_csv(path, addresses)
+
+        started = time.perf_counter()
+        AddressIndex.from_csv(path)
+        load = time.perf_counter() - started
+        # Память - отдельной загрузкой: tracemalloc заметно замедляет выделения
+        gc.collect()
+        tracemalloc.start()
+        index = AddressIndex.from_csv(path)
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    rnd = random.Random(0)
+    queries = [index.address(rnd.randrange(len(index))) for _ in range(lookups)]
+    started = time.perf_counter()
+    for query in queries:
+        index.lookup(_normalize_address_string(query))
+    exact = time.perf_counter() - started
+
+    from thefuzz import process as fuzz_process
+    started = time.perf_counter()
+    for query in queries[:fuzzy_lookups]:
+        fuzz_process.extractOne(_normalize_address_string(query + ' корп. 2'), index.keys())
+    fuzzy = time.perf_counter() - started
+
+    return {
+        'addresses': len(index),
+        'load': round(load, 3),
+        'retained_mb': round(retained / (1024 * 1024), 1),
+        'load_peak_mb': round(peak / (1024 * 1024), 1),
+        'bytes_per_address': round(retained / len(index)) if len(index) else 0,
+        'exact_us': round(exact / lookups * 1e6, 2),
+        'fuzzy_ms': round(fuzzy / fuzzy_lookups * 1e3, 1) if fuzzy_lookups else None,
+    }
+
+
+def format_report(result):
+    fuzzy = '-' if result['fuzzy_ms'] is None else f"{result['fuzzy_ms']:.1f} мс"
+    return '\n'.join([
+        f"адресов:           {result['addresses']}",
+        f"загрузка:          {result['load']:.3f} с",
+        f"память индекса:    {result['retained_mb']:.1f} МБ ({result['bytes_per_address']} байт на адрес), "
+        f"пик при загрузке {result['load_peak_mb']:.1f} МБ",
+        f"точный поиск:      {result['exact_us']:.2f} мкс",
+        f"нечеткий поиск:    {fuzzy}",
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк базы адресов геокодера.")
+    parser.add_argument('--addresses', type=int, default=200000, help="адресов в справочнике")
+    parser.add_argument('--lookups', type=int, default=50000, help="запросов точного поиска")
+    parser.add_argument('--fuzzy', type=int, default=3, help="запросов нечеткого поиска")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    args = parser.parse_args(argv)
+    if args.addresses < 1 or args.lookups < 1:
+        parser.error("--addresses и --lookups должны быть положительными")
+
+    result = run(args.addresses, args.lookups, args.fuzzy)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+# benchmarks/pipeline.py
+"""
+Бенчмарк конвейера обработки (process_excel_hybrid) на синтетических книгах.
+
+Каждый сценарий выполняется в отдельном процессе, чтобы пиковая память
+(ru_maxrss) относилась только к нему. Книги генерируются заранее и в замер
+не входят.
+
+    python -m benchmarks.pipeline                      # все сценарии
+    python -m benchmarks.pipeline medium formulas -r 5 # выбранные сценарии, 5 повторов
+    python -m benchmarks.pipeline --scale 0.1          # уменьшенные объемы (быстрая проверка)
+    python -m benchmarks.pipeline --save-baseline      # записать benchmarks/baseline.json
+    python -m benchmarks.pipeline --compare            # сравнить с baseline, код 1 при регрессии
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Этапы в порядке выполнения (см. excel_processor.process_excel_hybrid)
+STAGES = ['load', 'cell_mappings', 'plan', 'source_cell_fill', 'columns', 'static', 'formulas', 'geocoding',
+          'write', 'save']
+
+# Параметры генератора: rows, cols, sheets, hidden_every, hyperlink_every,
+# formula_rules, static_rules, fill_rules, cell_mappings, addresses, visible_rows_only
+SCENARIOS = {
+    'small': dict(rows=1000, cols=10, static_rules=1, formula_rules=1),
+    'medium': dict(rows=20000, cols=20, formula_rules=3, static_rules=2, fill_rules=1, cell_mappings=5),
+    'wide': dict(rows=5000, cols=80),
+    'multisheet': dict(rows=5000, cols=10, sheets=3),
+    'hidden_links': dict(rows=20000, cols=10, hidden_every=7, hyperlink_every=5, visible_rows_only=True),
+    'formulas': dict(rows=20000, cols=8, formula_rules=10),
+    'geocoding': dict(rows=5000, cols=6, addresses=2000),
+}
+
+_SIZE_PARAMS = ('rows',)
+
+
+def scaled(params, scale):
+    """Параметры сценария с количеством строк, умноженным на scale."""
+    params = dict(params)
+    for key in _SIZE_PARAMS:
+        params[key] = max(10, int(params[key] * scale))
+    return params
+
+
+def generate_case(params, directory):
+    """Записывает книги, справочник адресов и правила сценария в directory."""
+    addresses = params.get('addresses', 0)
+    template_cols, rules = synthetic.make_rules(
+        params['cols'], sheets=params.get('sheets', 1), formula_rules=params.get('formula_rules', 0),
+        static_rules=params.get('static_rules', 0), fill_rules=params.get('fill_rules', 0),
+        cell_mappings=params.get('cell_mappings', 0), geocoding=bool(addresses))
+    rules['visible_rows_only'] = params.get('visible_rows_only', False)
+
+    source = synthetic.make_source_workbook(
+        params['rows'], params['cols'], sheets=params.get('sheets', 1), hidden_every=params.get('hidden_every', 0),
+        hyperlink_every=params.get('hyperlink_every', 0), address_count=addresses)
+    template_rows = params['rows'] if params.get('fill_rules') else 0
+    template = synthetic.make_template_workbook(template_cols, rows=template_rows, geocoding=bool(addresses))
+
+    with open(os.path.join(directory, 'source.xlsx'), 'wb') as f:
+        f.write(source.getvalue())
+    with open(os.path.join(directory, 'template.xlsx'), 'wb') as f:
+        f.write(template.getvalue())
+    with open(os.path.join(directory, 'rules.json'), 'w', encoding='utf-8') as f:
+        json.dump(rules, f, ensure_ascii=False)
+    if addresses:
+        synthetic.make_addresses_csv(os.path.join(directory, 'addresses.csv'), addresses)
+
+
+def _peak_rss_mb():
+    # На Linux ru_maxrss в килобайтах, на macOS - в байтах
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(directory, repeat):
+    """
+    Выполняет сценарий из directory repeat раз в текущем процессе.
+    Возвращает медианы времени этапов, пропускную способность и пиковую память.
+    """
+    from app import create_app
+    from app.config import Config
+    from app.extensions import db, task_statuses
+    from app.services.excel_processor import process_excel_hybrid
+
+    for key in ('UPLOAD_FOLDER', 'PROCESSED_FOLDER', 'TEMPLATES_DB_FOLDER', 'TEMPLATE_EXCEL_FOLDER',
+                'DICTIONARIES_FOLDER', 'GEOCODING_DATA_FOLDER'):
+        setattr(Config, key, os.path.join(directory, key.lower()))
+    Config.ADDRESS_CSV_FILE = os.path.join(directory, 'addresses.csv')
+    Config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+    Config.JOB_QUEUE_WEB_WORKERS = 0
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+
+    with open(os.path.join(directory, 'rules.json'), encoding='utf-8') as f:
+        rules = json.load(f)
+    with open(os.path.join(directory, 'source.xlsx'), 'rb') as f:
+        source_bytes = f.read()
+    with open(os.path.join(directory, 'template.xlsx'), 'rb') as f:
+        template_bytes = f.read()
+
+    rss_before = _peak_rss_mb()
+    runs = []
+    for i in range(repeat):
+        task_id = f"bench-{i}"
+        task_statuses.create(task_id, {'owner_id': None})
+        started = time.perf_counter()
+        # Отладочный вывод обработчика в результат не попадает
+        with contextlib.redirect_stdout(io.StringIO()):
+            process_excel_hybrid(
+                app, task_id, io.BytesIO(source_bytes), io.BytesIO(template_bytes), {'t_start_row': 1},
+                rules['sheet_settings'], rules['template_rules'], rules['post_function'], 'template.xlsx',
+                task_statuses, cell_mappings=rules['cell_mappings'], formula_rules=rules['formula_rules'],
+                static_value_rules=rules['static_value_rules'], visible_rows_only=rules['visible_rows_only'],
+                source_cell_fill_rules=rules['source_cell_fill_rules'])
+        wall = time.perf_counter() - started
+        task = task_statuses.get(task_id)
+        task_statuses.delete(task_id)
+        if not task.get('result_ready'):
+            raise RuntimeError(f"Сценарий завершился с ошибкой: {task.get('warnings')}")
+        runs.append((wall, task['metrics']))
+
+    metrics = runs[-1][1]
+    stages = {stage: statistics.median(m['stages'].get(stage, 0.0) for _, m in runs)
+              for stage in STAGES if any(stage in m['stages'] for _, m in runs)}
+    wall = statistics.median(w for w, _ in runs)
+    rows = metrics['counters'].get('rows_written', 0)
+    source_mb = metrics['counters'].get('source_bytes', 0) / (1024 * 1024)
+    return {
+        'wall': round(wall, 4),
+        'stages': {stage: round(seconds, 4) for stage, seconds in stages.items()},
+        'rows': rows,
+        'rows_per_sec': round(rows / wall) if wall else 0,
+        'source_mb_per_sec': round(source_mb / wall, 3) if wall else 0,
+        'result_bytes': metrics['counters'].get('result_bytes', 0),
+        'rss_start_mb': round(rss_before, 1),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+
+def run_scenario(name, params, repeat):
+    """Генерирует книги сценария и выполняет его в отдельном процессе."""
+    directory = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        # Книги генерируются тоже в отдельном процессе: на Linux ru_maxrss
+        # наследуется дочерними процессами, и пик генератора попал бы в замер
+        subprocess.run([sys.executable, '-m', 'benchmarks.pipeline', '--generate-case', directory,
+                        '--params', json.dumps(params)], check=True, cwd=cwd)
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.pipeline', '--run-case', directory, '--repeat', str(repeat)],
+            check=True, capture_output=True, text=True, cwd=cwd)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        result['params'] = params
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_report(results, baseline=None):
+    lines = []
+    header = f"{'сценарий':<14}{'всего, с':>10}{'строк/с':>10}{'МБ/с':>8}{'RSS, МБ':>9}  этапы"
+    lines.append(header)
+    lines.append('-' * len(header))
+    for name, result in results.items():
+        stages = ', '.join(f"{stage} {seconds:.3f}" for stage, seconds in result['stages'].items() if seconds >= 0.001)
+        line = (f"{name:<14}{result['wall']:>10.3f}{result['rows_per_sec']:>10}{result['source_mb_per_sec']:>8.2f}"
+                f"{result['peak_rss_mb']:>9.1f}  {stages}")
+        if baseline and name in baseline.get('scenarios', {}):
+            line += f"  [{result['wall'] / baseline['scenarios'][name]['wall']:.2f}x от baseline]"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def compare(results, baseline, tolerance, min_delta=0.05):
+    """
+    Регрессии относительно baseline: общее время и время этапов, выросшие
+    больше чем на tolerance (и больше чем на min_delta секунд, чтобы не
+    реагировать на шум коротких этапов).
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None or base.get('params') != result['params']:
+            continue
+        checks = [('всего', result['wall'], base['wall'])]
+        checks += [(stage, seconds, base['stages'].get(stage, 0.0)) for stage, seconds in result['stages'].items()]
+        for label, current, previous in checks:
+            if current - previous > min_delta and current > previous * (1 + tolerance):
+                regressions.append(f"{name}/{label}: {previous:.3f} с -> {current:.3f} с")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк process_excel_hybrid на синтетических книгах.")
+    parser.add_argument('scenarios', nargs='*', help=f"сценарии (по умолчанию все: {', '.join(SCENARIOS)})")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="повторов на сценарий (берется медиана)")
+    parser.add_argument('--scale', type=float, default=1.0, help="множитель количества строк")
+    parser.add_argument('--save-baseline', action='store_true', help="сохранить результат в baseline.json")
+    parser.add_argument('--compare', action='store_true', help="сравнить с baseline.json")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое замедление (0.2 = 20%%)")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--generate-case', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.generate_case:
+        generate_case(json.loads(args.params), args.generate_case)
+        return 0
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.repeat)))
+        return 0
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        results[name] = run_scenario(name, scaled(SCENARIOS[name], args.scale), args.repeat)
+        if not args.json:
+            print(f"{name}: {results[name]['wall']:.3f} с", file=sys.stderr)
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(results, baseline))
+
+    if args.save_baseline:
+        data = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scenarios': results,
+        }
+        with open(BASELINE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"Baseline сохранен: {BASELINE_FILE}")
+
+    if args.compare:
+        if baseline is None:
+            print("Baseline не найден: запустите с --save-baseline.")
+            return 1
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Замедление относительно baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("Регрессий относительно baseline нет.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
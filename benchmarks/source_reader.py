@@ -0,0 +1,167 @@
+# benchmarks/source_reader.py
+"""
+Бенчмарк чтения книги-источника: openpyxl против потокового чтения
+(services/xlsx_reader.py) на синтетической книге со скрытыми строками и
+гиперссылками.
+
+    openpyxl            load_workbook(data_only=True) - SOURCE_READER=openpyxl
+    openpyxl_read_only  load_workbook(read_only=True) и обход iter_rows
+                        (без скрытости строк и гиперссылок - для сравнения)
+    stream              xlsx_reader.load_workbook - SOURCE_READER=stream
+
+Каждый способ выполняется в отдельном процессе, чтобы пиковая память
+(ru_maxrss) относилась только к нему. Книга генерируется заранее и в замер
+не входит.
+
+    python -m benchmarks.source_reader                     # 100 000 строк, все способы
+    python -m benchmarks.source_reader --rows 20000 -r 5   # объем и повторы
+    python -m benchmarks.source_reader stream openpyxl     # выбранные способы
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+from benchmarks.pipeline import _peak_rss_mb
+
+BACKENDS = ('openpyxl', 'openpyxl_read_only', 'stream')
+
+
+def _read_openpyxl(data):
+    from openpyxl import load_workbook
+    wb = load_workbook(io.BytesIO(data), data_only=True)
+    values = sum(1 for ws in wb.worksheets for cell in ws._cells.values() if cell.value is not None)
+    hidden = sum(1 for ws in wb.worksheets for dim in ws.row_dimensions.values() if dim.hidden)
+    links = sum(1 for ws in wb.worksheets for cell in ws._cells.values() if cell.hyperlink)
+    return wb, values, hidden, links
+
+
+def _read_openpyxl_read_only(data):
+    from openpyxl import load_workbook
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    values = sum(1 for ws in wb.worksheets for row in ws.iter_rows(values_only=True)
+                 for value in row if value is not None)
+    wb.close()
+    return wb, values, None, None
+
+
+def _read_stream(data):
+    from app.services import xlsx_reader
+    wb, _ = xlsx_reader.load_workbook(io.BytesIO(data))
+    values = sum(1 for ws in wb.worksheets for row in ws.rows.values() for value in row if value is not None)
+    hidden = sum(len(ws.hidden_rows) for ws in wb.worksheets)
+    links = sum(len(ws.hyperlinks) for ws in wb.worksheets)
+    return wb, values, hidden, links
+
+
+_READERS = {
+    'openpyxl': _read_openpyxl,
+    'openpyxl_read_only': _read_openpyxl_read_only,
+    'stream': _read_stream,
+}
+
+
+def run_case(path, backend, repeat):
+    """
+    Читает книгу path способом backend repeat раз в текущем процессе.
+    Возвращает медиану времени, пиковую память и число прочитанных значений,
+    скрытых строк и гиперссылок (None - способ их не читает).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    rss_before = _peak_rss_mb()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        wb, values, hidden, links = _READERS[backend](data)
+        times.append(time.perf_counter() - started)
+        del wb
+    return {
+        'wall': round(statistics.median(times), 4),
+        'values': values,
+        'hidden_rows': hidden,
+        'hyperlinks': links,
+        'rss_start_mb': round(rss_before, 1),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+
+def run_backends(backends, rows, cols, repeat):
+    """Генерирует книгу и выполняет каждый способ чтения в отдельном процессе."""
+    directory = tempfile.mkdtemp(prefix='bench-reader-')
+    try:
+        path = os.path.join(directory, 'source.xlsx')
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # Книга генерируется тоже в отдельном процессе: на Linux ru_maxrss
+        # наследуется дочерними процессами, и пик генератора попал бы в замеры
+        subprocess.run([sys.executable, '-m', 'benchmarks.source_reader', '--generate', path,
+                        '--rows', str(rows), '--cols', str(cols)], check=True, cwd=cwd)
+        results = {}
+        for backend in backends:
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.source_reader', '--run-case', path, '--backend', backend,
+                 '--repeat', str(repeat)],
+                check=True, capture_output=True, text=True, cwd=cwd)
+            results[backend] = json.loads(output.stdout.strip().splitlines()[-1])
+            results[backend]['source_mb'] = round(os.path.getsize(path) / (1024 * 1024), 2)
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_report(results, rows):
+    lines = []
+    header = f"{'способ':<20}{'время, с':>10}{'строк/с':>10}{'RSS, МБ':>9}{'значений':>11}{'скрытых':>9}{'ссылок':>8}"
+    lines.append(header)
+    lines.append('-' * len(header))
+    for backend, result in results.items():
+        def count(key):
+            return '-' if result[key] is None else result[key]
+        rows_per_sec = round(rows / result['wall']) if result['wall'] else 0
+        lines.append(f"{backend:<20}{result['wall']:>10.3f}{rows_per_sec:>10}{result['peak_rss_mb']:>9.1f}"
+                     f"{result['values']:>11}{count('hidden_rows'):>9}{count('hyperlinks'):>8}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк чтения книги-источника: openpyxl и потоковое чтение.")
+    parser.add_argument('backends', nargs='*', help=f"способы чтения (по умолчанию все: {', '.join(BACKENDS)})")
+    parser.add_argument('--rows', type=int, default=100000, help="строк в книге")
+    parser.add_argument('--cols', type=int, default=10, help="колонок в книге")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="повторов (берется медиана)")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    parser.add_argument('--generate', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        source = synthetic.make_source_workbook(args.rows, args.cols, hidden_every=7, hyperlink_every=5)
+        with open(args.generate, 'wb') as f:
+            f.write(source.getvalue())
+        return 0
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.backend, args.repeat)))
+        return 0
+
+    unknown = [name for name in args.backends if name not in BACKENDS]
+    if unknown:
+        parser.error(f"неизвестные способы чтения: {', '.join(unknown)}")
+
+    results = run_backends(args.backends or BACKENDS, args.rows, args.cols, args.repeat)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(results, args.rows))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
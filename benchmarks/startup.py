@@ -0,0 +1,162 @@
+# benchmarks/startup.py
+"""
+Бенчмарк запуска веб-процесса: время импорта пакета app и вызова
+create_app() (регистрация маршрутов импортирует все сервисы), память
+процесса после запуска и какие тяжелые библиотеки при этом загружены.
+
+Библиотеки LAZY_MODULES (scipy, thefuzz/rapidfuzz) нужны только
+постобработке и должны загружаться при первом использовании: если
+create_app() загрузил любую из них, --compare считает это регрессией
+независимо от времени.
+
+Каждый замер - в новом процессе (импорт выполняется один раз за процесс).
+
+    python -m benchmarks.startup                   # 5 запусков, медиана
+    python -m benchmarks.startup --save-baseline   # записать benchmarks/startup_baseline.json
+    python -m benchmarks.startup --compare         # сравнить с baseline, код 1 при регрессии
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_baseline.json')
+
+LAZY_MODULES = ('scipy', 'thefuzz', 'rapidfuzz')
+
+
+def run_case(directory):
+    """Импортирует app и вызывает create_app() в текущем (новом) процессе."""
+    started = time.perf_counter()
+    from app import create_app
+    from app.config import Config
+    imported = time.perf_counter()
+
+    for key in ('UPLOAD_FOLDER', 'PROCESSED_FOLDER', 'TEMPLATES_DB_FOLDER', 'TEMPLATE_EXCEL_FOLDER',
+                'DICTIONARIES_FOLDER', 'GEOCODING_DATA_FOLDER'):
+        setattr(Config, key, os.path.join(directory, key.lower()))
+    Config.ADDRESS_CSV_FILE = os.path.join(directory, 'addresses.csv')
+    Config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+    Config.JOB_QUEUE_WEB_WORKERS = 0
+    created_at = time.perf_counter()
+    create_app()
+    finished = time.perf_counter()
+    modules = len(sys.modules)
+    lazy_loaded = sorted(name for name in LAZY_MODULES if name in sys.modules)
+
+    # Импорт benchmarks.pipeline тянет openpyxl/numpy - только после замеров
+    from benchmarks.pipeline import _peak_rss_mb
+    return {
+        'import': round(imported - started, 4),
+        'create_app': round(finished - created_at, 4),
+        'wall': round(finished - started - (created_at - imported), 4),
+        'modules': modules,
+        'lazy_loaded': lazy_loaded,
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+
+def run(repeat):
+    """repeat запусков, каждый в отдельном процессе; медианы времени и памяти."""
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeat):
+        directory = tempfile.mkdtemp(prefix='bench-startup-')
+        try:
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--run-case', directory],
+                                    check=True, capture_output=True, text=True, cwd=cwd)
+            runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    result = {key: round(statistics.median(r[key] for r in runs), 4)
+              for key in ('import', 'create_app', 'wall', 'peak_rss_mb')}
+    result['modules'] = runs[-1]['modules']
+    result['lazy_loaded'] = sorted({name for r in runs for name in r['lazy_loaded']})
+    return result
+
+
+def format_report(result, baseline=None):
+    lines = [
+        f"импорт app:     {result['import']:.3f} с",
+        f"create_app():   {result['create_app']:.3f} с",
+        f"всего:          {result['wall']:.3f} с",
+        f"RSS:            {result['peak_rss_mb']:.1f} МБ",
+        f"модулей:        {result['modules']}",
+        f"загружены зря:  {', '.join(result['lazy_loaded']) or 'нет'}",
+    ]
+    if baseline:
+        lines.append(f"baseline:       {baseline['wall']:.3f} с, {baseline['peak_rss_mb']:.1f} МБ "
+                     f"[{result['wall'] / baseline['wall']:.2f}x]")
+    return '\n'.join(lines)
+
+
+def compare(result, baseline, tolerance, min_delta=0.05):
+    """
+    Регрессии относительно baseline: время запуска выросло больше чем на
+    tolerance (и больше чем на min_delta секунд) или при запуске загружены
+    библиотеки из LAZY_MODULES.
+    """
+    regressions = [f"при запуске загружен {name}" for name in result['lazy_loaded']]
+    if result['wall'] - baseline['wall'] > min_delta and result['wall'] > baseline['wall'] * (1 + tolerance):
+        regressions.append(f"запуск: {baseline['wall']:.3f} с -> {result['wall']:.3f} с")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк запуска веб-процесса: импорт app и create_app().")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="запусков (берется медиана)")
+    parser.add_argument('--save-baseline', action='store_true', help="сохранить результат в startup_baseline.json")
+    parser.add_argument('--compare', action='store_true', help="сравнить с startup_baseline.json")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое замедление (0.2 = 20%%)")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case)))
+        return 0
+
+    result = run(args.repeat)
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(result, baseline and baseline['startup']))
+
+    if args.save_baseline:
+        data = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'startup': result,
+        }
+        with open(BASELINE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"Baseline сохранен: {BASELINE_FILE}")
+
+    if args.compare:
+        if baseline is None:
+            print("Baseline не найден: запустите с --save-baseline.")
+            return 1
+        regressions = compare(result, baseline['startup'], args.tolerance)
+        if regressions:
+            print("Регрессия запуска относительно baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("Регрессий относительно baseline нет.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+# benchmarks/status_rps.py
+"""
+Бенчмарк опроса статуса задачи (GET /status/<task_id>): запросов в секунду
+с кэшем пользователей Flask-Login (USER_CACHE_TTL) и без него.
+
+Запросы выполняет тестовый клиент Flask (без сети), так что замер
+показывает стоимость обработки запроса в приложении: сессия, загрузка
+пользователя, чтение состояния задачи. threads клиентов опрашивают статус
+одновременно, как несколько открытых вкладок; у каждого клиента свой
+пользователь.
+
+    python -m benchmarks.status_rps                      # 2000 запросов, 4 клиента
+    python -m benchmarks.status_rps --requests 5000 -r 5 # объем и повторы
+    python -m benchmarks.status_rps --threads 1          # один клиент
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+MODES = {
+    'без кэша': 0,
+    'с кэшем': 30,
+}
+
+
+def _create_app(directory):
+    from app import create_app
+    from app.config import Config
+    from app.extensions import db
+
+    for key in ('UPLOAD_FOLDER', 'PROCESSED_FOLDER', 'TEMPLATES_DB_FOLDER', 'TEMPLATE_EXCEL_FOLDER',
+                'DICTIONARIES_FOLDER', 'GEOCODING_DATA_FOLDER'):
+        setattr(Config, key, os.path.join(directory, key.lower()))
+    Config.ADDRESS_CSV_FILE = os.path.join(directory, 'addresses.csv')
+    Config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+    Config.JOB_QUEUE_WEB_WORKERS = 0
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _clients(app, threads):
+    """По клиенту на поток: свой пользователь, вход и задача."""
+    from app.extensions import task_statuses
+    from app.services import user_service
+
+    clients = []
+    for i in range(threads):
+        with app.app_context():
+            user_id = user_service.create_user(f"bench{i}", 'secret').id
+        task_id = f"bench-status-{i}"
+        task_statuses.create(task_id, {'owner_id': user_id, 'status': 'Обработка...', 'progress': 50})
+        client = app.test_client()
+        client.post('/login', data={'username': f"bench{i}", 'password': 'secret'})
+        clients.append((client, f"/status/{task_id}"))
+    return clients
+
+
+def _poll(clients, per_client):
+    """Все клиенты одновременно делают по per_client запросов; время в секундах."""
+    errors = []
+
+    def worker(client, url):
+        for _ in range(per_client):
+            response = client.get(url)
+            if response.status_code != 200 or 'progress' not in response.get_json():
+                errors.append(response.status_code)
+                return
+
+    threads = [threading.Thread(target=worker, args=pair) for pair in clients]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if errors:
+        raise RuntimeError(f"Ошибочные ответы /status: {errors}")
+    return elapsed
+
+
+def run(requests, threads, repeat):
+    """Замер каждого режима repeat раз; медиана запросов в секунду."""
+    from app.services import user_service
+
+    directory = tempfile.mkdtemp(prefix='bench-status-')
+    try:
+        app = _create_app(directory)
+        clients = _clients(app, threads)
+        per_client = max(1, requests // threads)
+        total = per_client * threads
+        _poll(clients, min(per_client, 50))  # прогрев
+        results = {}
+        for mode, ttl in MODES.items():
+            app.config['USER_CACHE_TTL'] = ttl
+            user_service.user_cache.invalidate()
+            times = [_poll(clients, per_client) for _ in range(repeat)]
+            wall = statistics.median(times)
+            results[mode] = {
+                'requests': total,
+                'wall': round(wall, 4),
+                'rps': round(total / wall) if wall else 0,
+                'ms_per_request': round(wall / total * 1000, 3),
+            }
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_report(results):
+    lines = []
+    header = f"{'режим':<12}{'запросов':>10}{'время, с':>10}{'запр./с':>10}{'мс/запр.':>10}"
+    lines.append(header)
+    lines.append('-' * len(header))
+    for mode, result in results.items():
+        lines.append(f"{mode:<12}{result['requests']:>10}{result['wall']:>10.3f}{result['rps']:>10}"
+                     f"{result['ms_per_request']:>10.3f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк GET /status: запросов в секунду с кэшем "
+                                                 "пользователей и без него.")
+    parser.add_argument('--requests', type=int, default=2000, help="запросов на замер (всего по всем клиентам)")
+    parser.add_argument('--threads', type=int, default=4, help="одновременных клиентов")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="повторов (берется медиана)")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    args = parser.parse_args(argv)
+    if args.threads < 1 or args.requests < 1:
+        parser.error("--threads и --requests должны быть положительными")
+
+    results = run(args.requests, args.threads, args.repeat)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# benchmarks/synthetic.py
+"""
+Генератор синтетических книг-источников, шаблонов и правил для бенчмарка
+process_excel_hybrid (см. benchmarks/pipeline.py).
+"""
+import io
+import random
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+# Заголовки колонок шаблона, по которым геокодинг находит свои колонки
+GEOCODING_HEADERS = ['Адрес', 'Широта', 'Долгота']
+
+_STREETS = ['Ленина', 'Мира', 'Садовая', 'Невский пр.', 'Гагарина', 'Лесная', 'Школьная', 'Советская']
+
+
+def _address(index):
+    return f"{_STREETS[index % len(_STREETS)]} ул. {index // len(_STREETS) + 1}"
+
+
+def make_addresses_csv(path, count):
+    """Справочник адресов для геокодинга: адрес, широта, долгота."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            f.write(f'"{_address(i)}",{55 + i * 1e-4:.6f},{37 + i * 1e-4:.6f}\n')
+
+
+def make_source_workbook(rows, cols, sheets=1, hidden_every=0, hyperlink_every=0, address_count=0, seed=0):
+    """
+    Книга-источник: на каждом листе строка заголовков и rows строк данных.
+    Колонки чередуются: целые, дробные, строки, даты-строки.
+    hidden_every - каждая N-я строка скрыта, hyperlink_every - в каждой N-й
+    строке первой текстовой колонки гиперссылка. При address_count > 0
+    последняя колонка содержит адреса из справочника make_addresses_csv.
+    Возвращает BytesIO с .xlsx.
+    """
+    rnd = random.Random(seed)
+    wb = Workbook()
+    wb.remove(wb.active)
+    for sheet_idx in range(sheets):
+        ws = wb.create_sheet(f"Лист{sheet_idx + 1}")
+        ws.append([f"Колонка {c}" for c in range(1, cols + 1)])
+        for r in range(rows):
+            row = []
+            for c in range(cols):
+                kind = c % 4
+                if address_count and c == cols - 1:
+                    row.append(_address(rnd.randrange(address_count)))
+                elif kind == 0:
+                    row.append(r + 1)
+                elif kind == 1:
+                    row.append(round(rnd.uniform(0, 10000), 2))
+                elif kind == 2:
+                    row.append(f"Значение {rnd.randrange(1000)}")
+                else:
+                    row.append(f"2024-{rnd.randrange(1, 13):02d}-{rnd.randrange(1, 29):02d}")
+            ws.append(row)
+            if hyperlink_every and (r + 1) % hyperlink_every == 0 and cols > 2:
+                ws.cell(row=r + 2, column=3).hyperlink = f"https://example.com/{sheet_idx}/{r}"
+        if hidden_every:
+            for r in range(hidden_every, rows + 1, hidden_every):
+                ws.row_dimensions[r + 1].hidden = True
+    return _to_bytes(wb)
+
+
+def make_template_workbook(cols, rows=0, geocoding=False):
+    """
+    Шаблон: один лист с заголовком в первой строке (и колонками геокодинга).
+    rows - строки, уже заполненные в шаблоне (номер в первой колонке):
+    до них работает "Заполнение из ячейки".
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Лист1'
+    headers = [f"Поле {c}" for c in range(1, cols + 1)]
+    if geocoding:
+        headers[-len(GEOCODING_HEADERS):] = GEOCODING_HEADERS
+    ws.append(headers)
+    for r in range(1, rows + 1):
+        ws.cell(row=r + 1, column=1, value=r)
+    return _to_bytes(wb)
+
+
+def make_rules(cols, sheets=1, formula_rules=0, static_rules=0, fill_rules=0, cell_mappings=0, geocoding=False):
+    """
+    Правила, как их сохраняет редактор шаблонов.
+    Колонки всех листов источника копируются подряд в колонки шаблона;
+    формулы, статичные значения и заполнение из ячейки пишутся в колонки
+    после скопированных. Возвращает (template_cols, rules), где rules -
+    именованные аргументы process_excel_hybrid.
+    """
+    template_rules = []
+    t_col = 1
+    for sheet_idx in range(sheets):
+        for c in range(1, cols + 1):
+            template_rules.append({'source_sheet': f"Лист{sheet_idx + 1}",
+                                   'source_cell': f"{get_column_letter(c)}1",
+                                   'template_col': get_column_letter(t_col)})
+            t_col += 1
+
+    numeric_cols = [get_column_letter(c) for c in range(1, cols + 1) if c % 4 in (1, 2)] or ['A']
+    formulas = []
+    for i in range(formula_rules):
+        a, b = numeric_cols[i % len(numeric_cols)], numeric_cols[(i + 1) % len(numeric_cols)]
+        formulas.append({'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': get_column_letter(t_col),
+                         'formula': f"={a}{{row}}*2+{b}{{row}}"})
+        t_col += 1
+
+    statics = []
+    for i in range(static_rules):
+        statics.append({'target_sheet': 'Лист1', 'target_col': get_column_letter(t_col), 'value': f"static {i}"})
+        t_col += 1
+
+    fills = []
+    for i in range(fill_rules):
+        fills.append({'source_sheet': 'Лист1', 'source_cell': f"A{i + 2}", 'target_sheet': 'Лист1',
+                      'target_col': get_column_letter(t_col)})
+        t_col += 1
+
+    mappings = [{'source_sheet': 'Лист1', 'source_cell': f"B{i + 2}", 'dest_cell': f"{get_column_letter(t_col)}{i + 1}"}
+                for i in range(cell_mappings)]
+    if cell_mappings:
+        t_col += 1
+
+    if geocoding:
+        # Адрес копируется из последней колонки источника, координаты пишет геокодинг
+        template_rules[cols - 1]['template_col'] = get_column_letter(t_col)
+        t_col += len(GEOCODING_HEADERS)
+
+    rules = {
+        'sheet_settings': [{'sheet_name': f"Лист{s + 1}", 'start_cell': 'A1'} for s in range(sheets)],
+        'template_rules': template_rules,
+        'formula_rules': formulas,
+        'static_value_rules': statics,
+        'source_cell_fill_rules': fills,
+        'cell_mappings': mappings,
+        'post_function': 'address_to_coords' if geocoding else 'none',
+    }
+    return t_col - 1, rules
+
+
+def _to_bytes(wb):
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
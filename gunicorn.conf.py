@@ -0,0 +1,34 @@
+# gunicorn.conf.py
+"""
+Настройки gunicorn (читаются автоматически из рабочей директории).
+
+GUNICORN_PRELOAD=1 - режим pre-fork: приложение создается в мастер-процессе,
+там же загружаются индекс адресов геокодера и сохраненные шаблоны, и воркеры
+получают их после fork общими страницами памяти (см. app/services/prefork.py).
+Имеет смысл при WEB_CONCURRENCY > 1. Обновление кода при этом требует
+перезапуска мастера (HUP перезапускает воркеры с уже загруженным кодом).
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+# eventlet требуется для SocketIO; число воркеров - WEB_CONCURRENCY (читает сам gunicorn)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'eventlet')
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+if preload_app and worker_class == 'eventlet':
+    # Приложение импортируется в мастере: патч должен быть применен до этого,
+    # иначе блокировки и потоки, созданные при импорте, останутся не "зелеными"
+    import eventlet
+    eventlet.monkey_patch()
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from app.services import prefork
+        prefork.preload(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app.services import prefork
+        prefork.after_fork(server.app.wsgi())
@@ -24,5 +24,16 @@ def create_admin(username, password):
     except Exception as e:
         print(f"Произошла непредвиденная ошибка: {e}")
 
+@app.cli.command("worker")
+@click.option("--threads", default=1, show_default=True, help="Число параллельно выполняемых заданий.")
+@click.option("--burst", is_flag=True, help="Завершиться, когда очередь опустеет.")
+def worker(threads, burst):
+    """
+    Обработчик очереди заданий (обработка Excel вне веб-процесса).
+    Пример: flask --app manage.py worker --threads 2
+    """
+    from app.services import job_worker
+    job_worker.run_workers(app, threads=threads, burst=burst)
+
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
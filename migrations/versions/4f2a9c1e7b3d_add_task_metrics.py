@@ -0,0 +1,52 @@
+"""Add processing metrics to task_log and task_stage_timing table.
+
+Revision ID: 4f2a9c1e7b3d
+Revises: c8b3db714c48
+Create Date: 2026-10-19 12:05:41.517204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2a9c1e7b3d'
+down_revision = 'c8b3db714c48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('task_log', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('duration', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('source_rows', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('target_rows', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('input_bytes', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('output_bytes', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('peak_rss_bytes', sa.BigInteger(), nullable=True))
+
+    op.create_table('task_stage_timing',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('task_log_id', sa.Integer(), nullable=False),
+    sa.Column('stage', sa.String(length=32), nullable=False),
+    sa.Column('seconds', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['task_log_id'], ['task_log.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('task_stage_timing', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_task_stage_timing_task_log_id'), ['task_log_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task_stage_timing', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_task_stage_timing_task_log_id'))
+
+    op.drop_table('task_stage_timing')
+
+    with op.batch_alter_table('task_log', schema=None) as batch_op:
+        batch_op.drop_column('peak_rss_bytes')
+        batch_op.drop_column('output_bytes')
+        batch_op.drop_column('input_bytes')
+        batch_op.drop_column('target_rows')
+        batch_op.drop_column('source_rows')
+        batch_op.drop_column('duration')
@@ -0,0 +1,37 @@
+"""Add status_kind to task_log and indexes for admin reports.
+
+Revision ID: 9d3e51b0a6c2
+Revises: 4f2a9c1e7b3d
+Create Date: 2026-10-19 14:32:08.774610
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3e51b0a6c2'
+down_revision = '4f2a9c1e7b3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('task_log', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status_kind', sa.String(length=10), nullable=True))
+
+    # Старые записи: ошибкой считается статус, содержащий 'Ошибка' (как раньше в отчете)
+    op.execute("UPDATE task_log SET status_kind = CASE WHEN status LIKE '%Ошибка%' THEN 'error' ELSE 'success' END")
+
+    with op.batch_alter_table('task_log', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_task_log_status_kind'), ['status_kind'], unique=False)
+        batch_op.create_index(batch_op.f('ix_task_log_owner_id'), ['owner_id'], unique=False)
+        batch_op.create_index('ix_task_log_owner_id_timestamp', ['owner_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task_log', schema=None) as batch_op:
+        batch_op.drop_index('ix_task_log_owner_id_timestamp')
+        batch_op.drop_index(batch_op.f('ix_task_log_owner_id'))
+        batch_op.drop_index(batch_op.f('ix_task_log_status_kind'))
+        batch_op.drop_column('status_kind')
@@ -0,0 +1,26 @@
+"""Add last_login to user.
+
+Revision ID: c8b3db714c48
+Revises: ce890a4dcb8f
+Create Date: 2025-11-12 10:14:52.301118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8b3db714c48'
+down_revision = 'ce890a4dcb8f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_login', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('last_login')
@@ -0,0 +1,29 @@
+from benchmarks import pipeline, startup
+
+
+def test_scaled_scenario_reports_all_stages():
+    params = pipeline.scaled(pipeline.SCENARIOS['medium'], 0.001)
+    result = pipeline.run_scenario('medium', params, repeat=1)
+
+    assert result['rows'] == params['rows']
+    assert {'load', 'plan', 'columns', 'static', 'formulas', 'write', 'save'} <= set(result['stages'])
+    assert result['peak_rss_mb'] > 0 and result['rows_per_sec'] > 0
+
+
+def test_compare_flags_only_significant_slowdowns():
+    base = {'wall': 1.0, 'stages': {'load': 0.5, 'formulas': 0.01}, 'params': {'rows': 10}}
+    current = {'wall': 1.1, 'stages': {'load': 0.5, 'formulas': 0.03}, 'params': {'rows': 10}}
+    baseline = {'scenarios': {'medium': base}}
+
+    assert pipeline.compare({'medium': current}, baseline, tolerance=0.2) == []
+
+    current['stages']['load'] = 0.9
+    assert pipeline.compare({'medium': current}, baseline, tolerance=0.2) == ['medium/load: 0.500 с -> 0.900 с']
+
+
+def test_create_app_does_not_load_postprocessing_libraries():
+    result = startup.run(repeat=1)
+
+    assert result['lazy_loaded'] == []
+    assert result['wall'] > 0 and result['modules'] > 0
+    assert startup.compare(dict(result, lazy_loaded=['scipy']), result, tolerance=0.2) == ['при запуске загружен scipy']
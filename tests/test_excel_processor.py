@@ -0,0 +1,1330 @@
+import io
+import json
+import os
+
+import pytest
+from openpyxl import Workbook, load_workbook
+
+from app import create_app
+from app.config import Config
+from app.extensions import task_statuses
+from app.services.excel_processor import process_excel_hybrid
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    for key in ('UPLOAD_FOLDER', 'PROCESSED_FOLDER', 'TEMPLATES_DB_FOLDER', 'TEMPLATE_EXCEL_FOLDER',
+                'DICTIONARIES_FOLDER', 'GEOCODING_DATA_FOLDER'):
+        monkeypatch.setattr(Config, key, str(tmp_path / key.lower()))
+    monkeypatch.setattr(Config, 'ADDRESS_CSV_FILE', str(tmp_path / 'addresses.csv'))
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///' + str(tmp_path / 'app.db'))
+    # Журнал пишется синхронно, чтобы тесты сразу видели записи
+    monkeypatch.setattr(Config, 'TASK_LOG_ASYNC', False)
+    # Задания из очереди тесты выполняют сами (Worker.run_once)
+    monkeypatch.setattr(Config, 'JOB_QUEUE_WEB_WORKERS', 0)
+    app = create_app()
+    with app.app_context():
+        from app.extensions import db
+        db.create_all()
+    return app
+
+
+def _to_bytes(wb):
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def _run(app, source_wb, template_wb, t_start_row=1, **rules):
+    task_id = 'test-task'
+    task_statuses.create(task_id, {'owner_id': None})
+    process_excel_hybrid(
+        app, task_id, _to_bytes(source_wb), _to_bytes(template_wb), {'t_start_row': t_start_row},
+        rules.get('sheet_settings', []), rules.get('template_rules', []), rules.get('post_function', 'none'),
+        'template.xlsx', task_statuses,
+        cell_mappings=rules.get('cell_mappings', []),
+        formula_rules=rules.get('formula_rules', []),
+        static_value_rules=rules.get('static_value_rules', []),
+        visible_rows_only=rules.get('visible_rows_only', False),
+        source_cell_fill_rules=rules.get('source_cell_fill_rules', []),
+    )
+    task = task_statuses.get(task_id)
+    assert task['result_ready']
+    with task_statuses.open_result(task_id) as result_file:
+        result = load_workbook(result_file).active
+    task_statuses.delete(task_id)
+    return result, task['warnings']
+
+
+def _source():
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Лист1'
+    ws.append(['Номер', 'Сумма', 'Ссылка'])
+    for i in range(1, 6):
+        ws.append([i, i * 10, f'link {i}'])
+    ws['C3'].hyperlink = 'https://example.com/2'
+    return wb
+
+
+def _template(*extra_rows):
+    wb = Workbook()
+    wb.active.title = 'Лист1'
+    wb.active.append(['N', 'Сумма', 'Ссылка', 'Итог', 'Статус', 'Из ячейки'])
+    for row in extra_rows:
+        wb.active.append(row)
+    return wb
+
+
+def test_all_rule_types_fill_rows_in_one_pass(app):
+    ws, warnings = _run(
+        app, _source(), _template([None, None, None, None, None, 'pre']),
+        template_rules=[
+            {'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'},
+            {'source_sheet': 'Лист1', 'source_cell': 'B1', 'template_col': 'B'},
+            {'source_sheet': 'Лист1', 'source_cell': 'C1', 'template_col': 'C'},
+            # Колонка A источника уже использована - правило пропускается
+            {'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'E'},
+        ],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                        'formula': '=B{row}*2'}],
+        static_value_rules=[{'target_sheet': 'Лист1', 'target_col': 'E', 'value': 'ok'}],
+        source_cell_fill_rules=[{'source_sheet': 'Лист1', 'source_cell': 'B2', 'target_sheet': 'Лист1',
+                                 'target_col': 'F'}],
+        cell_mappings=[{'source_sheet': 'Лист1', 'source_cell': 'A6', 'dest_cell': 'H1'}],
+    )
+
+    rows = list(ws.iter_rows(min_row=2, max_col=6, values_only=True))
+    assert rows == [(i, i * 10, f'link {i}', float(i * 20), 'ok', 10 if i == 1 else None) for i in range(1, 6)]
+    # Заполнение из ячейки идет только по строкам, существовавшим в шаблоне до копирования колонок
+    assert ws['F2'].value == 10 and ws['F3'].value is None
+    assert ws['C3'].hyperlink.target == 'https://example.com/2'
+    assert ws['H1'].value == 5
+    assert warnings == []
+
+
+def test_visible_rows_only_aligns_formulas_with_copied_rows(app):
+    source_wb = _source()
+    source_wb.active.row_dimensions[3].hidden = True
+
+    ws, _ = _run(
+        app, source_wb, _template(),
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                        'formula': '=A{row}+100'}],
+        visible_rows_only=True,
+    )
+
+    assert list(ws.iter_rows(min_row=2, values_only=True, max_col=1)) == [(1,), (3,), (4,), (5,)]
+    assert [ws.cell(row=r, column=4).value for r in range(2, 6)] == [101.0, 103.0, 104.0, 105.0]
+
+
+# --- Эталонные результаты на наборе книг ---
+# tests/data/row_pass_golden.json получен прежним конвейером (отдельный проход
+# по листу на каждый вид правил, до общего прохода по строкам) на книгах
+# _row_pass_corpus(). Прежний конвейер перебирал ссылки формулы в множестве
+# (порядок зависит от PYTHONHASHSEED), и при нескольких нечисловых ссылках
+# в "#VALUE! (ссылка: ...)" попадала любая из них; в эталоне - первая по
+# тексту формулы, как в общем проходе. Если результат меняется намеренно,
+# эталон перезаписывается: UPDATE_GOLDEN=1 python -m pytest -k golden
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), 'data', 'row_pass_golden.json')
+
+
+def _row_pass_corpus():
+    """
+    Случайные (с фиксированным seed) книги и правила: значения разных типов,
+    скрытые строки, гиперссылки, два листа источника, строки, уже
+    заполненные в шаблоне, формулы с ошибками, статичные значения,
+    заполнение из ячейки и перенос отдельных ячеек; visible_rows_only
+    чередуется. Возвращает список (имя, источник, шаблон, t_start_row, правила).
+    """
+    import random
+    from openpyxl.utils import get_column_letter
+
+    corpus = []
+    for case in range(12):
+        rnd = random.Random(case)
+        sheets = 2 if case % 3 == 0 else 1
+        source = Workbook()
+        source.remove(source.active)
+        sheet_settings, template_rules = [], []
+        t_col = 1
+        for s in range(sheets):
+            ws = source.create_sheet(f'Лист{s + 1}')
+            header_row = 2 if case % 4 == 1 else 1
+            if header_row == 2:
+                ws.append([f'Выгрузка {case}'])
+            ws.append(['Номер', 'Цена', 'Название', 'Разное', 'Количество'])
+            for r in range(rnd.randint(4, 14)):
+                ws.append([
+                    r + 1,
+                    round(rnd.uniform(0, 1000), 2),
+                    rnd.choice(['Стол', 'Стул', 'Шкаф', '', None]),
+                    rnd.choice([None, True, '12', '3,5', 7, 2.5, 'текст']),
+                    rnd.randint(0, 20),
+                ])
+                row = ws.max_row
+                if rnd.random() < 0.2:
+                    ws.row_dimensions[row].hidden = True
+                if rnd.random() < 0.25:
+                    ws.cell(row=row, column=3).hyperlink = f'https://example.com/{case}/{s}/{row}'
+            sheet_settings.append({'sheet_name': ws.title, 'start_cell': f'A{header_row}'})
+            for c in rnd.sample(range(1, 6), rnd.randint(2, 5)):
+                template_rules.append({'source_sheet': ws.title, 'source_cell': f'{get_column_letter(c)}{header_row}',
+                                       'template_col': get_column_letter(t_col)})
+                t_col += 1
+        # Повторно использованная колонка источника - правило пропускается
+        template_rules.append(dict(template_rules[0], template_col=get_column_letter(t_col)))
+        t_col += 1
+
+        formulas = ['=A{row}*2', '=B{row}+E{row}', '=B{row}/E{row}', '=C{row}+1', '=D{row}*10']
+        formula_rules = []
+        for formula in rnd.sample(formulas, rnd.randint(1, 3)):
+            formula_rules.append({'source_sheet': rnd.choice(source.sheetnames), 'target_sheet': 'Лист1',
+                                  'target_col': get_column_letter(t_col), 'formula': formula})
+            t_col += 1
+        static_value_rules = [{'target_sheet': 'Лист1', 'target_col': get_column_letter(t_col), 'value': f'статус {case}'}]
+        t_col += 1
+        source_cell_fill_rules = [{'source_sheet': 'Лист1', 'source_cell': f'B{rnd.randint(2, 4)}',
+                                   'target_sheet': 'Лист1', 'target_col': get_column_letter(t_col)}]
+        t_col += 1
+        cell_mappings = [{'source_sheet': 'Лист1', 'source_cell': 'C3', 'dest_cell': f'{get_column_letter(t_col)}1'}]
+
+        template = Workbook()
+        template.active.title = 'Лист1'
+        t_start_row = 1 + case % 2
+        if t_start_row == 2:
+            template.active.append(['Отчет'])
+        template.active.append([f'Поле {c}' for c in range(1, t_col)])
+        for r in range(rnd.randint(0, 3)):
+            template.active.append([f'заполнено {r}'])
+
+        corpus.append((f'case{case}', source, template, t_start_row, {
+            'sheet_settings': sheet_settings, 'template_rules': template_rules, 'formula_rules': formula_rules,
+            'static_value_rules': static_value_rules, 'source_cell_fill_rules': source_cell_fill_rules,
+            'cell_mappings': cell_mappings, 'visible_rows_only': case % 2 == 1,
+        }))
+    return corpus
+
+
+def _golden_sheet(ws):
+    """Значения (с типом) и гиперссылки листа результата - в виде, пригодном для JSON."""
+    cells = []
+    for row in ws.iter_rows():
+        for cell in row:
+            if cell.value is not None:
+                value = cell.value if isinstance(cell.value, (bool, int, float, str)) else str(cell.value)
+                cells.append([cell.coordinate, type(cell.value).__name__, value])
+    links = [[cell.coordinate, cell.hyperlink.target] for row in ws.iter_rows() for cell in row if cell.hyperlink]
+    return {'max_row': ws.max_row, 'max_column': ws.max_column, 'cells': cells, 'hyperlinks': links}
+
+
+def test_row_pass_matches_golden_outputs_of_per_rule_passes(app):
+    # Эталон снят после исправления формул без visible_rows_only: они читают
+    # ту же строку источника, что и правила колонок (см. тест ниже)
+    results = {}
+    for name, source, template, t_start_row, rules in _row_pass_corpus():
+        ws, _ = _run(app, source, template, t_start_row, **rules)
+        results[name] = _golden_sheet(ws)
+
+    if os.environ.get('UPDATE_GOLDEN'):
+        with open(GOLDEN_PATH, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+    with open(GOLDEN_PATH, encoding='utf-8') as f:
+        golden = json.load(f)
+    assert sorted(results) == sorted(golden)
+    for name in golden:
+        assert results[name] == golden[name], name
+
+
+def test_formulas_read_the_same_source_row_as_column_rules(app):
+    # Заголовок источника не в первой строке; фильтр видимых строк выключен
+    source_wb = Workbook()
+    source_wb.active.title = 'Лист1'
+    source_wb.active.append(['Выгрузка'])
+    source_wb.active.append(['Номер', 'Сумма'])
+    for i in range(1, 6):
+        source_wb.active.append([i, i * 10])
+    rules = dict(
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A2'}],
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A2', 'template_col': 'A'},
+                        {'source_sheet': 'Лист1', 'source_cell': 'B2', 'template_col': 'B'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                        'formula': '=B{row}+A{row}'}],
+    )
+
+    ws, warnings = _run(app, source_wb, _template(), **rules)
+    rows = list(ws.iter_rows(min_row=2, max_col=4, values_only=True))
+    # Первая строка данных - не заголовок источника: формула считается по ней же
+    assert [(a, b, d) for a, b, _, d in rows] == [(i, i * 10, i * 11) for i in range(1, 6)]
+    assert warnings == []
+
+
+def test_columnar_source_cache_keeps_values_types_and_links(app, monkeypatch):
+    from app.services.source_cache import _Column
+
+    column = _Column([5, None, -7], {})
+    assert column.data.dtype.kind == 'i' and [column.get(i) for i in range(3)] == [5, None, -7]
+    assert all(type(column.get(i)) is int for i in (0, 2))
+    column = _Column([None, 2.5, 3.0], {})
+    assert column.data.dtype.kind == 'f' and [column.get(i) for i in range(3)] == [None, 2.5, 3.0]
+    assert type(column.get(2)) is float
+    # Смешанные int/float, bool и не помещающиеся в int64 целые - без преобразования
+    for values in ([1, 2.5], [True, 0], [2 ** 63, 1]):
+        column = _Column(values, {})
+        assert column.data.dtype == object and [(v, type(v)) for v in map(column.get, range(2))] == \
+            [(v, type(v)) for v in values]
+
+    source = Workbook()
+    ws = source.active
+    ws.title = 'Лист1'
+    ws.append(['Целые', 'Дробные', 'Смешанные', 'Флаги', 'Текст', 'Большие'])
+    for i in range(1, 13):
+        ws.append([i if i % 4 else None, i / 4 if i % 5 else None, i if i % 2 else i + 0.5,
+                   i % 3 == 0, f'строка {i}' if i % 6 else None, 2 ** 40 + i if i % 7 == 0 else i])
+    ws['A3'].hyperlink = 'https://example.com/a3'
+    ws['B6'].hyperlink = 'https://example.com/b6'
+    ws['E4'].hyperlink = '#Лист1!A1'
+    ws.row_dimensions[8].hidden = True
+    rules = dict(
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': f'{col}1', 'template_col': col} for col in 'ABCDEF'],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'G', 'formula': '=A{row}+B{row}'},
+                       {'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'H', 'formula': '=C{row}*2'}],
+    )
+    template = Workbook()
+    template.active.title = 'Лист1'
+    template.active.append([f'Поле {c}' for c in range(1, 9)])
+
+    results = {}
+    for reader in ('openpyxl', 'stream'):
+        monkeypatch.setitem(app.config, 'SOURCE_READER', reader)
+        for use_cache in (False, True):
+            monkeypatch.setitem(app.config, 'COLUMNAR_SOURCE_CACHE', use_cache)
+            for visible_rows_only in (False, True):
+                result_ws, warnings = _run(app, source, template, visible_rows_only=visible_rows_only, **rules)
+                results[reader, use_cache, visible_rows_only] = (_golden_sheet(result_ws), warnings)
+
+    for (reader, use_cache, visible_rows_only), result in results.items():
+        assert result == results['openpyxl', False, visible_rows_only], (reader, use_cache)
+    cells = {coordinate: (type_name, value) for coordinate, type_name, value in
+             results['stream', True, False][0]['cells']}
+    assert cells['A2'] == ('int', 1) and 'A5' not in cells and cells['B2'] == ('float', 0.25)
+    assert cells['C3'] == ('float', 2.5) and cells['C4'] == ('int', 3) and cells['D4'] == ('bool', True)
+    assert cells['F8'] == ('int', 2 ** 40 + 7) and cells['G2'] == ('float', 1.25)
+    assert results['stream', True, False][0]['hyperlinks'] == [
+        ['A3', 'https://example.com/a3'], ['E4', '#Лист1!A1'], ['B6', 'https://example.com/b6']]
+
+
+def test_formula_errors_are_grouped_with_counts_and_full_report(app):
+    import csv
+    from app.services import user_service, warning_report
+
+    source_wb = _source()
+    source_wb.active['C4'] = 5
+    ws, warnings = _run(
+        app, source_wb, _template(),
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                        'formula': '=C{row}+1'},
+                       {'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'E',
+                        'formula': '=A{row}/0'}],
+    )
+
+    assert ws['D2'].value == '#VALUE! (ссылка: C2)' and ws['D4'].value == 6 and ws['E2'].value == '#NUM!'
+    assert warnings == [
+        "Формула =C{row}+1: не удалось получить число (случаев: 4), например: C2 (значение: 'link 1'), "
+        "C3 (значение: 'link 2'), C5 (значение: 'link 4'), C6 (значение: 'link 5')",
+        "Формула =A{row}/0: ошибка вычисления (случаев: 5), например: строка источника 2, строка источника 3, "
+        "строка источника 4, строка источника 5, строка источника 6",
+    ]
+    with app.app_context(), open(warning_report.report_path('test-task'), encoding='utf-8-sig', newline='') as f:
+        report = list(csv.reader(f, delimiter=';'))
+    assert report[0] == warning_report.REPORT_HEADER and len(report) == 1 + 9
+    assert report[1] == ['Формула =C{row}+1', 'не удалось получить число', 'C2', "значение: 'link 1'"]
+
+    with app.app_context():
+        owner_id = user_service.create_user('user', 'secret').id
+        user_service.create_user('other', 'secret')
+    task_statuses.create('test-task', {'owner_id': owner_id, 'result_ready': True, 'warnings_report': True})
+    other = app.test_client()
+    other.post('/login', data={'username': 'other', 'password': 'secret'})
+    assert other.get('/download_warnings/test-task').status_code == 403
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+    response = client.get('/download_warnings/test-task')
+    assert response.status_code == 200 and response.mimetype == 'text/csv'
+    assert len(response.get_data(as_text=True).splitlines()) == 10
+
+
+def test_resumed_warnings_merge_groups_and_continue_the_report(tmp_path):
+    import csv
+    from app.services.warning_report import REPORT_HEADER, WarningCollector
+
+    previous = WarningCollector(str(tmp_path / 'previous.csv'), max_examples=2)
+    previous.add('Формула =C{row}+1', 'не удалось получить число', 'C2', "значение: 'a'")
+    previous.add('Формула =C{row}+1', 'не удалось получить число', 'C3', "значение: 'b'")
+    previous.add('Формула =A{row}/0', 'ошибка вычисления', None, 'строка источника 2')
+    previous.close()
+
+    current = WarningCollector(str(tmp_path / 'current.csv'), max_examples=2)
+    current.resume(json.loads(json.dumps(previous.groups_state())), previous.report_path)
+    current.add('Формула =C{row}+1', 'не удалось получить число', 'C9', "значение: 'c'")
+    current.add('Формула =B{row}*2', 'не удалось получить число', 'B9', "значение: 'd'")
+    current.close()
+
+    assert current.summary() == [
+        "Формула =C{row}+1: не удалось получить число (случаев: 3), например: C2 (значение: 'a'), "
+        "C3 (значение: 'b') и др.",
+        "Формула =A{row}/0: ошибка вычисления (случаев: 1), например: строка источника 2",
+        "Формула =B{row}*2: не удалось получить число (случаев: 1), например: B9 (значение: 'd')",
+    ]
+    with open(current.report_path, encoding='utf-8-sig', newline='') as f:
+        report = list(csv.reader(f, delimiter=';'))
+    assert report[0] == REPORT_HEADER and [row[2] for row in report[1:]] == ['C2', 'C3', '', 'C9', 'B9']
+
+    # Без замечаний в прежнем прогоне отчет создается только при новых
+    empty = WarningCollector(str(tmp_path / 'empty.csv'))
+    empty.resume([], None)
+    assert not empty.has_report and empty.summary() == []
+
+
+def _chunked_upload_client(app):
+    from app.services import user_service
+
+    app.config['UPLOAD_CHUNK_SIZE'] = 1024
+    with app.app_context():
+        user_service.create_user('user', 'secret')
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+    return client
+
+
+def _init_chunked_upload(client, data, **form):
+    if 'saved_template' not in form:
+        form['template_file'] = (_to_bytes(_template()), 'template.xlsx')
+    state = client.post('/upload/init', data=dict(form, filename='source.xlsx', size=len(data)),
+                        content_type='multipart/form-data').get_json()
+    chunks = [data[i:i + 1024] for i in range(0, len(data), 1024)]
+    assert state['received'] == [] and state['total_chunks'] == len(chunks) > 2
+    return state['upload_id'], chunks
+
+
+def test_chunked_upload_resumes_checks_chunks_and_starts_one_task(app):
+    import hashlib
+    import os
+    from app.extensions import job_queue
+    from app.services import upload_service
+
+    client = _chunked_upload_client(app)
+    data = _to_bytes(_source()).getvalue()
+    upload_id, chunks = _init_chunked_upload(client, data, sha256=hashlib.sha256(data).hexdigest())
+    url = f'/upload/{upload_id}/chunk/'
+    last = len(chunks) - 1
+
+    assert client.put(url + '0', data=chunks[0]).get_json()['received'] == [0]
+    # Повторная отправка части безопасна
+    assert client.put(url + '0', data=chunks[0]).get_json()['received'] == [0]
+    assert client.put(url + str(len(chunks)), data=chunks[0]).status_code == 400
+    assert client.put(url + '1', data=chunks[1][:-1]).status_code == 400
+    response = client.put(url + '1', data=chunks[1], headers={'X-Chunk-SHA256': hashlib.sha256(b'x').hexdigest()})
+    assert response.status_code == 400 and 'контрольная сумма' in response.get_json()['error']
+    for index in range(1, last):
+        client.put(url + str(index), data=chunks[index],
+                   headers={'X-Chunk-SHA256': hashlib.sha256(chunks[index]).hexdigest()})
+    # Докачка: клиент узнает, какие части уже есть
+    assert client.get(f'/upload/{upload_id}').get_json()['received'] == list(range(last))
+
+    # Сборку уже выполняет параллельный запрос: этот не запускает задачу
+    with app.app_context():
+        assert upload_service.claim_assembly(upload_id) and not upload_service.claim_assembly(upload_id)
+        lock_path = os.path.join(upload_service._get_upload_dir(upload_id), '.assembling')
+    state = client.put(url + str(last), data=chunks[last]).get_json()
+    assert not state['complete'] and state['task_id'] is None and job_queue.stats()['queued'] == 0
+
+    os.remove(lock_path)
+    state = client.put(url + str(last), data=chunks[last]).get_json()
+    assert state['complete'] and state['task_id'] and job_queue.stats()['queued'] == 1
+    assert client.put(url + '0', data=chunks[0]).get_json()['task_id'] == state['task_id']
+    assert client.get(f'/upload/{upload_id}').get_json()['task_id'] == state['task_id']
+    assert job_queue.stats()['queued'] == 1
+    assert task_statuses.get(state['task_id'])['owner_id'] is not None
+    # Части удалены, собранный файл перемещен в папку задачи
+    assert sorted(os.listdir(os.path.dirname(lock_path))) == ['.assembling', 'manifest.json', 'template.xlsx']
+    assert not any(name.startswith(upload_id) for name in os.listdir(app.config['UPLOAD_FOLDER']))
+
+
+def test_chunked_upload_reports_failures_and_keeps_active_uploads(app, monkeypatch):
+    import os
+    import time
+    from app.extensions import job_queue
+    from app.services import job_worker, upload_service
+
+    submit_processing_job = job_worker.submit_processing_job
+    client = _chunked_upload_client(app)
+    data = _to_bytes(_source()).getvalue()
+
+    def upload_all_but_last(**form):
+        upload_id, chunks = _init_chunked_upload(client, data, **form)
+        for index in range(len(chunks) - 1):
+            client.put(f'/upload/{upload_id}/chunk/{index}', data=chunks[index])
+        return upload_id, f'/upload/{upload_id}/chunk/{len(chunks) - 1}', chunks[-1]
+
+    def leftovers():
+        # Собранный файл (<upload_id>.xlsx) лежит прямо в UPLOAD_FOLDER, рядом с папками chunks и jobs
+        folder = app.config['UPLOAD_FOLDER']
+        return [name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name))]
+
+    # Ошибка постановки в очередь: собранный файл удален, ошибку видит опрос статуса
+    upload_id, last_url, last_chunk = upload_all_but_last()
+
+    def broken_submit(*args, **kwargs):
+        raise OSError('диск заполнен')
+    monkeypatch.setattr(job_worker, 'submit_processing_job', broken_submit)
+    response = client.put(last_url, data=last_chunk)
+    assert response.status_code == 500 and 'диск заполнен' in response.get_json()['error']
+    state = client.get(f'/upload/{upload_id}').get_json()
+    assert 'диск заполнен' in state['error'] and not state['complete'] and state['task_id'] is None
+    assert leftovers() == []
+
+    # Повторная отправка последней части повторяет сборку
+    monkeypatch.setattr(job_worker, 'submit_processing_job', submit_processing_job)
+    state = client.put(last_url, data=last_chunk).get_json()
+    assert state['complete'] and state['task_id'] and 'error' not in state and job_queue.stats()['queued'] == 1
+
+    # Параметры задачи проверяются до сборки: файл не собирается, части остаются
+    upload_id, last_url, last_chunk = upload_all_but_last(saved_template='удаленный')
+    response = client.put(last_url, data=last_chunk)
+    assert response.status_code == 400 and response.get_json()['error'] == 'Файл шаблона не найден.'
+    state = client.get(f'/upload/{upload_id}').get_json()
+    assert state['error'] == 'Файл шаблона не найден.' and len(state['received']) == state['total_chunks']
+    assert leftovers() == []
+
+    # Не совпала контрольная сумма файла - загрузка удаляется, клиент начнет заново
+    upload_id, last_url, last_chunk = upload_all_but_last(sha256='0' * 64)
+    response = client.put(last_url, data=last_chunk)
+    assert response.status_code == 400 and 'Контрольная сумма' in response.get_json()['error']
+    assert client.get(f'/upload/{upload_id}').status_code == 404 and leftovers() == []
+
+    # Брошенной считается загрузка без новых частей, а не со старым manifest
+    upload_id, _, _ = upload_all_but_last()
+    with app.app_context():
+        upload_dir = upload_service._get_upload_dir(upload_id)
+        past = time.time() - 3 * 3600
+        os.utime(os.path.join(upload_dir, 'manifest.json'), (past, past))
+        upload_service.cleanup_stale_uploads(2)
+        assert os.path.isdir(upload_dir)
+        for name in os.listdir(upload_dir):
+            os.utime(os.path.join(upload_dir, name), (past, past))
+        upload_service.cleanup_stale_uploads(2)
+        assert not os.path.exists(upload_dir)
+
+
+def test_formatting_only_rows_are_not_processed(app):
+    from openpyxl.styles import Font
+
+    source_wb = _source()
+    template_wb = _template()
+    # Ячейки только с форматированием далеко за пределами данных
+    source_wb.active.cell(row=5000, column=1).font = Font(bold=True)
+    template_wb.active.cell(row=8000, column=5).font = Font(bold=True)
+
+    ws, _ = _run(
+        app, source_wb, template_wb,
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        static_value_rules=[{'target_sheet': 'Лист1', 'target_col': 'E', 'value': 'ok'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                        'formula': '=A{row}+1'}],
+    )
+
+    assert [ws.cell(row=r, column=5).value for r in range(2, 7)] == ['ok'] * 5
+    assert ws['E7'].value is None and ws['D7'].value is None
+    assert ws['E8000'].value is None
+
+
+def test_task_metrics_are_logged_and_shown_in_reports(app):
+    from app.models import TaskLog
+    from app.services import logging_service, user_service
+
+    _run(
+        app, _source(), _template(),
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                        'formula': '=A{row}+1'}],
+    )
+
+    with app.app_context():
+        log = TaskLog.query.one()
+        assert (log.source_rows, log.target_rows) == (5, 5)
+        assert log.duration > 0 and log.input_bytes > 0 and log.output_bytes > 0 and log.peak_rss_bytes > 0
+        assert {'load', 'plan', 'columns', 'formulas', 'write', 'save'} <= {s.stage for s in log.stages}
+
+        assert [row['template_name'] for row in logging_service.get_slowest_templates()] == ['template.xlsx']
+        assert abs(sum(row['share'] for row in logging_service.get_stage_breakdown()) - 1) < 1e-6
+
+        user_service.create_user('admin', 'secret', role='admin')
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'secret'})
+    page = client.get('/admin/reports').get_data(as_text=True)
+    assert 'Самые медленные шаблоны' in page and 'template.xlsx' in page and 'formulas' in page
+
+
+def test_metrics_endpoint_requires_admin_or_token(app):
+    app.config['METRICS_TOKEN'] = 'scrape-token'
+    _run(app, _source(), _template(),
+         template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}],
+         sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}])
+
+    client = app.test_client()
+    assert client.get('/admin/metrics').status_code != 200
+    assert client.get('/admin/metrics', headers={'Authorization': 'Bearer wrong'}).status_code != 200
+
+    response = client.get('/admin/metrics', headers={'Authorization': 'Bearer scrape-token'})
+    text = response.get_data(as_text=True)
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    assert 'excel_stage_duration_seconds_bucket{stage="load",le="+Inf"}' in text
+    assert 'socketio_events_total{event="task_complete"}' in text
+    assert 'process_resident_memory_bytes' in text and 'task_statuses_size' in text
+
+
+def test_processing_logs_through_queue_with_task_id(app, capsys):
+    import logging
+
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logging.getLogger('app').addHandler(handler)
+    try:
+        _run(app, _source(), _template(),
+             template_rules=[{'source_sheet': 'Нет такого', 'source_cell': 'A1', 'template_col': 'A'}],
+             source_cell_fill_rules=[{'source_sheet': 'Нет такого', 'source_cell': 'A1', 'target_col': 'B'}])
+    finally:
+        logging.getLogger('app').removeHandler(handler)
+
+    assert capsys.readouterr().out == ''
+    warning = next(r for r in records if r.levelno == logging.WARNING)
+    assert warning.task_id == 'test-task' and 'Нет такого' in warning.getMessage()
+
+
+def test_reports_count_tasks_in_sql_with_pagination_and_date_filter(app):
+    import datetime
+    from app.extensions import db
+    from app.models import TaskLog
+    from app.services import logging_service, user_service
+
+    with app.app_context():
+        admin = user_service.create_user('admin', 'secret', role='admin')
+        for day in range(1, 61):
+            status = 'Ошибка: сбой' if day % 10 == 0 else 'Готово!'
+            logging_service.log_task(f'task-{day}', admin.id, status, 'Шаблон')
+            TaskLog.query.filter_by(task_uuid=f'task-{day}').update(
+                {'timestamp': datetime.datetime(2026, 1, 1) + datetime.timedelta(days=day - 1)})
+        db.session.commit()
+        admin_id = admin.id
+
+        assert logging_service.get_task_counts_by_owner()[admin_id] == \
+            {'tasks_run': 60, 'tasks_success': 54, 'tasks_error': 6}
+        assert logging_service.get_task_counts_by_owner(datetime.date(2026, 1, 1), datetime.date(2026, 1, 10)) == \
+            {admin_id: {'tasks_run': 10, 'tasks_success': 9, 'tasks_error': 1}}
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'secret'})
+    page = client.get('/admin/reports?date_from=2026-01-01&date_to=2026-01-31').get_data(as_text=True)
+    assert 'Весь журнал (31)' in page
+
+    page = client.get(f'/admin/reports/{admin_id}?page=2').get_data(as_text=True)
+    assert 'Всего запусков: 60' in page
+    # Вторая страница (записи 51-60, сначала новые): 10 января ... 1 января
+    assert '2026-01-10' in page and '2026-01-11' not in page
+
+
+def test_task_log_writer_saves_batches_in_background(app):
+    from sqlalchemy import text
+    from app.extensions import db
+    from app.models import TaskLog
+    from app.services import logging_service
+
+    app.config['TASK_LOG_ASYNC'] = True
+    metrics = {'duration': 1.5, 'stages': {'load': 1.0, 'save': 0.5}, 'counters': {'rows_written': 10}}
+    with app.app_context():
+        for i in range(5):
+            logging_service.log_task(f'async-{i}', None, 'Успешно', 'Шаблон', metrics=metrics)
+        assert logging_service.flush_task_logs(timeout=10)
+        assert logging_service.pending_task_logs() == 0
+        logs = TaskLog.query.order_by(TaskLog.task_uuid).all()
+        assert [log.task_uuid for log in logs] == [f'async-{i}' for i in range(5)]
+        assert all(log.target_rows == 10 and len(log.stages) == 2 for log in logs)
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+
+
+def test_logged_in_user_is_loaded_from_cache_and_invalidated_on_changes(app):
+    from sqlalchemy import event
+    from app.extensions import db
+    from app.models import User
+    from app.services import user_service
+
+    with app.app_context():
+        user_id = user_service.create_user('user', 'secret').id
+        engine = db.engine
+    task_statuses.create('cached-task', {'owner_id': user_id})
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+
+    user_queries = []
+
+    def count_user_queries(conn, cursor, statement, *args):
+        if statement.startswith('SELECT user.id'):
+            user_queries.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count_user_queries)
+    try:
+        for _ in range(5):
+            assert client.get('/status/cached-task').get_json()['owner_id'] == user_id
+        assert len(user_queries) == 1
+        assert client.get('/admin/users').status_code == 403
+
+        # Смена роли сбрасывает запись: следующий запрос видит новую роль
+        with app.app_context():
+            db.session.get(User, user_id).role = 'admin'
+            db.session.commit()
+        assert client.get('/admin/users').status_code == 200
+        assert len(user_queries) > 1
+
+        with app.app_context():
+            assert user_service.delete_user(user_id)
+        assert client.get('/status/cached-task').status_code == 302
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_user_queries)
+        task_statuses.delete('cached-task')
+
+
+def test_prefork_preload_loads_address_index_and_template_plans(app, monkeypatch):
+    import gc
+    import os
+    from app.services import excel_processor, prefork, template_plans
+    from app.services.geocoding_service import address_service
+
+    for name, value in (('_data_loaded', False), ('index', None), ('kdtree', None)):
+        monkeypatch.setattr(address_service, name, value)
+    with open(app.config['ADDRESS_CSV_FILE'], 'w', encoding='utf-8') as f:
+        f.write('"Москва, Тверская 1",55.7575,37.6132\n"Казань, Баумана 5",55.7907,49.1144\n')
+    definition = {'template_name': 'Отчет', 'formula_rules': [{'formula': '=A{row}*2', 'template_col': 'B'}]}
+    json_path = os.path.join(app.config['TEMPLATES_DB_FOLDER'], 'plan.json')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(definition, f)
+
+    try:
+        prefork.preload(app)
+        assert gc.get_freeze_count() > 0
+    finally:
+        gc.unfreeze()
+    assert address_service.kdtree is not None and address_service.get_address(55.79, 49.11) == 'Казань, Баумана 5'
+
+    with app.app_context():
+        assert template_plans.get('plan') == definition
+        assert excel_processor.compile_formula('=A{row}*2').row_columns == {1}
+        template_plans.get('plan')['template_name'] = 'изменено'
+        assert [data['template_name'] for _, data in template_plans.all_templates()] == ['Отчет']
+
+        # Измененный в другом процессе файл перечитывается, удаленный - забывается
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(definition, template_name='Отчет 2'), f)
+        assert template_plans.get('plan')['template_name'] == 'Отчет 2'
+        os.remove(json_path)
+        assert template_plans.get('plan') is None and template_plans.all_templates() == []
+
+
+def test_logging_listener_restarts_in_forked_child(app, tmp_path, monkeypatch):
+    import logging
+    from app.utils import log
+
+    log_path = tmp_path / 'child.log'
+    file_handler = logging.FileHandler(log_path, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(log.LOG_FORMAT))
+    monkeypatch.setattr(log._listener, 'handlers', log._listener.handlers + (file_handler,))
+
+    pid = os.fork()
+    if pid == 0:
+        # Дочерний процесс: запись должна дойти до обработчиков до выхода
+        try:
+            with log.TaskLogContext('child-task'):
+                logging.getLogger('app.test').warning("запись из воркера %s", os.getpid())
+            log._listener.stop()
+            file_handler.flush()
+        finally:
+            os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    file_handler.close()
+    assert status == 0
+    assert f"WARNING [child-task] app.test: запись из воркера {pid}" in log_path.read_text(encoding='utf-8')
+    # Поток родителя продолжает работать
+    assert log._listener._thread is not None and log._listener._thread.is_alive()
+
+
+def test_address_index_lookups_match_dict_semantics(app, monkeypatch):
+    from app.services.geocoding_service import AddressIndex, address_service
+
+    index = AddressIndex(['Москва, Тверская 1', 'Казань, Баумана 5', 'МОСКВА Тверская-1'],
+                         ['москватверская1', 'казаньбаумана5', 'москватверская1'],
+                         [(55.75, 37.61), (55.79, 49.11), (55.76, 37.62)])
+    assert len(index) == 3 and index.lookup('казаньбаумана5') == (55.79, 49.11)
+    # Одинаковые ключи: как в словаре, действует последняя строка
+    assert index.lookup('москватверская1') == (55.76, 37.62)
+    assert index.lookup('казаньбаумана6') is None and index.find('') is None
+    assert index.keys() == ['москватверская1', 'казаньбаумана5', 'москватверская1']
+    assert index.address(1) == 'Казань, Баумана 5' and index.key(2) == 'москватверская1'
+    # Совпадение 64-битного хеша без совпадения ключа - не находка
+    for i in range(len(index._slot_hashes)):
+        if index._slot_rows[i]:
+            index._slot_hashes[i] = hash('новосибирсклени1')
+    assert index.lookup('новосибирсклени1') is None
+
+    empty = AddressIndex([], [], [])
+    assert len(empty) == 0 and empty.lookup('москватверская1') is None and empty.keys() == []
+
+    def reset():
+        for name, value in (('_data_loaded', False), ('index', None), ('kdtree', None)):
+            monkeypatch.setattr(address_service, name, value)
+
+    csv_path = app.config['ADDRESS_CSV_FILE']
+    with open(csv_path, 'w', encoding='utf-8') as f:
+        f.write('"Москва, Тверская 1",55.7575,37.6132\n"Казань, Баумана 5",55.7907,49.1144\nбез координат\n')
+    reset()
+    with app.app_context():
+        assert address_service.get_coords('москва тверская, 1') == (55.7575, 37.6132)
+        # Нечеткий поиск по keys()
+        assert address_service.get_coords('Казань, ул. Баумана 5') == (55.7907, 49.1144)
+        assert address_service.get_coords('Владивосток, Светланская 10') == (None, None)
+        assert address_service.get_address(55.79, 49.11) == 'Казань, Баумана 5'
+
+    # Пустая база (только некорректные строки) загружается один раз
+    with open(csv_path, 'w', encoding='utf-8') as f:
+        f.write('Адрес;Широта;Долгота\n')
+    reset()
+    loads = []
+    original_from_csv = AddressIndex.from_csv
+    monkeypatch.setattr(AddressIndex, 'from_csv', classmethod(
+        lambda cls, path: loads.append(path) or original_from_csv.__func__(cls, path)))
+    with app.app_context():
+        assert address_service.get_coords('Москва, Тверская 1') == (None, None)
+        assert address_service.get_coords('Казань, Баумана 5') == (None, None)
+        assert address_service.get_address(55.79, 49.11) is None
+    assert len(loads) == 1 and len(address_service) == 0
+
+
+def test_task_state_is_shared_between_workers_through_sqlite_store(app):
+    import os
+    from app.services import user_service
+    from app.services.task_store import SQLiteTaskStore
+
+    with app.app_context():
+        owner = user_service.create_user('user', 'secret')
+        owner_id = owner.id
+    task_statuses.create('shared-task', {'owner_id': owner_id})
+    process_excel_hybrid(
+        app, 'shared-task', _to_bytes(_source()), _to_bytes(_template()), {'t_start_row': 1},
+        [{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        [{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}], 'none',
+        'template.xlsx', task_statuses)
+
+    # Другой воркер: свое соединение с тем же файлом состояния и папкой результатов
+    worker_store = task_statuses.backend
+    other_worker = SQLiteTaskStore(worker_store.path, worker_store.results_folder)
+    assert os.path.dirname(worker_store.path) == app.config['PROCESSED_FOLDER']
+    task_statuses.backend = other_worker
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+    status = client.get('/status/shared-task').get_json()
+    assert status['result_ready'] and status['owner_id'] == owner_id
+    response = client.get('/download/shared-task')
+    assert response.status_code == 200
+    assert load_workbook(io.BytesIO(response.data)).active['A2'].value == 1
+    response.close()
+
+    other_worker.purge(0)
+    assert client.get('/status/shared-task').get_json() == {'status': 'Задача не найдена.'}
+    assert worker_store.open_result('shared-task') is None
+
+
+def test_queued_job_survives_crashed_worker_and_runs_in_another(app):
+    import os
+    from app.extensions import job_queue
+    from app.services import user_service
+    from app.services.job_worker import Worker
+
+    with app.app_context():
+        user_service.create_user('user', 'secret')
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+    response = client.post('/process', data={
+        'source_file': (_to_bytes(_source()), 'source.xlsx'),
+        'template_file': (_to_bytes(_template()), 'template.xlsx'),
+        'template_range_start': 'A1',
+    }, content_type='multipart/form-data')
+    task_id = response.get_json()['task_id']
+    assert job_queue.stats() == {'queued': 1, 'running': 0}
+
+    # Обработчик забрал задание и "упал": аренда истекла без сердцебиения
+    crashed = job_queue.claim('crashed-worker', lease_seconds=-1)
+    assert crashed['id'] == task_id and crashed['attempts'] == 1
+    job_dir = os.path.dirname(crashed['payload']['source_path'])
+
+    assert Worker(app).run_once()
+    status = client.get(f'/status/{task_id}').get_json()
+    assert status['result_ready']
+    assert client.get(f'/download/{task_id}').status_code == 200
+    assert job_queue.stats() == {'queued': 0, 'running': 0} and not os.path.exists(job_dir)
+    assert not Worker(app).run_once()
+
+    # Исчерпавшее попытки задание снимается с очереди с ошибкой (тот же файл - без кэша результатов)
+    app.config['JOB_MAX_ATTEMPTS'] = 1
+    app.config['RESULT_CACHE_ENABLED'] = False
+    response = client.post('/process', data={
+        'source_file': (_to_bytes(_source()), 'source.xlsx'),
+        'template_file': (_to_bytes(_template()), 'template.xlsx'),
+    }, content_type='multipart/form-data')
+    task_id = response.get_json()['task_id']
+    job_queue.claim('crashed-worker', lease_seconds=-1)
+    assert not Worker(app).run_once()
+    status = client.get(f'/status/{task_id}').get_json()
+    assert status['status'].startswith('Ошибка') and not status['result_ready']
+
+
+def test_scheduler_applies_caps_priority_and_round_robin(tmp_path):
+    from app.services.job_queue import SQLiteJobQueue, PRIORITY_HIGH
+
+    queue = SQLiteJobQueue(str(tmp_path / 'queue.db'))
+    for i in range(3):
+        queue.enqueue(f'a{i}', 'user-a', {})
+    queue.enqueue('b0', 'user-b', {})
+    queue.enqueue('c-small', 'user-c', {}, priority=PRIORITY_HIGH)
+
+    def claim():
+        job = queue.claim('w', 60, max_running=4, max_running_per_user=2)
+        return job and job['id']
+
+    # Небольшой файл - первым, затем пользователи по кругу, а не все файлы user-a подряд
+    assert [claim(), claim(), claim()] == ['c-small', 'a0', 'b0']
+    assert claim() == 'a1'
+    assert claim() is None  # 4 задания выполняются
+    queue.complete('b0', 'w')
+    assert claim() is None  # у user-a уже 2 задания
+    queue.complete('a0', 'w')
+    assert claim() == 'a2'
+
+
+def test_cancel_stops_running_task_between_row_chunks_and_removes_queued_job(app):
+    from app.extensions import job_queue
+    from app.models import TaskLog
+    from app.services import user_service
+
+    source = Workbook()
+    source.active.title = 'Лист1'
+    for i in range(1, 1002):
+        source.active.append([i])
+    checks = []
+    task_statuses.create('cancel-task', {'owner_id': None})
+    process_excel_hybrid(
+        app, 'cancel-task', _to_bytes(source), _to_bytes(_template()), {'t_start_row': 1},
+        [{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        [{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}], 'none', 'template.xlsx',
+        task_statuses, cancel_check=lambda: checks.append(1) or len(checks) >= 3)
+    # Проверки: после загрузки, после плана и после первого блока строк
+    assert len(checks) == 3
+    task = task_statuses.get('cancel-task')
+    assert not task['result_ready'] and task_statuses.open_result('cancel-task') is None
+    with app.app_context():
+        log = TaskLog.query.filter_by(task_uuid='cancel-task').one()
+        assert (log.status, log.status_kind) == ('Отменено пользователем', 'cancelled')
+
+    with app.app_context():
+        user_service.create_user('user', 'secret')
+        user_service.create_user('other', 'secret')
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+    task_id = client.post('/process', data={
+        'source_file': (_to_bytes(_source()), 'source.xlsx'),
+        'template_file': (_to_bytes(_template()), 'template.xlsx'),
+    }, content_type='multipart/form-data').get_json()['task_id']
+
+    other = app.test_client()
+    other.post('/login', data={'username': 'other', 'password': 'secret'})
+    assert other.post(f'/cancel/{task_id}').status_code == 403
+
+    assert client.post(f'/cancel/{task_id}').get_json()['status'] == 'Отменено пользователем'
+    assert job_queue.stats()['queued'] == 0
+    assert client.get(f'/status/{task_id}').get_json()['status'] == 'Отменено пользователем'
+    assert client.post(f'/cancel/{task_id}').status_code == 409
+
+
+def test_repeated_run_is_served_from_result_cache_with_lru_eviction(app):
+    import os
+    import time
+    from app.extensions import job_queue
+    from app.services import result_cache, user_service
+    from app.services.job_worker import Worker
+
+    with app.app_context():
+        user_service.create_user('user', 'secret')
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+
+    # Байты файлов фиксируются один раз: openpyxl записывает в файл время сохранения
+    source_bytes, template_bytes = _to_bytes(_source()).getvalue(), _to_bytes(_template()).getvalue()
+
+    def submit():
+        return client.post('/process', data={
+            'source_file': (io.BytesIO(source_bytes), 'source.xlsx'),
+            'template_file': (io.BytesIO(template_bytes), 'template.xlsx'),
+        }, content_type='multipart/form-data').get_json()['task_id']
+
+    first = submit()
+    assert Worker(app).run_once()
+    second = submit()
+    status = client.get(f'/status/{second}').get_json()
+    assert status['result_ready'] and status['from_cache'] and job_queue.stats()['queued'] == 0
+    assert client.get(f'/download/{second}').data == client.get(f'/download/{first}').data
+
+    # Новая версия справочника адресов - другой ключ
+    with open(app.config['ADDRESS_CSV_FILE'], 'w', encoding='utf-8') as f:
+        f.write('"Ленина ул. 1",55.0,37.0\n')
+    submit()
+    assert job_queue.stats()['queued'] == 1
+    assert Worker(app).run_once()
+
+    # Превышение размера - удаляется давно не использованный результат
+    cache_dir = os.path.join(app.config['PROCESSED_FOLDER'], 'result_cache')
+    keys = sorted((os.path.getmtime(os.path.join(cache_dir, name)), name[:-5])
+                  for name in os.listdir(cache_dir) if name.endswith('.xlsx'))
+    assert len(keys) == 2
+    old_key, new_key = keys[0][1], keys[1][1]
+    with app.app_context():
+        past = time.time() - 60
+        os.utime(os.path.join(cache_dir, f'{new_key}.xlsx'), (past, past))
+        assert result_cache.lookup(old_key) is not None  # использование обновляет время
+        # Размер записи - все ее файлы: результат, описание и отчет о замечаниях
+        old_size = sum(os.path.getsize(os.path.join(cache_dir, name))
+                       for name in os.listdir(cache_dir) if name.startswith(old_key))
+        with open(os.path.join(cache_dir, 'orphan.csv'), 'w', encoding='utf-8') as f:
+            f.write('отчет удаленной записи')
+        result_cache.evict(old_size)
+        assert result_cache.lookup(new_key) is None and result_cache.lookup(old_key) is not None
+        assert sorted(os.listdir(cache_dir)) == [f'{old_key}.json', f'{old_key}.xlsx']
+
+        with open(os.path.join(cache_dir, f'{old_key}.csv'), 'w', encoding='utf-8') as f:
+            f.write('отчет')
+        result_cache.evict(old_size)
+        assert os.listdir(cache_dir) == []
+
+
+def test_result_cache_hit_keeps_the_warnings_report(app):
+    import os
+    from app.services import user_service
+    from app.services.job_worker import Worker
+
+    # Сохраненный шаблон с формулой, которая ошибается на текстовой колонке
+    os.makedirs(app.config['TEMPLATE_EXCEL_FOLDER'], exist_ok=True)
+    _template().save(os.path.join(app.config['TEMPLATE_EXCEL_FOLDER'], 'report.xlsx'))
+    with open(os.path.join(app.config['TEMPLATES_DB_FOLDER'], 'report.json'), 'w', encoding='utf-8') as f:
+        json.dump({'template_name': 'Отчет', 'excel_file': 'report.xlsx', 'header_start_cell': 'A1',
+                   'sheet_settings': [{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+                   'rules': [{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}],
+                   'formula_rules': [{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                                      'formula': '=C{row}+1'}]}, f)
+    with app.app_context():
+        user_service.create_user('user', 'secret')
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+    source_bytes = _to_bytes(_source()).getvalue()
+
+    def submit():
+        return client.post('/process', data={'source_file': (io.BytesIO(source_bytes), 'source.xlsx'),
+                                              'saved_template': 'report'},
+                           content_type='multipart/form-data').get_json()['task_id']
+
+    first = submit()
+    assert Worker(app).run_once()
+    second = submit()
+    statuses = [client.get(f'/status/{task_id}').get_json() for task_id in (first, second)]
+    assert statuses[1]['from_cache'] and statuses[1]['warnings'] == statuses[0]['warnings'] != []
+    assert statuses[1]['warnings_report']
+    reports = [client.get(f'/download_warnings/{task_id}') for task_id in (first, second)]
+    assert reports[1].status_code == 200 and reports[1].data == reports[0].data
+    assert len(reports[1].get_data(as_text=True).splitlines()) == 1 + 5
+
+
+def test_incremental_run_appends_only_new_rows_and_falls_back_on_changes(app):
+    rules = dict(
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'},
+                        {'source_sheet': 'Лист1', 'source_cell': 'B1', 'template_col': 'B'}],
+        formula_rules=[{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                        'formula': '=B{row}*2'}],
+        static_value_rules=[{'target_sheet': 'Лист1', 'target_col': 'E', 'value': 'ok'}],
+        visible_rows_only=True,
+    )
+    incremental = {'owner_id': 'user', 'template_id': 't1', 'config': 'rules-v1'}
+
+    def source(rows, changed=False):
+        wb = _source()
+        ws = wb.active
+        for i in range(6, rows + 1):
+            ws.append([i, i * 10, f'link {i}'])
+        ws.row_dimensions[3].hidden = True
+        if changed:
+            ws['B2'] = 999
+        return wb
+
+    def run(source_wb):
+        task_statuses.create('inc-task', {'owner_id': 'user'})
+        process_excel_hybrid(
+            app, 'inc-task', _to_bytes(source_wb), _to_bytes(_template()), {'t_start_row': 1},
+            rules['sheet_settings'], rules['template_rules'], 'none', 'template.xlsx', task_statuses,
+            formula_rules=rules['formula_rules'], static_value_rules=rules['static_value_rules'],
+            visible_rows_only=True, incremental=incremental)
+        task = task_statuses.get('inc-task')
+        with task_statuses.open_result('inc-task') as result_file:
+            rows = list(load_workbook(result_file).active.iter_rows(min_row=2, max_col=5, values_only=True))
+        task_statuses.delete('inc-task')
+        return rows, task['metrics']['counters'].get('resumed_rows')
+
+    def full_run(source_wb):
+        ws, _ = _run(app, source_wb, _template(), **rules)
+        return list(ws.iter_rows(min_row=2, max_col=5, values_only=True))
+
+    assert run(source(5)) == (full_run(source(5)), None)
+    # Источник дополнился: 4 видимые строки уже в результате, дописываются 3 новые
+    assert run(source(8)) == (full_run(source(8)), 4)
+    assert run(source(8)) == (full_run(source(8)), 7)
+    # Изменилась прежняя строка - полный прогон
+    assert run(source(10, changed=True)) == (full_run(source(10, changed=True)), None)
+    # Другие правила - тоже
+    incremental['config'] = 'rules-v2'
+    assert run(source(11, changed=True))[1] is None
+
+
+def test_incremental_run_keeps_warnings_and_report_of_a_full_run(app):
+    from app.services import warning_report
+
+    sheet_settings = [{'sheet_name': 'Лист1', 'start_cell': 'A1'}]
+    template_rules = [{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}]
+    # Формула ошибается на каждой строке: колонка C текстовая
+    formula_rules = [{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                      'formula': '=C{row}+1'}]
+
+    def source(rows):
+        wb = _source()
+        for i in range(6, rows + 1):
+            wb.active.append([i, i * 10, f'link {i}'])
+        return wb
+
+    def run(source_wb, incremental=None):
+        task_statuses.create('inc-task', {'owner_id': 'user'})
+        process_excel_hybrid(
+            app, 'inc-task', _to_bytes(source_wb), _to_bytes(_template()), {'t_start_row': 1},
+            sheet_settings, template_rules, 'none', 'template.xlsx', task_statuses,
+            formula_rules=formula_rules, incremental=incremental)
+        task = task_statuses.get('inc-task')
+        with app.app_context(), open(warning_report.report_path('inc-task'), encoding='utf-8-sig') as f:
+            report = f.read()
+        task_statuses.delete('inc-task')
+        return task['warnings'], report, task['metrics']['counters'].get('resumed_rows')
+
+    incremental = {'owner_id': 'user', 'template_id': 't1', 'config': 'rules-v1'}
+    assert run(source(5), incremental)[2] is None
+    for rows, resumed in ((8, 5), (8, 8), (12, 8)):
+        warnings, report, resumed_rows = run(source(rows), incremental)
+        full_warnings, full_report, _ = run(source(rows))
+        assert resumed_rows == resumed
+        # Одна группа со счетчиком по всем строкам, а не склейка сводок прогонов
+        assert warnings == full_warnings and len(warnings) == 1
+        assert f'(случаев: {rows})' in warnings[0]
+        assert report == full_report and len(report.splitlines()) == 1 + rows
+
+
+def test_preview_returns_first_rows_with_all_rules_applied(app):
+    from app.services import user_service
+
+    with app.app_context():
+        user_service.create_user('user', 'secret')
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+
+    source_wb = _source()
+    for i in range(6, 5001):
+        source_wb.active.append([i, i * 10, f'link {i}'])
+    source_wb.active.row_dimensions[3].hidden = True
+    source_wb.create_sheet('Итоги')['B2'] = 'итого'
+    template_path = app.config['TEMPLATE_EXCEL_FOLDER'] + '/preview.xlsx'
+    _template().save(template_path)
+    rules = {
+        'excel_file': 'preview.xlsx', 'original_filename': 'preview.xlsx', 'header_start_cell': 'A1',
+        'sheet_settings': [{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+        'rules': [{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'},
+                  {'source_sheet': 'Лист1', 'source_cell': 'C1', 'template_col': 'C'}],
+        'formula_rules': [{'source_sheet': 'Лист1', 'target_sheet': 'Лист1', 'target_col': 'D',
+                           'formula': '=B{row}*2'}],
+        'static_value_rules': [{'target_sheet': 'Лист1', 'target_col': 'E', 'value': 'ok'}],
+        'cell_mappings': [{'source_sheet': 'Итоги', 'source_cell': 'B2', 'dest_cell': 'H1'}],
+        'visible_rows_only': True,
+    }
+    with open(app.config['TEMPLATES_DB_FOLDER'] + '/preview.json', 'w', encoding='utf-8') as f:
+        json.dump(rules, f)
+
+    response = client.post('/preview', data={
+        'source_file': (_to_bytes(source_wb), 'source.xlsx'), 'saved_template': 'preview', 'rows': '3',
+    }, content_type='multipart/form-data').get_json()
+
+    sheet = response['sheets'][0]
+    assert sheet['header'][:8] == ['N', 'Сумма', 'Ссылка', 'Итог', 'Статус', 'Из ячейки', None, 'итого']
+    assert [row[:5] for row in sheet['rows']] == [[1, None, 'link 1', 20.0, 'ok'], [3, None, 'link 3', 60.0, 'ok'],
+                                                 [4, None, 'link 4', 80.0, 'ok']]
+    # Прочитаны только заголовок и первые строки (скрытая строка не в счет)
+    assert response['source_rows'] == {'Лист1': 5, 'Итоги': 2}
+    assert not response['truncated'] and response['warnings'] == []
+    assert client.get('/status/x').get_json()['status'] == 'Задача не найдена.'
+
+
+def test_source_loader_parses_only_sheets_referenced_by_rules(app):
+    from app.services.source_loader import load_source_workbook
+
+    source_wb = _source()
+    source_wb.create_sheet('Сводная', 0)['A1'] = 'не нужна'
+    source_wb.create_sheet('Итоги')['B2'] = 'итого'
+    source_wb.create_sheet('Отчет')['A1'] = 'не нужен'
+    rules = dict(
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'}],
+        cell_mappings=[{'source_sheet': 'Итоги', 'source_cell': 'B2', 'dest_cell': 'H1'}],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+    )
+
+    loaded, skipped = load_source_workbook(_to_bytes(source_wb), rules['template_rules'], rules['cell_mappings'],
+                                           sheet_settings=rules['sheet_settings'])
+    assert loaded.sheetnames == ['Сводная', 'Лист1', 'Итоги', 'Отчет'] and skipped == ['Сводная', 'Отчет']
+    assert loaded['Сводная']['A1'].value is None and loaded['Итоги']['B2'].value == 'итого'
+
+    ws, _ = _run(app, source_wb, _template(), **rules)
+    assert [row[0] for row in ws.iter_rows(min_row=2, max_col=1, values_only=True)] == [1, 2, 3, 4, 5]
+    assert ws['H1'].value == 'итого'
+
+
+def test_stream_reader_matches_openpyxl_values_hidden_rows_and_links(app, monkeypatch):
+    import datetime
+    from openpyxl.cell.rich_text import CellRichText, TextBlock
+    from openpyxl.cell.text import InlineFont
+    from openpyxl.chart import BarChart, Reference
+    from app.services.source_loader import load_source_workbook
+
+    source_wb = _source()
+    ws = source_wb.active
+    ws.append([6, 0.5, True])
+    ws.append([7, datetime.datetime(2024, 3, 1, 12, 30), CellRichText('жирный ', TextBlock(InlineFont(b=True), 'текст'))])
+    ws.append([8, datetime.date(2024, 3, 2), '#N/A'])
+    ws['D10'] = 'далеко'
+    ws.row_dimensions[4].hidden = True
+    ws['C5'].hyperlink = '#Лист1!A1'
+    chart = BarChart()
+    chart.add_data(Reference(ws, min_col=2, min_row=1, max_row=6), titles_from_data=True)
+    source_wb.create_chartsheet('Диаграмма').add_chart(chart)
+    rules = dict(template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'},
+                                 {'source_sheet': 'Лист1', 'source_cell': 'C1', 'template_col': 'C'}],
+                 sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}])
+
+    expected = load_workbook(_to_bytes(source_wb), data_only=True).active
+    streamed, _ = load_source_workbook(_to_bytes(source_wb), rules['template_rules'],
+                                       sheet_settings=rules['sheet_settings'], backend='stream')
+    streamed_ws = streamed['Лист1']
+    for row in expected.iter_rows():
+        for cell in row:
+            got = streamed_ws.cell(row=cell.row, column=cell.column)
+            assert (got.value, type(got.value)) == (cell.value, type(cell.value)), cell.coordinate
+            assert bool(got.hyperlink) == bool(cell.hyperlink), cell.coordinate
+            if cell.hyperlink:
+                assert got.hyperlink.target == cell.hyperlink.target
+    assert streamed_ws.row_dimensions.keys() == {4} and streamed_ws.max_row == 10
+    assert [[(cell.row, cell.column, cell.value) for cell in row] for row in streamed_ws.iter_rows()] == \
+        [[(cell.row, cell.column, cell.value) for cell in row] for row in expected.iter_rows()]
+    assert list(streamed_ws.iter_rows(min_row=4, max_row=11, min_col=2, max_col=5, values_only=True)) == \
+        list(expected.iter_rows(min_row=4, max_row=11, min_col=2, max_col=5, values_only=True))
+    # Лист диаграммы ячеек не содержит: в книге только листы с ячейками, как wb.worksheets
+    assert streamed.sheetnames == [sheet.title for sheet in load_workbook(_to_bytes(source_wb)).worksheets]
+
+    results = {}
+    for backend in ('openpyxl', 'stream'):
+        monkeypatch.setitem(app.config, 'SOURCE_READER', backend)
+        result_ws, _ = _run(app, source_wb, _template(), visible_rows_only=True, **rules)
+        results[backend] = [[(cell.value, cell.hyperlink.target if cell.hyperlink else None) for cell in row]
+                            for row in result_ws.iter_rows()]
+    assert results['stream'] == results['openpyxl']
+    assert [row[0][0] for row in results['stream'][1:]] == [1, 2, 4, 5, 6, 7, 8]
+
+
+def test_streaming_output_splices_rows_into_template_like_in_memory_save(app, monkeypatch):
+    import datetime
+    from openpyxl.styles import Font
+
+    source_wb = _source()
+    source_wb.active['B4'] = datetime.date(2024, 3, 1)
+    template_wb = _template(['', None, None, None, 'готово'])
+    template_ws = template_wb.active
+    template_ws['A1'].font = Font(bold=True)
+    template_ws['A1'].hyperlink = 'https://example.com/help'
+    template_ws['D2'].font = Font(italic=True)
+    template_ws.row_dimensions[3].height = 30
+    template_ws['A20'] = 'Подпись'
+    rules = dict(
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'A1', 'template_col': 'A'},
+                        {'source_sheet': 'Лист1', 'source_cell': 'B1', 'template_col': 'B'},
+                        {'source_sheet': 'Лист1', 'source_cell': 'C1', 'template_col': 'C'}],
+        static_value_rules=[{'target_col': 'E', 'value': 'ok'}],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+    )
+
+    results = {}
+    for streaming in (False, True):
+        monkeypatch.setitem(app.config, 'STREAMING_OUTPUT', streaming)
+        ws, _ = _run(app, source_wb, template_wb, **rules)
+        results[streaming] = (
+            [[(cell.value, cell.hyperlink.target if cell.hyperlink else None, cell.font.b, cell.font.i,
+               cell.number_format) for cell in row] for row in ws.iter_rows()],
+            {r: dim.height for r, dim in ws.row_dimensions.items() if dim.height},
+            ws.dimensions,
+        )
+    assert results[True] == results[False]
+    rows, heights, _ = results[True]
+    assert rows[0][0][:3] == ('N', 'https://example.com/help', True) and rows[2][2][1] == 'https://example.com/2'
+    assert rows[1][3][3] is True and heights == {3: 30} and rows[19][0][0] == 'Подпись'
+    assert isinstance(rows[3][1][0], datetime.datetime) and [row[4][0] for row in rows[1:6]] == ['ok'] * 5
+
+
+def test_streaming_output_keeps_internal_source_links_like_in_memory_save(app, monkeypatch):
+    from openpyxl.worksheet.hyperlink import Hyperlink
+
+    source_wb = _source()
+    # Ссылка на место в книге: только location, без связи в .rels
+    source_wb.active['C4'].hyperlink = Hyperlink(ref='C4', location="'Лист1'!A1")
+    source_wb = load_workbook(_to_bytes(source_wb))
+    assert source_wb.active['C4'].hyperlink.target is None
+    rules = dict(
+        template_rules=[{'source_sheet': 'Лист1', 'source_cell': 'C1', 'template_col': 'C'}],
+        sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+    )
+
+    results = {}
+    for streaming in (False, True):
+        monkeypatch.setitem(app.config, 'STREAMING_OUTPUT', streaming)
+        ws, _ = _run(app, source_wb, _template(), **rules)
+        results[streaming] = [(cell.value, cell.hyperlink.target if cell.hyperlink else None, cell.style)
+                              for cell in ws['C'][1:]]
+    assert results[True] == results[False]
+    assert results[True][1] == ('link 2', 'https://example.com/2', 'Hyperlink')
+    assert results[True][2] == ('link 3', None, 'Hyperlink')